@@ -0,0 +1,428 @@
+'''
+Autor: Mijie Pang
+Date: 2024-04-20 10:12:36
+LastEditTime: 2024-04-20 16:45:03
+Description: shared analysis engine for the assimilation schemes,
+the analysis method is selected by name from Assimilation.json
+'''
+import logging
+import numpy as np
+from scipy import sparse
+from datetime import datetime
+
+from Localization_lib import Localization, LocalizationCache
+
+
+### *--- symmetric square root of the ensemble-space analysis ---* ###
+def ensemble_transform(C: np.ndarray, Yp: np.ndarray, d: np.ndarray,
+                       Ne: int, inflation=1.0) -> np.ndarray:
+    """
+    Solve the ETKF analysis in the Ne * Ne ensemble space, leading axes
+    (e.g. levels) are solved as a batch.
+
+    params:
+        C: Yp.T @ R^-1 (localized), dim : [L] * Ne * m
+        Yp: ensemble perturbation in observation space, dim : [L] * m * Ne
+        d: innovation of the ensemble mean, dim : [L] * m
+        Ne: ensemble number.
+        inflation: multiplicative prior inflation factor.
+
+    return:
+        transform matrix W (mean weights added to every column),
+        dim : [L] * Ne * Ne
+    """
+
+    A = (Ne - 1) / inflation * np.eye(Ne) + C @ Yp
+    eigen_value, eigen_vector = np.linalg.eigh(A)
+    eigen_value = eigen_value[..., np.newaxis, :]
+    eigen_vector_T = np.swapaxes(eigen_vector, -1, -2)
+
+    P_a = (eigen_vector / eigen_value) @ eigen_vector_T
+    W_a = (eigen_vector * np.sqrt((Ne - 1) / eigen_value)) @ eigen_vector_T
+    w_mean = P_a @ (C @ d[..., np.newaxis])
+
+    return W_a + w_mean
+
+
+### *--- perform the analysis in observation space or ensemble space ---* ###
+class Analysis:
+
+    def __init__(self, analysis='enkf', **kwargs) -> None:
+
+        methods = {
+            'enkf': self.enkf,
+            'etkf': self.etkf,
+            'letkf': self.letkf,
+        }
+        if analysis not in methods.keys():
+            raise ValueError('Invalid analysis method -> "%s" <-' %
+                             (analysis))
+
+        self.analysis = analysis
+        self.methods = methods
+
+        self.inflation = kwargs.get('inflation', 1.0)
+        self.distance_threshold = kwargs.get('distance_threshold', 500)
+        self.distance_method = kwargs.get('distance_method', 'empirical')
+        self.sparse_localization = kwargs.get('sparse_localization', False)
+        # entries per block of the sparse cross covariance and the letkf
+        self.block_size = kwargs.get('block_size', 2**22)
+
+        # localization matrices are reused across cycles with the same network
+        self.cache = None
+        if kwargs.get('cache_localization', False) and kwargs.get('cache_dir'):
+            self.cache = LocalizationCache(kwargs['cache_dir'],
+                                           kwargs.get('cache_size', 16))
+
+    ### *--- Method Portal ---* ###
+    def update(self, X_f: np.ndarray, HX_f: np.ndarray, y: np.ndarray,
+               obs_error: np.ndarray, **kwargs) -> tuple:
+        """
+        Update the ensemble with the selected analysis method.
+
+        params:
+            X_f: ensemble prior of the state to update, dim : Ns * Ne
+            HX_f: ensemble prior in observation space, dim : m * Ne
+            y: observations, dim : m (or m * 1)
+            obs_error: observational error (std), dim : m (or m * 1)
+
+        return:
+            ensemble posterior (Ns * Ne) and posterior mean (Ns * 1).
+        """
+
+        start_cal = datetime.now()
+
+        y = np.asarray(y, dtype=float).reshape(-1)
+        obs_error = np.asarray(obs_error, dtype=float).reshape(-1)
+
+        # nothing to assimilate
+        if len(y) == 0:
+            return X_f.copy(), np.mean(X_f, axis=-1, keepdims=True)
+
+        X_a, x_a = self.methods.get(self.analysis)(X_f, HX_f, y, obs_error,
+                                                   **kwargs)
+
+        logging.debug('%s analysis with %s observations took %.2f s' %
+                      (self.analysis, len(y),
+                       (datetime.now() - start_cal).total_seconds()))
+
+        return X_a, x_a
+
+    ### *--- levels sharing one observation set, solved as a batch ---* ###
+    def update_levels(self, X_f: np.ndarray, HX_f: np.ndarray, y: np.ndarray,
+                      obs_error: np.ndarray, **kwargs) -> tuple:
+        """
+        Update several levels observed at the same locations, the levels
+        go through batched linear algebra instead of one analysis each.
+
+        params:
+            X_f: ensemble prior of the levels, dim : L * Ns * Ne
+            HX_f: ensemble prior in observation space, dim : L * m * Ne
+            y: observations, dim : L * m
+            obs_error: observational error (std), dim : L * m
+            kwargs: as update, the localization is shared by the levels.
+
+        return:
+            ensemble posterior (L * Ns * Ne) and posterior mean (L * Ns * 1).
+        """
+
+        start_cal = datetime.now()
+
+        y = np.asarray(y, dtype=float).reshape(HX_f.shape[:-1])
+        obs_error = np.asarray(obs_error, dtype=float).reshape(y.shape)
+
+        # nothing to assimilate
+        if y.shape[-1] == 0:
+            return X_f.copy(), np.mean(X_f, axis=-1, keepdims=True)
+
+        batch_methods = {
+            'enkf': self.enkf_levels,
+            'etkf': self.etkf,
+        }
+        if self.analysis in batch_methods.keys():
+            X_a, x_a = batch_methods.get(self.analysis)(X_f, HX_f, y,
+                                                        obs_error, **kwargs)
+        else:
+            # the local analysis differs on every state point anyway
+            X_a, x_a = np.empty(X_f.shape), np.empty(X_f.shape[:-1] + (1, ))
+            for i_lev in range(len(X_f)):
+                X_a[i_lev], x_a[i_lev] = self.methods.get(self.analysis)(
+                    X_f[i_lev], HX_f[i_lev], y[i_lev], obs_error[i_lev],
+                    **kwargs)
+
+        logging.debug(
+            '%s analysis of %s levels with %s observations took %.2f s' %
+            (self.analysis, len(y), y.shape[-1],
+             (datetime.now() - start_cal).total_seconds()))
+
+        return X_a, x_a
+
+    ### *--------------------------------------* ###
+    ### *---      Observation space EnKF    ---* ###
+
+    def enkf(self, X_f: np.ndarray, HX_f: np.ndarray, y: np.ndarray,
+             obs_error: np.ndarray, **kwargs) -> tuple:
+        """
+        Stochastic EnKF with perturbed observations, solved in observation space.
+
+        kwargs:
+            local: (L1, L2) localization matrices of dim Ns * m and m * m,
+                   dense arrays or scipy sparse matrices.
+            perturb: whether to perturb the observations, default True.
+        """
+
+        Ne = X_f.shape[-1]
+        x_f_mean = np.mean(X_f, axis=-1, keepdims=True)
+        X_pertubate = X_f - x_f_mean
+        U = HX_f - np.mean(HX_f, axis=-1, keepdims=True)
+
+        local = kwargs.get('local', None)
+        PHT = self.cross_covariance(X_pertubate, U, local)
+        increment = self.innovation_solve(U, HX_f, y, obs_error, local,
+                                          kwargs.get('perturb', True))
+
+        X_a = X_f + PHT @ increment[:, :Ne]
+        x_a = x_f_mean + PHT @ increment[:, Ne:]
+
+        return X_a, x_a
+
+    def enkf_levels(self, X_f: np.ndarray, HX_f: np.ndarray, y: np.ndarray,
+                    obs_error: np.ndarray, **kwargs) -> tuple:
+        """
+        The EnKF of update_levels, the innovation covariances of all levels
+        are solved in one batched call. See enkf for the kwargs.
+        """
+
+        Ne = X_f.shape[-1]
+        x_f_mean = np.mean(X_f, axis=-1, keepdims=True)
+        X_pertubate = X_f - x_f_mean
+        U = HX_f - np.mean(HX_f, axis=-1, keepdims=True)
+
+        local = kwargs.get('local', None)
+        increment = self.innovation_solve(U, HX_f, y, obs_error, local,
+                                          kwargs.get('perturb', True))
+
+        if local is None:
+            # PHT @ increment without forming PHT, dim : L * Ns * (Ne + 1)
+            update = X_pertubate @ (np.swapaxes(U, -1, -2) @ increment) / (
+                Ne - 1) * self.inflation
+        else:
+            update = np.empty(X_f.shape[:-1] + (Ne + 1, ))
+            for i_lev in range(len(X_f)):
+                update[i_lev] = self.cross_covariance(
+                    X_pertubate[i_lev], U[i_lev], local) @ increment[i_lev]
+
+        return X_f + update[..., :Ne], x_f_mean + update[..., Ne:]
+
+    ### *--- the pieces of the EnKF, [L] for the leading level axis ---* ###
+    def cross_covariance(self, X_pertubate: np.ndarray, U: np.ndarray,
+                         local: tuple):
+        """
+        Localized PHT of one level, dim : Ns * m
+        """
+
+        Ne = U.shape[-1]
+
+        if local is None:
+            PHT = X_pertubate @ U.T / (Ne - 1) * self.inflation
+        elif sparse.issparse(local[0]):
+            # only the covariances inside the taper support are kept, the
+            # state rows go in blocks of at most block_size covariances so
+            # the peak memory stays below the dense Ns * m product
+            L1 = local[0].tocsr()
+            data = np.empty(L1.nnz)
+            block = max(1, self.block_size // max(1, L1.shape[1]))
+            for start in range(0, L1.shape[0], block):
+                stop = min(start + block, L1.shape[0])
+                lo, hi = L1.indptr[start], L1.indptr[stop]
+                if lo == hi:
+                    continue
+                cols, col_idx = np.unique(L1.indices[lo:hi],
+                                          return_inverse=True)
+                rows = np.repeat(np.arange(stop - start),
+                                 np.diff(L1.indptr[start:stop + 1]))
+                cov = X_pertubate[start:stop] @ U[cols].T
+                data[lo:hi] = cov[rows, col_idx.reshape(-1)]
+            PHT = sparse.csr_matrix(
+                (L1.data * data / (Ne - 1) * self.inflation, L1.indices,
+                 L1.indptr),
+                shape=L1.shape)
+        else:
+            PHT = local[0] * (X_pertubate @ U.T) / (Ne - 1) * self.inflation
+
+        return PHT
+
+    def innovation_solve(self, U: np.ndarray, HX_f: np.ndarray, y: np.ndarray,
+                         obs_error: np.ndarray, local: tuple,
+                         perturb: bool) -> np.ndarray:
+        """
+        (HPHT + R)^-1 applied to the perturbed innovations of the members
+        and to the innovation of the mean, dim : [L] * m * (Ne + 1)
+        """
+
+        Ne, m = U.shape[-1], U.shape[-2]
+
+        HPHT = U @ np.swapaxes(U, -1, -2) / (Ne - 1) * self.inflation
+        if not local is None:
+            L2 = local[1].toarray() if sparse.issparse(local[1]) else local[1]
+            HPHT = L2 * HPHT
+
+        innovation_mean = y - np.mean(HX_f, axis=-1)
+        innovation_ensemble = y[..., np.newaxis] - HX_f
+        if perturb:
+            innovation_ensemble += np.random.normal(
+                loc=0, scale=obs_error[..., np.newaxis], size=HX_f.shape)
+
+        # solve instead of inverting the innovation covariance
+        diagonal = np.arange(m)
+        HPHT[..., diagonal, diagonal] += obs_error**2
+
+        return np.linalg.solve(
+            HPHT,
+            np.concatenate((innovation_ensemble, innovation_mean[...,
+                                                                 np.newaxis]),
+                           axis=-1))
+
+    ### *--------------------------------------* ###
+    ### *---      Ensemble space ETKF       ---* ###
+
+    def etkf(self, X_f: np.ndarray, HX_f: np.ndarray, y: np.ndarray,
+             obs_error: np.ndarray, **kwargs) -> tuple:
+        """
+        Global ensemble transform Kalman filter, solved in Ne * Ne space.
+        """
+
+        Ne = X_f.shape[-1]
+        x_f_mean = np.mean(X_f, axis=-1, keepdims=True)
+        X_pertubate = X_f - x_f_mean
+        y_f_mean = np.mean(HX_f, axis=-1)
+        U = HX_f - y_f_mean[..., np.newaxis]
+
+        # a leading level axis is solved as a batch
+        C = np.swapaxes(U, -1, -2) / (obs_error**2)[..., np.newaxis, :]
+        W = ensemble_transform(C, U, y - y_f_mean, Ne, self.inflation)
+
+        X_a = x_f_mean + X_pertubate @ W
+        x_a = np.mean(X_a, axis=-1, keepdims=True)
+
+        return X_a, x_a
+
+    ### *--------------------------------------* ###
+    ### *---  Local ETKF on every grid point  ---* ###
+
+    def letkf(self, X_f: np.ndarray, HX_f: np.ndarray, y: np.ndarray,
+              obs_error: np.ndarray, **kwargs) -> tuple:
+        """
+        Local ensemble transform Kalman filter. Every state point is analysed
+        with the observations inside 2 * distance_threshold, whose inverse
+        error variance is tapered by the Gaspari-Cohn function.
+
+        kwargs:
+            local: (L1, L2) from localization(), L1 is the sparse taper.
+            state_coord: (lon, lat) of the state points, dim : Ns
+            obs_coord: (lon, lat) of the observations, dim : m
+        """
+
+        Ne = X_f.shape[-1]
+        x_f_mean = np.mean(X_f, axis=-1, keepdims=True)
+        X_pertubate = X_f - x_f_mean
+        y_f_mean = np.mean(HX_f, axis=-1)
+        U = HX_f - y_f_mean[:, np.newaxis]
+        d = y - y_f_mean
+        R_inv = 1 / obs_error**2
+
+        local = kwargs.get('local', None)
+        if local is None or not sparse.issparse(local[0]):
+            L1 = self.sparse_taper(kwargs['state_coord'], kwargs['obs_coord'])
+        else:
+            L1 = local[0].tocsr()
+
+        # the local analyses are solved as batches of state points, the
+        # observation lists are padded with zero weights to the longest one
+        X_a = X_f.copy()
+        states = np.flatnonzero(np.diff(L1.indptr))
+        n_local = np.diff(L1.indptr)[states]
+        block = max(1, self.block_size // max(1, n_local.max(initial=1) * Ne))
+        for start in range(0, len(states), block):
+
+            i_state = states[start:start + block]
+            count = n_local[start:start + block]
+            pad = np.arange(count.max()) < count[:, np.newaxis]
+            entry = np.where(pad, L1.indptr[i_state][:, np.newaxis] +
+                             np.arange(count.max()), 0)
+            local_idx = np.where(pad, L1.indices[entry], 0)
+            rho = np.where(pad, L1.data[entry], 0)
+
+            Yp = U[local_idx]  # dim : block * k * Ne
+            C = np.swapaxes(Yp, -1, -2) * (rho *
+                                           R_inv[local_idx])[:, np.newaxis]
+            W = ensemble_transform(C, Yp, d[local_idx], Ne, self.inflation)
+            X_a[i_state] = x_f_mean[i_state] + np.einsum(
+                'ie,ief->if', X_pertubate[i_state], W)
+
+        x_a = np.mean(X_a, axis=-1, keepdims=True)
+
+        return X_a, x_a
+
+    ### *--------------------------------------* ###
+    ### *---          Localization          ---* ###
+
+    def localization(self, state_coord: tuple, obs_coord: tuple) -> tuple:
+        """
+        Localization matrices required by the selected analysis method.
+
+        params:
+            state_coord: (lon, lat) of the state points, dim : Ns
+            obs_coord: (lon, lat) of the observations, dim : m
+
+        return:
+            (L1, L2) of dim Ns * m and m * m, sparse for letkf or when
+            sparse_localization is set, None for the global etkf.
+        """
+
+        if self.analysis == 'etkf':
+            return None
+
+        start_local = datetime.now()
+        use_sparse = self.analysis == 'letkf' or self.sparse_localization
+
+        if not self.cache is None:
+            key = self.cache.key(*state_coord,
+                                 *obs_coord,
+                                 method=self.distance_method,
+                                 distance_threshold=self.distance_threshold,
+                                 sparse=use_sparse)
+            cached = self.cache.load(key)
+            if not cached is None:
+                logging.debug('Localization loaded from cache %s' % (key))
+                return cached
+
+        if use_sparse:
+            L1 = self.sparse_taper(state_coord, obs_coord)
+            L2 = self.sparse_taper(obs_coord, obs_coord)
+        else:
+            local = Localization(*state_coord, *obs_coord)
+            local.cal_distance(self.distance_method)
+            L1 = local.cal_correlation(
+                distance_threshold=self.distance_threshold)
+
+            local = Localization(*obs_coord, *obs_coord)
+            local.cal_distance(self.distance_method)
+            L2 = local.cal_correlation(
+                distance_threshold=self.distance_threshold)
+
+        logging.debug('Dims of Localization : %s and %s, took %.2f s' %
+                      (L1.shape, L2.shape,
+                       (datetime.now() - start_local).total_seconds()))
+
+        if not self.cache is None:
+            self.cache.save(key, (L1, L2))
+
+        return L1, L2
+
+    def sparse_taper(self, coord1: tuple, coord2: tuple):
+
+        local = Localization(*map(np.ravel, coord1), *map(np.ravel, coord2))
+
+        return local.cal_sparse_correlation(self.distance_method,
+                                            self.distance_threshold)
@@ -8,7 +8,6 @@ import os
 import sys
 import logging
 import numpy as np
-from numpy.linalg import inv
 import netCDF4 as nc
 from datetime import datetime, timedelta
 
@@ -20,8 +19,8 @@ import system_lib as stl
 import LE_obs_lib as leol
 import LE_write_lib as lewl
 import LE_output_lib as leopl
-import Localization_lib as lol
 import Assimilation_lib as asl
+import Analysis_lib as anl
 
 
 def main(Config: dict, **kwargs):
@@ -80,6 +79,11 @@ def main(Config: dict, **kwargs):
 
         var_output = leopl.Output(save_variables_dir,
                                   Config['Model'][model_scheme], **Config)
+        var_output.start(
+            max_queue=Config['Assimilation']['post_process'].get(
+                'output_queue', 4),
+            workers=Config['Assimilation']['post_process'].get(
+                'output_workers', 1))
 
     ### *------------------------------------* ###
     ###                                        ###
@@ -205,63 +209,54 @@ def main(Config: dict, **kwargs):
     obs = leol.Observation(Config['Observation']['path'], 'bc_pm10',
                            Config['Observation']['bc_pm10'])
     obs.get_data(assimilation_time)
-    obs.map2obs('nearest', model_lon=model_lon, model_lat=model_lat)
+    obs.map2obs('nearest',
+                model_lon=model_lon,
+                model_lat=model_lat,
+                index_dir=os.path.join(Config['Info']['path']['output_path'],
+                                       'mapping'))
     obs.get_error('fraction', threshold=200, factor=0.1)
 
-    R = np.diag((obs.error**2).reshape(-1))
-
     ### *---------------------------------------* ###
-    ### *---      calculate Kalman Gain      ---* ###
+    ### *---      calculate posteriors       ---* ###
 
-    # convert [Ne_extend, Nspec, Nlev, Nlat, Nlon] to [Ne_extend, Ns]
+    # convert [Ne_extend, Nspec, Nlev, Nlat, Nlon] to [Ns, Ne_extend]
     X_f_extend = np.sum(X_f_read[:, :, 0, :, :], axis=1)
-    X_f_extend = X_f_extend.reshape([Ne, Ns])
-    x_f_mean = np.nanmean(X_f_extend, axis=0)
-    X_pertubate = (X_f_extend - x_f_mean).T
-    logging.debug(f'dim of X_pertubate : {X_pertubate.shape}')
-    U = X_pertubate[obs.map_idx, :]
-    logging.debug(f'dim of U : {U.shape}')
+    X_f_extend = X_f_extend.reshape([Ne, Ns]).T
+
+    analysis = anl.Analysis(**Config['Assimilation'][assimilation_scheme],
+                            cache_dir=os.path.join(
+                                Config['Info']['path']['output_path'],
+                                'localization'))
+    logging.info('Analysis method : %s' % (analysis.analysis))
+
+    model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
+    model_lon_meshed = np.ravel(model_lon_meshed)
+    model_lat_meshed = np.ravel(model_lat_meshed)
 
+    L = None
     if Config['Assimilation'][assimilation_scheme]['use_localization']:
 
-        start_local = datetime.now()
         logging.info('Localization enabled, distance threshold : %s km' % (
             Config['Assimilation'][assimilation_scheme]['distance_threshold']))
 
-        model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
-        model_lon_meshed = np.ravel(model_lon_meshed)
-        model_lat_meshed = np.ravel(model_lat_meshed)
-
-        local = lol.Local_class(
-            model_lon_meshed,
-            model_lat_meshed,
-            model_lon_meshed[obs.map_idx],
-            model_lat_meshed[obs.map_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'],
-        )
-        L1 = local.calculate()  # dim : Ns * m
-        logging.debug((f'Dims of Localization 1 : {L1.shape}'))
-
-        local = lol.Local_class(
-            model_lon_meshed[obs.map_idx], model_lat_meshed[obs.map_idx],
-            model_lon_meshed[obs.map_idx], model_lat_meshed[obs.map_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'])
-        L2 = local.calculate()  # dim : m * m
-        logging.debug((f'Dims of Localization 2 : {L2.shape}'))
-
-        logging.debug('localization took %.2f s' %
-                      ((datetime.now() - start_local).total_seconds()))
-
-        K = (np.multiply(X_pertubate @ U.T, L1) /
-             (Ne - 1)) @ inv(np.multiply(U @ U.T, L2) / (Ne - 1) + R)
+        L = analysis.localization(
+            (model_lon_meshed, model_lat_meshed),
+            (model_lon_meshed[obs.map_idx], model_lat_meshed[obs.map_idx]))
 
-    else:
-        K = (X_pertubate @ U.T) / (Ne - 1) @ inv(U @ U.T / (Ne - 1) + R)
+    X_a, x_a_mean = analysis.update(
+        X_f_extend,
+        X_f_extend[obs.map_idx, :].reshape(-1, Ne),
+        obs.values,
+        obs.error,
+        local=L,
+        state_coord=(model_lon_meshed, model_lat_meshed),
+        obs_coord=(model_lon_meshed[obs.map_idx],
+                   model_lat_meshed[obs.map_idx]))
 
-    logging.info('Kalman Gain calculated')
+    logging.info('Posteriors calculated')
 
     ### *---------------------------------------------------* ###
-    ### *---  calculate poerteriors and write them back  ---* ###
+    ### *---    write the posteriors back to restart     ---* ###
 
     ### *--- convert to 3D and write back to restart file ---* ###
     if Config['Assimilation'][assimilation_scheme]['write_restart']:
@@ -270,7 +265,6 @@ def main(Config: dict, **kwargs):
             Config['Model'][model_scheme]['path']['model_output_path'],
             Config['Model'][model_scheme]['run_project'])
 
-        X_a = np.zeros([Ns, Ne])
         X_a_3d = np.zeros([Nspec, Nlev, Nlat, Nlon, Ne])
 
         for i_time in range(len(time_set)):
@@ -286,16 +280,6 @@ def main(Config: dict, **kwargs):
 
                 n_count = sum(ensemble_set[:i_time]) + i_ensem
 
-                y_i = obs.values + np.random.normal(
-                    loc=0, scale=obs.error, size=(obs.m, 1))
-
-                y_i = y_i.reshape([obs.m, 1])
-                x_f_i = X_f_extend[n_count].reshape([Ns, 1])
-
-                X_a[:,
-                    n_count] = (x_f_i +
-                                K @ (y_i - x_f_i[obs.map_idx, :])).reshape(-1)
-
                 X_a_3d[:, :, :, :,
                        n_count] = (X_a[:, n_count].reshape(-1) *
                                    dust_ratio_sfc2layers[i_time]).reshape(
@@ -312,9 +296,6 @@ def main(Config: dict, **kwargs):
     ### *---    Save the variables     ---* ###
     if Config['Assimilation']['post_process']['save_variables']:
 
-        x_f_mean = x_f_mean.reshape([Ns, 1])
-        x_a_mean = x_f_mean + K @ (obs.values - x_f_mean[obs.map_idx, :])
-
         x_a_3d = np.zeros([Nspec, Nlev, Ns])
         x_a_3d = x_a_mean.reshape(-1) * np.mean(dust_ratio_sfc2layers, axis=0)
 
@@ -336,6 +317,10 @@ def main(Config: dict, **kwargs):
         (datetime.now() - timer0).total_seconds()))
     stl.edit_json(path=status_path, new_dict={'assimilation': {'code': 100}})
 
+    ### *--- wait for the output files ---* ###
+    if Config['Assimilation']['post_process']['save_variables']:
+        var_output.join()
+
 
 if __name__ == '__main__':
 
@@ -10,7 +10,6 @@ import logging
 import numpy as np
 import multiprocessing as mp
 
-from numpy.linalg import inv
 from datetime import datetime
 
 main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -22,8 +21,71 @@ import LE_obs_lib as leol
 import LE_read_lib as lerl
 import LE_write_lib as lewl
 import LE_output_lib as leopl
-import Localization_lib as lol
 import Assimilation_lib as asl
+import Analysis_lib as anl
+import Operator_lib as opl
+import State_lib as sl
+
+
+### *--- calculate the posteriors of a batch of levels ---* ###
+def posterior_updater(levels: slice, analysis: anl.Analysis, states: dict,
+                      H: tuple, y: np.ndarray, obs_error: np.ndarray,
+                      local: tuple, state_coord: tuple,
+                      obs_idx: np.ndarray) -> None:
+    """
+    Worker of the multi-level analysis, the ensemble is read from and the
+    posterior is written to the shared states of dim : Nlev * Nlat * Nlon * Ne
+
+    params:
+        levels: the levels observed at the same locations.
+        H: operators of the dust and the aod observations, dim : m * Ns,
+           None for no dust observation.
+        y: observations, dim : L * m
+        obs_error: observational error, dim : L * m
+    """
+
+    start_cal = datetime.now()
+
+    # dim : L * Ns * Ne
+    X_f_dust = states['prior_dust'].level(levels, axis=0)
+    X_f_aod = states['prior_aod'].level(levels, axis=0)
+
+    ### *--- gather the ensemble in observation space ---* ###
+    # dim : L * m * Ne
+    HX_f = opl.apply(H[1], X_f_aod)
+    if not H[0] is None:
+        HX_f = np.concatenate((opl.apply(H[0], X_f_dust), HX_f), axis=-2)
+
+    ### *--- calculate the ensemble posteriors ---* ###
+    X_a, x_a = analysis.update_levels(X_f_dust,
+                                      HX_f,
+                                      y,
+                                      obs_error,
+                                      local=local,
+                                      state_coord=state_coord,
+                                      obs_coord=(state_coord[0][obs_idx],
+                                                 state_coord[1][obs_idx]))
+
+    states['posterior_dust'].level(levels, axis=0)[:] = X_a
+    states['posterior_dust_mean'].level(levels, axis=0)[:] = x_a
+
+    logging.debug('Posteriors on layers %s to %s finished, took %.2f s' %
+                  (levels.start, levels.stop - 1,
+                   (datetime.now() - start_cal).total_seconds()))
+
+
+### *--- the level batches on the worker processes ---* ###
+updater_args = {}
+
+
+def init_updater(args_list: list) -> None:
+    # inherited by the forked workers, the localization and the operators
+    # are not pickled with every task
+    updater_args.update(args_list=args_list)
+
+
+def update_batch(i_batch: int) -> None:
+    posterior_updater(*updater_args['args_list'][i_batch])
 
 
 def main(Config: dict, **kwargs):
@@ -78,7 +140,13 @@ def main(Config: dict, **kwargs):
         if not os.path.exists(save_variables_dir):
             os.makedirs(save_variables_dir)
 
-        var_output = leopl.Output(save_variables_dir, Config)
+        var_output = leopl.Output(save_variables_dir,
+                                  Config['Model'][model_scheme], **Config)
+        var_output.start(
+            max_queue=Config['Assimilation']['post_process'].get(
+                'output_queue', 4),
+            workers=Config['Assimilation']['post_process'].get(
+                'output_workers', 1))
 
     ####################################################
     ###                                              ###
@@ -86,62 +154,62 @@ def main(Config: dict, **kwargs):
     ###                                              ###
     ####################################################
 
-    ### initialize the variables ###
-    X_f_aod_full = np.zeros([Nlat, Nlon, Ne])  # aod priori matrix
-    X_f_dust_full = np.zeros([Nspec, Nlev, Nlat, Nlon,
-                              Ne])  # dust priori matrix
-
     ### *-------------------------------------------------* ###
     ### *--- Section 2 : retrive ensemble model priors ---* ###
     ### *-------------------------------------------------* ###
 
     ### *--- read the model results ---* ###
     mr = lerl.ModelReader(
-        Config['Model'][model_scheme]['path']['model_output_path'])
-
-    for i_ensem in range(Ne):
-        run_id = 'iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
-        X_f_aod_full[:, :, i_ensem] = mr.read_output(
-            Config['Model'][model_scheme]['run_project'], run_id, 'aod2',
-            assimilation_time, 'aod_550nm')
+        Config['Model'][model_scheme]['path']['model_output_path'],
+        Config['Model'][model_scheme]['run_project'])
+    run_ids = [
+        'iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
+        for i_ensem in range(Ne)
+    ]
+
+    # aod prior, dim : Nlat * Nlon * Ne
+    X_f_aod_full = np.moveaxis(
+        mr.read_ensemble(run_ids, 'aod2', assimilation_time, 'aod_550nm'), 0,
+        -1)
 
     logging.info('%s ensemble aod priors received.' % (Ne))
 
-    for i_ensem in range(Ne):
-        run_id = 'iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
-        X_f_dust_full[:, :, :, :, i_ensem] = mr.read_restart(
-            Config['Model'][model_scheme]['run_project'], run_id,
-            assimilation_time)
+    # dust prior in shared memory, dim : Nspec * Nlev * Nlat * Nlon * Ne
+    X_f_dust_full = sl.EnsembleState([Nspec, Nlev, Nlat, Nlon, Ne])
+    for i_ensem, run_id in enumerate(run_ids):
+        X_f_dust_full.member(i_ensem)[:] = mr.read_restart(
+            run_id, assimilation_time)
 
     logging.info('%s ensemble dust priors received.' % (Ne))
 
     ### *--- prepare the variables ---* ###
-    # ensemble dust
-    X_f_dust = np.sum(X_f_dust_full, axis=0).reshape(Nlev, Ns, Ne)
-    # mean of dust
-    x_f_dust_mean = np.mean(X_f_dust, axis=-1).reshape([Nlev, Ns, 1])
-
-    # dust ratio
-    dust_ratio = np.zeros([Nspec, Nlev, Nlat, Nlon])
-    X_f_dust_mean = np.mean(X_f_dust_full, axis=-1)
-    # dim : Nspec * Nlev * Nlat * Nlon
+    # ensemble dust, dim : Nlev * Nlat * Nlon * Ne
+    X_f_dust = sl.EnsembleState([Nlev, Nlat, Nlon, Ne])
+    np.sum(X_f_dust_full.array, axis=0, out=X_f_dust.array)
+    # mean of dust, dim : Nlev * Ns * 1
+    x_f_dust_mean = np.mean(X_f_dust.grid(), axis=-1, keepdims=True)
+
+    # dust ratio, dim : Nspec * Nlev * Nlat * Nlon
+    X_f_dust_mean = X_f_dust_full.mean(keepdims=False)
     dust_ratio = X_f_dust_mean / np.sum(
         X_f_dust_mean, axis=(0, 1), keepdims=True)
     dust_ratio[np.isnan(dust_ratio)] = 0
     # dust ratio in vertical, dim : Nlev * Ns
     dust_ratio_layers = np.sum(dust_ratio, axis=0).reshape([Nlev, Ns])
 
+    # the full prior is not used after here
+    X_f_dust_full.close()
+
     ### split the aod in the vertical dicrction ###
-    # aod prior, dim : Nlev, Ns, Ne
-    X_f_aod = np.zeros([Nlev, Ns, Ne])
-    for i_ensem in range(Ne):
-        X_f_aod[:, :,
-                i_ensem] = (X_f_aod_full[:, :, i_ensem].reshape([1, Ns]) *
-                            dust_ratio_layers)
-    X_f_aod[np.isnan(X_f_aod)] = 0
+    # aod prior, dim : Nlev * Nlat * Nlon * Ne
+    X_f_aod = sl.EnsembleState([Nlev, Nlat, Nlon, Ne])
+    np.multiply(X_f_aod_full[np.newaxis],
+                dust_ratio_layers.reshape([Nlev, Nlat, Nlon, 1]),
+                out=X_f_aod.array)
+    X_f_aod.array[np.isnan(X_f_aod.array)] = 0
 
     # mean of aod priori
-    x_f_aod_mean = np.mean(X_f_aod, axis=-1).reshape([Nlev, Ns, 1])
+    x_f_aod_mean = np.mean(X_f_aod.grid(), axis=-1, keepdims=True)
 
     ### *--- save the ensemble priori ---* ###
     if Config['Assimilation']['post_process']['save_variables']:
@@ -168,199 +236,116 @@ def main(Config: dict, **kwargs):
     ### *--- BC-PM10 observation data ---* ###
     obs.get_data('bc_pm10', assimilation_time,
                  **Config['Observation']['bc_pm10'])
-    obs.map2obs('nearest', model_lon, model_lat)
+    mapping_dir = os.path.join(Config['Info']['path']['output_path'],
+                               'mapping')
+    obs.map2obs('nearest', model_lon, model_lat, index_dir=mapping_dir)
     obs.get_error('fraction', threshold=200, factor=0.1)
+    obs.operator(model_lon,
+                 model_lat,
+                 index_dir=mapping_dir,
+                 **Config['Observation']['bc_pm10'].get('operator', {}))
+
+    # the lowest levels are analysed
+    Nlev_asml = Nlev - 3
 
     ### *--- MODIS DOD observation data ---* ###
     obs.get_data('modis_dod', assimilation_time,
                  **Config['Observation']['modis_dod'])
     obs.map2obs('nearest', model_lon, model_lat)
-    obs.get_error('fraction',
-                  threshold=0.1,
-                  factor=0.3,
-                  layering=dust_ratio_layers.reshape([Nlev, Ns]))
+    obs.get_error('fraction', threshold=0.1, factor=0.3)
+    if 'superob' in Config['Observation']['modis_dod']:
+        obs.superob(**Config['Observation']['modis_dod']['superob'])
+    obs.operator(model_lon, model_lat,
+                 **Config['Observation']['modis_dod'].get('operator', {}))
+    obs.layering(dust_ratio_layers, max_level=Nlev_asml)
 
     ### *--- VIIRS DOD observation data ---* ###
     obs.get_data('viirs_dod', assimilation_time,
                  **Config['Observation']['viirs_dod'])
     obs.map2obs('nearest', model_lon, model_lat)
-    obs.get_error('fraction',
-                  threshold=0.1,
-                  factor=0.3,
-                  layering=dust_ratio_layers.reshape([Nlev, Ns]))
+    obs.get_error('fraction', threshold=0.1, factor=0.3)
+    if 'superob' in Config['Observation']['viirs_dod']:
+        obs.superob(**Config['Observation']['viirs_dod']['superob'])
+    obs.operator(model_lon, model_lat,
+                 **Config['Observation']['viirs_dod'].get('operator', {}))
+    obs.layering(dust_ratio_layers, max_level=Nlev_asml)
 
     ### *------------------------------------------* ###
     ### *---  Section 4 : calculate Posteriors  ---* ###
     ### *------------------------------------------* ###
 
+    ### *--- initialize the analysis engine ---* ###
+    analysis = anl.Analysis(**Config['Assimilation'][assimilation_scheme],
+                            cache_dir=os.path.join(
+                                Config['Info']['path']['output_path'],
+                                'localization'))
+    logging.info('Analysis method : %s' % (analysis.analysis))
+
+    model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
+    model_lon_meshed, model_lat_meshed = np.ravel(model_lon_meshed), np.ravel(
+        model_lat_meshed)
+
+    # observations on the ground level and on the upper levels
+    map_idx_list = [
+        np.concatenate((obs.map_idx['bc_pm10'], obs.map_idx['modis_dod'],
+                        obs.map_idx['viirs_dod'])),
+        np.concatenate((obs.map_idx['modis_dod'], obs.map_idx['viirs_dod']))
+    ]
+
     ### *-- localization ---* ###
+    L = [None, None]
     if Config['Assimilation'][assimilation_scheme]['use_localization']:
 
-        start_local = datetime.now()
         logging.debug('Localization enabled, distance threshold : %s km' % (
             Config['Assimilation'][assimilation_scheme]['distance_threshold']))
-        L1 = []
-        L2 = []
-        # on the ground level
-        map_lon_idx, map_lat_idx = obs.gather_map_idx_seperate(
-            'bc_pm10', 'modis_dod', 'viirs_dod')
-        local = lol.Local_class(
-            model_lon,
-            model_lat,
-            model_lon[map_lon_idx],
-            model_lat[map_lat_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'],
-            meshgrid1=True)
-        L1.append(local.calculate())  # dim : Ns * m
-        logging.debug((f'Dims of Localization 1 : {L1[0].shape}'))
-
-        local = lol.Local_class(
-            model_lon[map_lon_idx], model_lat[map_lat_idx],
-            model_lon[map_lon_idx], model_lat[map_lat_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'])
-        L2.append(local.calculate())  # dim : m * m
-        logging.debug((f'Dims of Localization 2 : {L2[0].shape}'))
-
-        # on the upper levels
-        map_lon_idx, map_lat_idx = obs.gather_map_idx_seperate(
-            'modis_dod', 'viirs_dod')
-        local = lol.Local_class(
-            model_lon,
-            model_lat,
-            model_lon[map_lon_idx],
-            model_lat[map_lat_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'],
-            meshgrid1=True)
-        L1.append(local.calculate())  # dim : Ns * m
-        logging.debug((f'Dims of Localization 1 : {L1[1].shape}'))
-
-        local = lol.Local_class(
-            model_lon[map_lon_idx], model_lat[map_lat_idx],
-            model_lon[map_lon_idx], model_lat[map_lat_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'])
-        L2.append(local.calculate())  # dim : m * m
-        logging.debug((f'Dims of Localization 2 : {L2[1].shape}'))
-
-        logging.debug('Localization took %.2f s' %
-                      ((datetime.now() - start_local).total_seconds()))
-
-    # create a memory-shared variables to store results
-    shared_array = mp.Array('f', X_f_dust.size)
-    X_a_dust = np.frombuffer(shared_array.get_obj(),
-                             dtype=np.float32).reshape(X_f_dust.shape)
-
-    shared_array = mp.Array('f', x_f_dust_mean.size)
-    x_a_dust = np.frombuffer(shared_array.get_obj(),
-                             dtype=np.float32).reshape(x_f_dust_mean.shape)
-
-    # X_a_dust = np.zeros([Nlev, Ns, Ne])
-    # x_a_dust = np.zeros([Nlev, Ns, 1])
-
-    def posterior_updater(i_lev: int) -> None:
-
-        start_cal = datetime.now()
-
-        ### *--- gather the pertubation matrix ---* ###
-        X_dust_pertubate = X_f_dust[i_lev, :, :] - x_f_dust_mean[i_lev, :, :]
-        X_aod_pertubate = X_f_aod[i_lev, :, :] - x_f_aod_mean[i_lev, :, :]
-
-        # on ground level
-        if i_lev == 0:
-
-            ### *--- gather the U matrix ---* ###
-            # dim : m * N
-            U_dust = X_dust_pertubate[obs.map_idx['bc_pm10'], :]
-            U_modis = X_aod_pertubate[obs.map_idx['modis_dod'], :]
-            U_viirs = X_aod_pertubate[obs.map_idx['viirs_dod'], :]
-            U = np.concatenate((U_dust, U_modis, U_viirs), axis=0)
-
-            ### *--- gather the observations ---* ###
-            # dim : m * 1
-            value_dust = obs.values['bc_pm10'].reshape(-1, 1)
-            value_modis = obs.values['modis_dod'][:, i_lev].reshape(-1, 1)
-            value_viirs = obs.values['viirs_dod'][:, i_lev].reshape(-1, 1)
-            y = np.concatenate((value_dust, value_modis, value_viirs), axis=0)
-
-            ### *--- gather the obervational error ---* ###
-            # dim : m * 1
-            error_dust = obs.error['bc_pm10'].reshape(-1, 1)
-            error_modis = obs.error['modis_dod'][:, i_lev].reshape(-1, 1)
-            error_viirs = obs.error['viirs_dod'][:, i_lev].reshape(-1, 1)
-            obs_error = np.concatenate((error_dust, error_modis, error_viirs),
-                                       axis=0)
-
-            ### *--- gather the innovation ---* ###
-            # dim : m * Ne
-            innovation_ensemble = y - np.concatenate(
-                (X_f_dust[i_lev, obs.map_idx['bc_pm10'], :],
-                 X_f_aod[i_lev, obs.map_idx['modis_dod'], :],
-                 X_f_aod[i_lev, obs.map_idx['viirs_dod'], :]))
-            # dim : m * 1
-            innovation_mean = y - np.concatenate(
-                (x_f_dust_mean[i_lev, obs.map_idx['bc_pm10']],
-                 x_f_aod_mean[i_lev, obs.map_idx['modis_dod']],
-                 x_f_aod_mean[i_lev, obs.map_idx['viirs_dod']]))
-
-        # on upper level
-        else:
-
-            U_modis = X_aod_pertubate[obs.map_idx['modis_dod'], :]
-            U_viirs = X_aod_pertubate[obs.map_idx['viirs_dod'], :]
-            U = np.concatenate((U_modis, U_viirs), axis=0)
-
-            value_modis = obs.values['modis_dod'][:, i_lev].reshape(-1, 1)
-            value_viirs = obs.values['viirs_dod'][:, i_lev].reshape(-1, 1)
-            y = np.concatenate((value_modis, value_viirs), axis=0)
-
-            error_modis = obs.error['modis_dod'][:, i_lev].reshape(-1, 1)
-            error_viirs = obs.error['viirs_dod'][:, i_lev].reshape(-1, 1)
-            obs_error = np.concatenate((error_modis, error_viirs), axis=0)
-
-            innovation_ensemble = y - np.concatenate(
-                (X_f_aod[i_lev, obs.map_idx['modis_dod'], :],
-                 X_f_aod[i_lev, obs.map_idx['viirs_dod'], :]))
-
-            innovation_mean = y - np.concatenate(
-                (x_f_aod_mean[i_lev, obs.map_idx['modis_dod']],
-                 x_f_aod_mean[i_lev, obs.map_idx['viirs_dod']]))
-
-        ### *--- calculate the Kalman Gain ---* ###
-        if Config['Assimilation'][assimilation_scheme]['use_localization']:
-            if i_lev == 0:
-                K = L1[0] * (X_dust_pertubate @ U.T) / (Ne - 1) @ inv(
-                    L2[0] * (U @ U.T) /
-                    (Ne - 1) + np.diag((obs_error**2).reshape(-1)))
-            else:
-                K = L1[1] * (X_dust_pertubate @ U.T) / (Ne - 1) @ inv(
-                    L2[1] * (U @ U.T) /
-                    (Ne - 1) + np.diag((obs_error**2).reshape(-1)))
-        else:
-            K = (X_dust_pertubate @ U.T /
-                 (Ne - 1)) @ inv((U @ U.T) / (Ne - 1) +
-                                 np.diag((obs_error**2).reshape(-1)))
-
-        ### *--- calculate the ensemble posteriors ---* ###
-        epsilon = np.random.normal(loc=0,
-                                   scale=obs_error,
-                                   size=(len(obs_error), Ne))
-
-        X_a_dust[i_lev, :, :] = X_f_dust[
-            i_lev, :, :] + K @ (innovation_ensemble + epsilon)
-        x_a_dust[i_lev, :, :] = x_f_dust_mean[i_lev, :] + K @ innovation_mean
-
-        logging.debug('Posteriors on %sth layer finished, took %.2f s' %
-                      (i_lev, ((datetime.now() - start_cal).total_seconds())))
-
-    ### *--- enable multiprocessing to calcualate the ensemble posteriors ---* ###
-    with mp.Pool(processes=2) as pool:
-        args_list = np.arange(Nlev - 3)
-        results = pool.map_async(posterior_updater, args_list, chunksize=1)
-        results.wait()
-        pool.close()
-        pool.join()
-    # for i_lev in range(Nlev):
-    #     posterior_updater(i_lev)
 
+        for i_type, map_idx in enumerate(map_idx_list):
+            L[i_type] = analysis.localization(
+                (model_lon_meshed, model_lat_meshed),
+                (model_lon_meshed[map_idx], model_lat_meshed[map_idx]))
+
+    # posteriors are written in place by the workers
+    states = {
+        'prior_dust': X_f_dust,
+        'prior_aod': X_f_aod,
+        'posterior_dust': sl.EnsembleState([Nlev, Nlat, Nlon, Ne]),
+        'posterior_dust_mean': sl.EnsembleState([Nlev, Nlat, Nlon, 1]),
+    }
+
+    ### *--- the ground level and batches of the upper levels ---* ###
+    aod_types = ['modis_dod', 'viirs_dod']
+    H_aod = opl.stack(*[obs.H[obs_type] for obs_type in aod_types])
+    level_batch = Config['Assimilation'][assimilation_scheme].get(
+        'level_batch', 4)
+    level_workers = Config['Assimilation'][assimilation_scheme].get(
+        'level_workers', 0)
+
+    args_list = [(slice(0, 1), analysis, states, (obs.H['bc_pm10'], H_aod),
+                  np.column_stack((obs.values['bc_pm10'].reshape(1, -1),
+                                   obs.stack_levels(aod_types, [0], 'value'))),
+                  np.column_stack((obs.error['bc_pm10'].reshape(1, -1),
+                                   obs.stack_levels(aod_types, [0], 'error'))),
+                  L[0], (model_lon_meshed, model_lat_meshed), map_idx_list[0])]
+    for start in range(1, Nlev_asml, level_batch):
+        levels = range(start, min(start + level_batch, Nlev_asml))
+        args_list.append(
+            (slice(levels.start, levels.stop), analysis, states, (None, H_aod),
+             obs.stack_levels(aod_types, levels, 'value'),
+             obs.stack_levels(aod_types, levels, 'error'), L[1],
+             (model_lon_meshed, model_lat_meshed), map_idx_list[1]))
+
+    ### *--- in process (threaded BLAS) or on workers sharing states ---* ###
+    if level_workers > 0:
+        with mp.Pool(processes=level_workers,
+                     initializer=init_updater,
+                     initargs=(args_list, )) as pool:
+            pool.map(update_batch, range(len(args_list)), chunksize=1)
+    else:
+        for args in args_list:
+            posterior_updater(*args)
+
+    X_a_dust = states['posterior_dust'].array
+    x_a_dust = states['posterior_dust_mean'].array
     X_a_dust[np.logical_or(np.isnan(X_a_dust), X_a_dust <= 1e-9)] = 0
     x_a_dust[np.logical_or(np.isnan(x_a_dust), x_a_dust <= 1e-9)] = 0
     # for i_lev in range(Nlev - 3):
@@ -380,31 +365,42 @@ def main(Config: dict, **kwargs):
             Config['Model'][model_scheme]['path']['model_output_path'],
             Config['Model'][model_scheme]['run_project'])
 
-        for i_ensem in range(Ne):
-
-            run_id = 'iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
-            X_a_dust_write = X_a_dust[:, :, i_ensem].reshape(
-                [Nlev, Nlat, Nlon]) * dust_ratio
-            wr.write(X_a_dust_write, run_id, assimilation_time, 'c')
+        wr.write_ensemble(
+            states['posterior_dust'],
+            run_ids,
+            assimilation_time,
+            'c',
+            ratio=dust_ratio,
+            max_workers=Config['Assimilation'][assimilation_scheme].get(
+                'write_workers', 4))
 
         logging.info('Ensemble posteriors have been written.')
 
     ### *--- save the posterior ---* ###
     if Config['Assimilation']['post_process']['save_variables']:
 
-        x_a_dust_sfc = x_a_dust[0, :].reshape([Nlat, Nlon])
+        x_a_dust_sfc = x_a_dust[0, :, :, 0].copy()
         if Config['Model'][model_scheme]['run_type'] == 'ensemble':
 
             # save to netcdf format
             if Config['Assimilation']['post_process']['save_method'] == 'nc':
                 var_output.save('posterior_dust_sfc', x_a_dust_sfc)
 
+    ### *--- release the shared ensemble states ---* ###
+    X_a_dust, x_a_dust = None, None
+    for state in states.values():
+        state.close()
+
     ### *--------------------------------------* ###
     ### *--- tell main branch i am finished ---* ###
     logging.info('Assimilation finished, took %.2f s.' %
                  ((datetime.now() - timer0).total_seconds()))
     stl.edit_json(path=status_path, new_dict={'assimilation': {'code': 100}})
 
+    ### *--- wait for the output files ---* ###
+    if Config['Assimilation']['post_process']['save_variables']:
+        var_output.join()
+
 
 if __name__ == '__main__':
 
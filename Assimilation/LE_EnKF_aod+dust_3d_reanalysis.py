@@ -8,7 +8,6 @@ import os
 import sys
 import logging
 import numpy as np
-from numpy.linalg import inv
 from datetime import datetime
 
 main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -20,6 +19,7 @@ import LE_obs_lib as leol
 import LE_read_lib as lerl
 import LE_write_lib as lewl
 import LE_output_lib as leopl
+import Analysis_lib as anl
 
 
 def main(Config: dict, **kwargs):
@@ -78,6 +78,11 @@ def main(Config: dict, **kwargs):
 
         var_output = leopl.Output(save_variables_dir,
                                   Config['Model'][model_scheme], **Config)
+        var_output.start(
+            max_queue=Config['Assimilation']['post_process'].get(
+                'output_queue', 4),
+            workers=Config['Assimilation']['post_process'].get(
+                'output_workers', 1))
 
     ####################################################
     ###                                              ###
@@ -209,7 +214,11 @@ def main(Config: dict, **kwargs):
     ### *--- BC-PM10 observation data ---* ###
     obs.get_data('bc_pm10', assimilation_time,
                  **Config['Observation']['bc_pm10'])
-    obs.map2obs('nearest', model_lon=model_lon, model_lat=model_lat)
+    obs.map2obs('nearest',
+                model_lon=model_lon,
+                model_lat=model_lat,
+                index_dir=os.path.join(Config['Info']['path']['output_path'],
+                                       'mapping'))
     obs.get_error('fraction', threshold=200, factor=0.1)
     obs.local_filter(local_bools[0, :])
     logging.debug('%s BC_PM10 in model space.' % (obs.values['bc_pm10'].size))
@@ -217,23 +226,13 @@ def main(Config: dict, **kwargs):
     ### *--- MODIS DOD observation data ---* ###
     obs.get_data('modis_dod', assimilation_time,
                  **Config['Observation']['modis_dod'])
-    obs.map2obs('nearest',
-                model_lon=model_lon,
-                model_lat=model_lat,
-                repeat=Nlev)
+    obs.map2obs('nearest', model_lon=model_lon, model_lat=model_lat)
     obs.get_error('fraction', threshold=0.1, factor=0.3)
-    obs.layering(dust_ratio_layers)
+    if 'superob' in Config['Observation']['modis_dod']:
+        obs.superob(**Config['Observation']['modis_dod']['superob'])
+    # only the lowest 8 levels are assimilated
+    obs.layering(dust_ratio_layers, max_level=8)
     obs.local_filter(local_bools)
-
-    if not obs.m['modis_dod'] == 0:
-        for i_lev in range(Nlev - 8):
-            obs.map_idx['modis_dod'][i_lev + 8] = np.empty(0, dtype=int)
-            obs.values['modis_dod'][i_lev + 8] = np.empty(0)
-            obs.error['modis_dod'][i_lev + 8] = np.empty(0)
-    # for i_lev in range(Nlev):
-    #     logging.info('%s %s' % (np.mean(obs.values['modis_dod'][i_lev]),
-    #                                np.mean(obs.error['modis_dod'][i_lev])))
-
     obs.reduce_dim(Ns, Nlev)
     logging.debug('%s MODIS DOD in model space.' %
                   (obs.values['modis_dod'].size))
@@ -241,20 +240,13 @@ def main(Config: dict, **kwargs):
     ### *--- VIIRS DOD observation data ---* ###
     obs.get_data('viirs_dod', assimilation_time,
                  **Config['Observation']['viirs_dod'])
-    obs.map2obs('nearest',
-                model_lon=model_lon,
-                model_lat=model_lat,
-                repeat=Nlev)
+    obs.map2obs('nearest', model_lon=model_lon, model_lat=model_lat)
     obs.get_error('fraction', threshold=0.1, factor=0.3)
-    obs.layering(dust_ratio_layers)
+    if 'superob' in Config['Observation']['viirs_dod']:
+        obs.superob(**Config['Observation']['viirs_dod']['superob'])
+    # only the lowest 8 levels are assimilated
+    obs.layering(dust_ratio_layers, max_level=8)
     obs.local_filter(local_bools)
-
-    if not obs.m['viirs_dod'] == 0:
-        for i_lev in range(Nlev - 8):
-            obs.map_idx['viirs_dod'][i_lev + 8] = np.empty(0, dtype=int)
-            obs.values['viirs_dod'][i_lev + 8] = np.empty(0)
-            obs.error['viirs_dod'][i_lev + 8] = np.empty(0)
-
     obs.reduce_dim(Ns, Nlev)
     logging.debug('%s VIIRS DOD in model space.' %
                   (obs.values['viirs_dod'].size))
@@ -265,19 +257,15 @@ def main(Config: dict, **kwargs):
 
     start_cal = datetime.now()
 
-    ### *--- gather the pertubation matrix ---* ###
-    # dim : n * N
-    X_dust_pertubate = (X_f_dust - x_f_dust_mean).reshape([Nlev * Ns, Ne])
-    X_aod_pertubate = (X_f_aod - x_f_aod_mean).reshape([Nlev * Ns, Ne])
-    X_dust_pertubate_local = X_f_dust_local - x_f_dust_local
-    X_aod_pertubate_local = X_f_aod_local - x_f_aod_local
-
-    ### *--- gather the U matrix ---* ###
+    ### *--- gather the ensemble in observation space ---* ###
     # dim : m * N
-    U_dust = X_dust_pertubate[obs.map_idx['bc_pm10'], :].reshape(-1, Ne)
-    U_modis = X_aod_pertubate[obs.map_idx['modis_dod'], :].reshape(-1, Ne)
-    U_viirs = X_aod_pertubate[obs.map_idx['viirs_dod'], :].reshape(-1, Ne)
-    U = np.concatenate((U_dust, U_modis, U_viirs), axis=0)
+    X_f_dust_flat = X_f_dust.reshape([Nlev * Ns, Ne])
+    X_f_aod_flat = X_f_aod.reshape([Nlev * Ns, Ne])
+    HX_f = np.concatenate(
+        (X_f_dust_flat[obs.map_idx['bc_pm10'], :].reshape(-1, Ne),
+         X_f_aod_flat[obs.map_idx['modis_dod'], :].reshape(-1, Ne),
+         X_f_aod_flat[obs.map_idx['viirs_dod'], :].reshape(-1, Ne)),
+        axis=0)
 
     ### *--- gather the observations ---* ###
     # dim : m * 1
@@ -293,28 +281,28 @@ def main(Config: dict, **kwargs):
     error_viirs = obs.error['viirs_dod'].reshape(-1, 1)
     obs_error = np.concatenate((error_dust, error_modis, error_viirs), axis=0)
 
-    ### *--- gather the innovation ---* ###
-    # dim : m * 1
-    x_f_dust_mean_tmp = x_f_dust_mean.reshape([Nlev * Ns, 1])
-    x_f_aod_mean_tmp = x_f_aod_mean.reshape([Nlev * Ns, 1])
-    innovation_mean = y - np.concatenate(
-        (x_f_dust_mean_tmp[obs.map_idx['bc_pm10']],
-         x_f_aod_mean_tmp[obs.map_idx['modis_dod']],
-         x_f_aod_mean_tmp[obs.map_idx['viirs_dod']]))
-
-    ### *--- calculate the Kalman Gain and Posterior ---* ###
-    K = (X_dust_pertubate_local @ U.T /
-         (Ne - 1)) @ inv((U @ U.T) /
-                         (Ne - 1) + np.diag((obs_error**2).reshape(-1)))
-
-    x_a_dust_local = x_f_dust_local + K @ innovation_mean
+    ### *--- calculate the posterior of the local states ---* ###
+    analysis = anl.Analysis(**Config['Assimilation'][assimilation_scheme])
+    logging.info('Analysis method : %s' % (analysis.analysis))
+
+    obs_idx = np.concatenate(
+        (obs.map_idx['bc_pm10'], obs.map_idx['modis_dod'],
+         obs.map_idx['viirs_dod'])).reshape(-1)
+    X_a_dust_local, x_a_dust_local = analysis.update(
+        X_f_dust_local,
+        HX_f,
+        y,
+        obs_error,
+        state_coord=(lon_space_local, lat_space_local),
+        obs_coord=(lon_space.reshape(-1)[obs_idx],
+                   lat_space.reshape(-1)[obs_idx]))
 
     logging.info('Posteriors calculation finished, took %.2f s' %
                  ((datetime.now() - start_cal).total_seconds()))
 
     ### *--- restore the dust full structure ---* ###
     x_a_dust = np.zeros(x_f_dust_mean.shape)
-    x_a_dust[local_bools] = x_a_dust_local
+    x_a_dust[local_bools] = x_a_dust_local.reshape(-1)
     x_a_dust[np.logical_or(np.isnan(x_a_dust), x_a_dust <= 1e-9)] = 0
     logging.info('Mean of posterior : %s and Mean of prior : %s' %
                  (np.mean(x_a_dust), np.mean(x_f_dust_mean)))
@@ -338,6 +326,10 @@ def main(Config: dict, **kwargs):
                  ((datetime.now() - timer0).total_seconds()))
     stl.edit_json(path=status_path, new_dict={'assimilation': {'code': 100}})
 
+    ### *--- wait for the output files ---* ###
+    if Config['Assimilation']['post_process']['save_variables']:
+        var_output.join()
+
 
 if __name__ == '__main__':
 
@@ -10,9 +10,7 @@ Target : Dust
 import os
 import sys
 import logging
-import threading
 import numpy as np
-from numpy.linalg import inv
 import multiprocessing as mp
 from datetime import datetime
 
@@ -24,7 +22,8 @@ import system_lib as stl
 import LE_obs_lib as leol
 import LE_read_lib as lerl
 import LE_output_lib as leopl
-import Localization_lib as lol
+import Analysis_lib as anl
+import Operator_lib as opl
 
 from post_asml.LE_plot_lib import PlotAssimilation
 
@@ -86,6 +85,11 @@ def main(Config: dict, **kwargs):
 
         var_output = leopl.Output(save_variables_dir,
                                   Config['Model'][model_scheme], **Config)
+        var_output.start(
+            max_queue=Config['Assimilation']['post_process'].get(
+                'output_queue', 4),
+            workers=Config['Assimilation']['post_process'].get(
+                'output_workers', 1))
 
     if Config['Assimilation']['post_process']['plot_results']:
         pa = PlotAssimilation(Config, Status)
@@ -96,12 +100,6 @@ def main(Config: dict, **kwargs):
     ###                                            ###
     ### *----------------------------------------* ###
 
-    ### *--- initialize the variables ---* ###
-    # aod prior array
-    X_f_aod_read = np.zeros([Nlat, Nlon, Ne])
-    # dust prior array
-    X_f_dust_read = np.zeros([Nspec, Nlev, Nlat, Nlon, Ne])
-
     ### *--- read the model results ---* ###
     mr = lerl.ModelReader(
         Config['Model'][model_scheme]['path']['model_output_path'],
@@ -140,56 +138,30 @@ def main(Config: dict, **kwargs):
     #             output_dir=model_output_dir,
     #             factor=1e9)
 
-    ### *--- parallel read by multi-threads ---* ###
-    def read_model_output(run_id: str,
-                          i_ensem: int,
-                          X_f_read: np.ndarray,
-                          data_type: str,
-                          model_output_dir: str = None):
-        if data_type == 'aod':
-            X_f_read[:, :,
-                     i_ensem] = mr.read_output(run_id,
-                                               'aod2',
-                                               assimilation_time,
-                                               'aod_550nm',
-                                               output_dir=model_output_dir)
-        elif data_type == 'dust':
-            for i_spec, spec in enumerate(dust_specs):
-                X_f_read[i_spec, :, :, :,
-                         i_ensem] = mr.read_output(run_id,
-                                                   'conc-3d',
-                                                   assimilation_time,
-                                                   spec,
-                                                   output_dir=model_output_dir,
-                                                   factor=1e9)
-
-    def create_and_start_thread(target, args):
-        thread = threading.Thread(target=target, args=args)
-        thread.start()
-        return thread
-
-    threads = []
-    for i_ensem in range(Ne):
-        run_id = 'iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
-        model_output_dir = os.path.join(
-            Config['Info']['path']['output_path'],
-            Config['Model'][model_scheme]['run_project'], 'model_run', run_id,
-            'output')
-
-        # Thread for AOD
-        threads.append(
-            create_and_start_thread(
-                read_model_output,
-                (run_id, i_ensem, X_f_aod_read, 'aod', model_output_dir)))
-
-        # Thread for Dust
-        threads.append(
-            create_and_start_thread(
-                read_model_output,
-                (run_id, i_ensem, X_f_dust_read, 'dust', model_output_dir)))
-
-    for thread in threads:
-        thread.join()
+    ### *--- parallel read, every output file is opened once ---* ###
+    run_ids = ['iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
+               for i_ensem in range(Ne)]
+    model_output_dirs = [
+        os.path.join(Config['Info']['path']['output_path'],
+                     Config['Model'][model_scheme]['run_project'], 'model_run',
+                     run_id, 'output') for run_id in run_ids
+    ]
+
+    # dim : Ne * Nlat * Nlon -> Nlat * Nlon * Ne
+    X_f_aod_read = np.moveaxis(
+        mr.read_ensemble(run_ids,
+                         'aod2',
+                         assimilation_time,
+                         'aod_550nm',
+                         output_dirs=model_output_dirs), 0, -1)
+    # dim : Ne * Nspec * Nlev * Nlat * Nlon -> Nspec * Nlev * Nlat * Nlon * Ne
+    X_f_dust_read = np.moveaxis(
+        mr.read_ensemble(run_ids,
+                         'conc-3d',
+                         assimilation_time,
+                         dust_specs,
+                         output_dirs=model_output_dirs,
+                         factor=1e9), 0, -1)
 
     logging.info('%s ensemble aod priors received.' % (Ne))
     logging.info('%s ensemble dust priors received.' % (Ne))
@@ -221,25 +193,19 @@ def main(Config: dict, **kwargs):
     # aod prior, dim : Ns * Ne
     X_f_aod = X_f_aod_read.reshape([Ns, Ne])
     X_f_aod[np.isnan(X_f_aod)] = 0
-    x_f_aod_mean = np.mean(X_f_aod, axis=-1).reshape([Ns, 1])
 
     ### *--- save the ensemble prior ---* ###
     if Config['Assimilation']['post_process']['save_variables']:
 
         # save to netCDF format
-        pool.apply_async(var_output.save,
-                         args=('prior_aod', np.mean(X_f_aod_read, axis=-1)))
-        # pool.apply_async(var_output.save,
-        #                  args=('prior_dust_3d',
-        #                        x_f_dust_mean.reshape([Nlev, Nlat, Nlon])),
-        #                  kwds={'altitude': alt})
-        pool.apply_async(var_output.save,
-                         args=('prior_dust', np.mean(X_f_dust_read, axis=-1)),
-                         kwds={
-                             'altitude': alt,
-                             'std': np.std(np.sum(X_f_dust_read, axis=0),
-                                           axis=-1)
-                         })
+        var_output.save('prior_aod', np.mean(X_f_aod_read, axis=-1))
+        # var_output.save('prior_dust_3d',
+        #                 x_f_dust_mean.reshape([Nlev, Nlat, Nlon]),
+        #                 altitude=alt)
+        var_output.save('prior_dust',
+                        np.mean(X_f_dust_read, axis=-1),
+                        altitude=alt,
+                        std=np.std(np.sum(X_f_dust_read, axis=0), axis=-1))
 
     ### *---------------------------------------------------* ###
     ### *---        Section 3 : read observations        ---* ###
@@ -251,8 +217,17 @@ def main(Config: dict, **kwargs):
     obs1 = leol.Observation(Config['Observation']['path'], 'bc_pm10',
                             Config['Observation']['bc_pm10'])
     obs1.get_data(assimilation_time)
-    obs1.map2obs('nearest', model_lon=model_lon, model_lat=model_lat)
+    mapping_dir = os.path.join(Config['Info']['path']['output_path'],
+                               'mapping')
+    obs1.map2obs('nearest',
+                 model_lon=model_lon,
+                 model_lat=model_lat,
+                 index_dir=mapping_dir)
     obs1.get_error('fraction', threshold=200, factor=0.1)
+    obs1.operator(model_lon,
+                  model_lat,
+                  index_dir=mapping_dir,
+                  **Config['Observation']['bc_pm10'].get('operator', {}))
     obs_dict['bc_pm10'] = obs1
 
     ### *--- MODIS DOD observation data ---* ###
@@ -261,6 +236,8 @@ def main(Config: dict, **kwargs):
     obs2.get_data(assimilation_time)
     obs2.map2obs('nearest', model_lon=model_lon, model_lat=model_lat)
     obs2.get_error('fraction', threshold=0.1, factor=0.3)
+    obs2.operator(model_lon, model_lat,
+                  **Config['Observation']['modis_dod'].get('operator', {}))
     obs_dict['modis_dod'] = obs2
 
     ### *--- VIIRS DOD observation data ---* ###
@@ -269,6 +246,8 @@ def main(Config: dict, **kwargs):
     obs3.get_data(assimilation_time)
     obs3.map2obs('nearest', model_lon=model_lon, model_lat=model_lat)
     obs3.get_error('fraction', threshold=0.1, factor=0.3)
+    obs3.operator(model_lon, model_lat,
+                  **Config['Observation']['viirs_dod'].get('operator', {}))
     obs_dict['viirs_dod'] = obs3
 
     # plot the observations
@@ -292,98 +271,48 @@ def main(Config: dict, **kwargs):
     ### *---  Section 4 : calculate Posteriors  ---* ###
     ### *------------------------------------------* ###
 
+    ### *--- initialize the analysis engine ---* ###
+    analysis = anl.Analysis(**Config['Assimilation'][assimilation_scheme],
+                            cache_dir=os.path.join(
+                                Config['Info']['path']['output_path'],
+                                'localization'))
+    logging.info('Analysis method : %s' % (analysis.analysis))
+
+    model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
+    model_lon_meshed, model_lat_meshed = np.ravel(model_lon_meshed), np.ravel(
+        model_lat_meshed)
+    aod_map_idx = np.concatenate(
+        (obs_dict['modis_dod'].map_idx, obs_dict['viirs_dod'].map_idx))
+
     ### *-- localization ---* ###
+    L_dict = {'type1': None, 'type2': None}  # ground and AOD
     if Config['Assimilation'][assimilation_scheme].get('use_localization',
-                                                       False):
+                                                        False):
 
-        start_local = datetime.now()
         logging.info('Localization enabled, distance threshold : %s km' % (
             Config['Assimilation'][assimilation_scheme]['distance_threshold']))
 
-        model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
-        model_lon_meshed, model_lat_meshed = np.ravel(
-            model_lon_meshed), np.ravel(model_lat_meshed)
-
-        L_dict = {'type1': [], 'type2': []}  # ground and AOD
-
-        ### *--- for the ground observations ---* ###
-        local = lol.Localization(
-            model_lon_meshed,
-            model_lat_meshed,
-            model_lon_meshed[obs_dict['bc_pm10'].map_idx],
-            model_lat_meshed[obs_dict['bc_pm10'].map_idx],
-        )
-        local.cal_distance()
-        Correlation = local.cal_correlation(
-            distance_threshold=Config['Assimilation'][assimilation_scheme]
-            ['distance_threshold'])
-        L_dict['type1'].append(Correlation)  # dim : Ns * m
-
-        local = lol.Localization(model_lon_meshed[obs_dict['bc_pm10'].map_idx],
-                                 model_lat_meshed[obs_dict['bc_pm10'].map_idx],
-                                 model_lon_meshed[obs_dict['bc_pm10'].map_idx],
-                                 model_lat_meshed[obs_dict['bc_pm10'].map_idx])
-        local.cal_distance()
-        Correlation = local.cal_correlation(
-            distance_threshold=Config['Assimilation'][assimilation_scheme]
-            ['distance_threshold'])
-        L_dict['type1'].append(Correlation)  # dim : m * m
-
-        logging.debug(
-            f'Dims of Localization type 1 : {L_dict["type1"][0].shape} and {L_dict["type1"][1].shape}'
-        )
-
-        ### *--- for the AOD observations ---* ###
-        local = lol.Localization(
-            model_lon_meshed, model_lat_meshed,
-            np.concatenate((model_lon_meshed[obs_dict['modis_dod'].map_idx],
-                            model_lon_meshed[obs_dict['viirs_dod'].map_idx])),
-            np.concatenate((model_lat_meshed[obs_dict['modis_dod'].map_idx],
-                            model_lat_meshed[obs_dict['viirs_dod'].map_idx])))
-        local.cal_distance()
-        Correlation = local.cal_correlation(
-            distance_threshold=Config['Assimilation'][assimilation_scheme]
-            ['distance_threshold'])
-        L_dict['type2'].append(Correlation)  # dim : Ns * m
-
-        local = lol.Localization(
-            np.concatenate((model_lon_meshed[obs_dict['modis_dod'].map_idx],
-                            model_lon_meshed[obs_dict['viirs_dod'].map_idx])),
-            np.concatenate((model_lat_meshed[obs_dict['modis_dod'].map_idx],
-                            model_lat_meshed[obs_dict['viirs_dod'].map_idx])),
-            np.concatenate((model_lon_meshed[obs_dict['modis_dod'].map_idx],
-                            model_lon_meshed[obs_dict['viirs_dod'].map_idx])),
-            np.concatenate((model_lat_meshed[obs_dict['modis_dod'].map_idx],
-                            model_lat_meshed[obs_dict['viirs_dod'].map_idx])))
-        local.cal_distance()
-        Correlation = local.cal_correlation(
-            distance_threshold=Config['Assimilation'][assimilation_scheme]
-            ['distance_threshold'])
-        L_dict['type2'].append(Correlation)  # dim : m * m
-        logging.debug(
-            f'Dims of Localization type 2 : {L_dict["type2"][0].shape} and {L_dict["type2"][1].shape}'
-        )
-        logging.info('Localization took %.2f s' %
-                     ((datetime.now() - start_local).total_seconds()))
+        L_dict['type1'] = analysis.localization(
+            (model_lon_meshed, model_lat_meshed),
+            (model_lon_meshed[obs_dict['bc_pm10'].map_idx],
+             model_lat_meshed[obs_dict['bc_pm10'].map_idx]))
+        L_dict['type2'] = analysis.localization(
+            (model_lon_meshed, model_lat_meshed),
+            (model_lon_meshed[aod_map_idx], model_lat_meshed[aod_map_idx]))
 
     start_cal = datetime.now()
 
     ### *------------------------------------* ###
     ### *---   Assimilate the AOD first   ---* ###
 
-    ### *--- gather the pertubation matrix ---* ###
+    ### *--- gather the prior ---* ###
     # dim : n * N
-    X_aod_pertubate = (X_f_aod - x_f_aod_mean).reshape([Ns, Ne])
     X_f_dust_all_layers = np.sum(X_f_dust, axis=0)
-    x_f_dust_mean_all_layers = np.sum(x_f_dust_mean, axis=0)
-    X_dust_pertubate_all_layers = (X_f_dust_all_layers -
-                                   x_f_dust_mean_all_layers).reshape([Ns, Ne])
 
-    ### *--- gather the U matrix ---* ###
+    ### *--- gather the ensemble in observation space ---* ###
     # dim : m * N
-    U_modis = X_aod_pertubate[obs_dict['modis_dod'].map_idx, :].reshape(-1, Ne)
-    U_viirs = X_aod_pertubate[obs_dict['viirs_dod'].map_idx, :].reshape(-1, Ne)
-    U = np.concatenate((U_modis, U_viirs), axis=0)
+    HX_f = opl.apply(
+        opl.stack(obs_dict['modis_dod'].H, obs_dict['viirs_dod'].H), X_f_aod)
 
     ### *--- gather the observations ---* ###
     # dim : m * 1
@@ -397,33 +326,16 @@ def main(Config: dict, **kwargs):
     error_viirs = obs_dict['viirs_dod'].error.reshape(-1, 1)
     obs_error = np.concatenate((error_modis, error_viirs), axis=0)
 
-    ### *--- gather the innovation ---* ###
-    # dim : m * 1
-    innovation_ensemble = y - np.concatenate(
-        (X_f_aod[obs_dict['modis_dod'].map_idx, :],
-         X_f_aod[obs_dict['viirs_dod'].map_idx, :]))
-    innovation_mean = y - np.concatenate(
-        (x_f_aod_mean[obs_dict['modis_dod'].map_idx],
-         x_f_aod_mean[obs_dict['viirs_dod'].map_idx]))
-
-    ### *--- calculate the Kalman Gain and Posterior ---* ###
-    R = np.diag((obs_error**2).reshape(-1))
-    if Config['Assimilation'][assimilation_scheme].get('use_localization',
-                                                       False):
-        K = L_dict['type2'][0] * (X_dust_pertubate_all_layers @ U.T) / (
-            Ne - 1) @ inv(L_dict['type2'][1] * (U @ U.T) / (Ne - 1) + R)
-    else:
-        K = (X_dust_pertubate_all_layers @ U.T / (Ne - 1)) @ inv((U @ U.T) /
-                                                                 (Ne - 1) + R)
-
-    epsilon = np.random.normal(loc=0,
-                               scale=obs_error,
-                               size=(len(obs_error), Ne))
-
-    X_a_dust_all_layers = (X_f_dust_all_layers +
-                           K @ (innovation_ensemble + epsilon)).astype(float)
-    x_a_dust_all_layers = (x_f_dust_mean_all_layers +
-                           K @ innovation_mean).astype(float)
+    ### *--- calculate the Posterior ---* ###
+    X_a_dust_all_layers, x_a_dust_all_layers = analysis.update(
+        X_f_dust_all_layers,
+        HX_f,
+        y,
+        obs_error,
+        local=L_dict['type2'],
+        state_coord=(model_lon_meshed, model_lat_meshed),
+        obs_coord=(model_lon_meshed[aod_map_idx],
+                   model_lat_meshed[aod_map_idx]))
 
     # transform this posterior into the prior
     # for the next ground observation assimilation
@@ -441,41 +353,28 @@ def main(Config: dict, **kwargs):
     x_f_dust_sfc = x_f_dust[0, :].reshape([Ns, 1])
     X_f_dust_sfc = X_f_dust[0, :, :].reshape([Ns, Ne])
 
-    ### *--- gather the pertubation matrix ---* ###
-    # dim : n * N
-    X_dust_sfc_pertubate = (X_f_dust_sfc - x_f_dust_sfc).reshape([Ns, Ne])
-
-    ### *--- gather the U matrix ---* ###
+    ### *--- gather the ensemble in observation space ---* ###
     # dim : m * N
-    U_dust = X_dust_sfc_pertubate[obs_dict['bc_pm10'].map_idx, :].reshape(
-        -1, Ne)
-    U = U_dust
+    HX_f = opl.apply(obs_dict['bc_pm10'].H, X_f_dust_sfc)
 
     ### *--- gather the observations ---* ###
     # dim : m * 1
-    value_dust = obs_dict['bc_pm10'].values.reshape(-1, 1)
-    y = value_dust
+    y = obs_dict['bc_pm10'].values.reshape(-1, 1)
 
     ### *--- gather the obervational error ---* ###
     # dim : m * 1
-    error_dust = obs_dict['bc_pm10'].error.reshape(-1, 1)
-    obs_error = error_dust
-
-    ### *--- gather the innovation ---* ###
-    # dim : m * 1
-    innovation_mean = y - x_f_dust_sfc[obs_dict['bc_pm10'].map_idx]
-
-    ### *--- calculate the Kalman Gain and Posterior ---* ###
-    R = np.diag((obs_error**2).reshape(-1))
-    if Config['Assimilation'][assimilation_scheme].get('use_localization',
-                                                       False):
-        K = L_dict['type1'][0] * (X_dust_sfc_pertubate @ U.T) / (
-            Ne - 1) @ inv(L_dict['type1'][1] * (U @ U.T) / (Ne - 1) + R)
-    else:
-        K = (X_dust_sfc_pertubate @ U.T / (Ne - 1)) @ inv((U @ U.T) /
-                                                          (Ne - 1) + R)
-
-    x_a_dust_sfc = (x_f_dust_sfc + K @ innovation_mean).astype(float)
+    obs_error = obs_dict['bc_pm10'].error.reshape(-1, 1)
+
+    ### *--- calculate the Posterior ---* ###
+    _, x_a_dust_sfc = analysis.update(
+        X_f_dust_sfc,
+        HX_f,
+        y,
+        obs_error,
+        local=L_dict['type1'],
+        state_coord=(model_lon_meshed, model_lat_meshed),
+        obs_coord=(model_lon_meshed[obs_dict['bc_pm10'].map_idx],
+                   model_lat_meshed[obs_dict['bc_pm10'].map_idx]))
 
     logging.info('Posteriors calculation finished, took %.2f s' %
                  ((datetime.now() - start_cal).total_seconds()))
@@ -494,12 +393,10 @@ def main(Config: dict, **kwargs):
     if Config['Assimilation']['post_process']['save_variables']:
 
         # save to netCDF format
-        # pool.apply_async(var_output.save,
-        #                  args=('posterior_dust_3d', np.sum(x_a_dust, axis=0)),
-        #                  kwds={'altitude': alt})
-        pool.apply_async(var_output.save,
-                         args=('posterior_dust', x_a_dust),
-                         kwds={'altitude': alt})
+        # var_output.save('posterior_dust_3d',
+        #                 np.sum(x_a_dust, axis=0),
+        #                 altitude=alt)
+        var_output.save('posterior_dust', x_a_dust, altitude=alt)
 
     ### *--------------------------------------* ###
     ### *--- tell main branch i am finished ---* ###
@@ -520,6 +417,10 @@ def main(Config: dict, **kwargs):
                          ['Posterior', 'posterior'],
                      ),
                      kwds={'obs_data': obs_dict['bc_pm10'].data})
+
+    ### *--- wait for the output files ---* ###
+    if Config['Assimilation']['post_process']['save_variables']:
+        var_output.join()
     pool.close()
     pool.join()
 
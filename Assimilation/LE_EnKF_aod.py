@@ -11,7 +11,6 @@ import os
 import sys
 import logging
 import numpy as np
-from numpy.linalg import inv
 from datetime import datetime
 
 main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -23,8 +22,9 @@ import LE_obs_lib as leol
 import LE_read_lib as lerl
 import LE_write_lib as lewl
 import LE_output_lib as leopl
-import Localization_lib as lol
 import Assimilation_lib as asl
+import Analysis_lib as anl
+import Operator_lib as opl
 
 home_dir = os.getcwd()
 
@@ -79,7 +79,13 @@ def main(Config: dict, **kwargs):
         if not os.path.exists(save_variables_dir):
             os.makedirs(save_variables_dir)
 
-        var_output = leopl.Output(output_dir=save_variables_dir, Config=Config)
+        var_output = leopl.Output(save_variables_dir,
+                                  Config['Model'][model_scheme], **Config)
+        var_output.start(
+            max_queue=Config['Assimilation']['post_process'].get(
+                'output_queue', 4),
+            workers=Config['Assimilation']['post_process'].get(
+                'output_workers', 1))
 
     ####################################################
     ###                                              ###
@@ -134,50 +140,46 @@ def main(Config: dict, **kwargs):
     obs.get_data(assimilation_time)
     obs.map2obs('nearest', model_lon, model_lat)
     obs.get_error('fraction', threshold=0.1, factor=0.3)
+    obs.operator(model_lon, model_lat,
+                 **Config['Observation']['modis_dod'].get('operator', {}))
 
     logging.info('%s observations received from %s.' % (obs.m, 'modis'))
 
     ##################################################
-    ###     Section 4 : calculate Kalman Gain      ###
+    ###     Section 4 : calculate the posteriors     ###
 
-    X_pertubate = X_f_aod - x_f_aod_mean.reshape([Ns, 1])
-    U = obs.H @ X_pertubate
+    analysis = anl.Analysis(**Config['Assimilation'][assimilation_scheme],
+                            cache_dir=os.path.join(
+                                Config['Info']['path']['output_path'],
+                                'localization'))
+    logging.info('Analysis method : %s' % (analysis.analysis))
+
+    model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
+    model_lon_meshed = np.ravel(model_lon_meshed)
+    model_lat_meshed = np.ravel(model_lat_meshed)
 
     ### Localization ###
+    L = None
     if Config['Assimilation'][assimilation_scheme]['use_localization']:
 
-        start_local = datetime.now()
         logging.debug('Localization enabled, distance threshold : %s km' % (
             Config['Assimilation'][assimilation_scheme]['distance_threshold']))
 
-        local = lol.Local_class(
-            model_lon,
-            model_lat,
-            model_lon[obs.map_lon_idx],
-            model_lat[obs.map_lat_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'],
-            meshgrid1=True)
-        L1 = local.calculate()  # dim : Ns * m
-        logging.debug((f'Dims of Localization 1 : {L1.shape}'))
-
-        local = lol.Local_class(
-            model_lon[obs.map_lon_idx], model_lat[obs.map_lat_idx],
-            model_lon[obs.map_lon_idx], model_lat[obs.map_lat_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'])
-        L2 = local.calculate()  # dim : m * m
-        logging.debug((f'Dims of Localization 2 : {L2.shape}'))
-
-        logging.debug('localization took %.2f s.' %
-                      ((datetime.now() - start_local).total_seconds()))
-
-        K = (np.multiply(X_pertubate @ U.T, L1) /
-             (Ne - 1)) @ inv(np.multiply(U @ U.T, L2) / (Ne - 1) + obs.O)
+        L = analysis.localization(
+            (model_lon_meshed, model_lat_meshed),
+            (model_lon_meshed[obs.map_idx], model_lat_meshed[obs.map_idx]))
 
-    else:
+    X_a_aod, x_a_aod_mean = analysis.update(
+        X_f_aod,
+        opl.apply(obs.H, X_f_aod),
+        obs.values,
+        obs.error,
+        local=L,
+        state_coord=(model_lon_meshed, model_lat_meshed),
+        obs_coord=(model_lon_meshed[obs.map_idx],
+                   model_lat_meshed[obs.map_idx]))
 
-        K = (X_pertubate @ U.T / (Ne - 1)) @ inv((U @ U.T) / (Ne - 1) + obs.O)
-
-    logging.info('Kalman Gain calculated.')
+    logging.info('Posteriors calculated.')
 
     ################################################
     ###     Section 5: update the posteriors     ###
@@ -217,11 +219,6 @@ def main(Config: dict, **kwargs):
     ###     Section 6 : save the variables     ###
     if Config['Assimilation']['post_process']['save_variables']:
 
-        x_a_aod_mean = asl.calculate_posteriori(
-            x_f=x_f_aod_mean.reshape([Ns, 1]),
-            K=K,
-            y=obs.values.reshape([obs.m, 1]),
-            H=obs.H)
         # x_a_dust_mean = (x_a_aod_mean / x_f_aod_mean) * x_f_dust_mean
 
         if Config['Model'][model_scheme]['run_type'] == 'ensemble':
@@ -245,6 +242,10 @@ def main(Config: dict, **kwargs):
                  ((datetime.now() - timer0).total_seconds()))
     stl.edit_json(path=status_path, new_dict={'assimilation': {'code': 100}})
 
+    ### *--- wait for the output files ---* ###
+    if Config['Assimilation']['post_process']['save_variables']:
+        var_output.join()
+
 
 if __name__ == '__main__':
 
@@ -10,9 +10,7 @@ Target : Dust
 import os
 import sys
 import logging
-import threading
 import numpy as np
-from numpy.linalg import inv
 import multiprocessing as mp
 from datetime import datetime
 
@@ -25,7 +23,7 @@ import LE_obs_lib as leol
 import LE_read_lib as lerl
 import LE_write_lib as lewl
 import LE_output_lib as leopl
-import Localization_lib as lol
+import Analysis_lib as anl
 
 from post_asml.LE_plot_lib import PlotAssimilation
 
@@ -54,7 +52,6 @@ def main(Config: dict, **kwargs):
     ### initialize the parameters ###
     Ne = Config['Model'][model_scheme][
         'ensemble_number']  # total number of ensembles
-    Nspec = Config['Model'][model_scheme]['nspec']  # number of states
     Nlev = Config['Model'][model_scheme]['nlevel']  # number of vertical layers
     Nlon = Config['Model'][model_scheme]['nlon']  # number of longitude grids
     Nlat = Config['Model'][model_scheme]['nlat']  # number of latitude grids
@@ -86,6 +83,11 @@ def main(Config: dict, **kwargs):
 
         var_output = leopl.Output(save_variables_dir,
                                   Config['Model'][model_scheme], **Config)
+        var_output.start(
+            max_queue=Config['Assimilation']['post_process'].get(
+                'output_queue', 4),
+            workers=Config['Assimilation']['post_process'].get(
+                'output_workers', 1))
 
     if Config['Assimilation']['post_process']['plot_results']:
         pa = PlotAssimilation(Config, Status)
@@ -96,12 +98,6 @@ def main(Config: dict, **kwargs):
     ###                                            ###
     ### *----------------------------------------* ###
 
-    ### *--- initialize the variables ---* ###
-    # aod prior matrix
-    X_f_aod_read = np.zeros([Nlat, Nlon, Ne])
-    # dust prior matrix
-    X_f_dust_read = np.zeros([Nspec, Nlev, Nlat, Nlon, Ne])
-
     ### *-----------------------------------------------------* ###
     ### *---   Section 2 : retrive ensemble model priors   ---* ###
     mr = lerl.ModelReader(
@@ -119,54 +115,28 @@ def main(Config: dict, **kwargs):
     #         Config['Model'][model_scheme]['run_project'], run_id,
     #         assimilation_time)
 
-    ### *--- parallel read by multi-threads ---* ###
-    def read_model_output(run_id: str,
-                          i_ensem: int,
-                          X_f_read: np.ndarray,
-                          data_type: str,
-                          data_dir: str = None):
-        if data_type == 'aod':
-            X_f_read[:, :, i_ensem] = mr.read_output(run_id,
-                                                     'aod2',
-                                                     assimilation_time,
-                                                     'aod_550nm',
-                                                     output_dir=data_dir)
-        elif data_type == 'dust':
-            for i_spec, spec in enumerate(dust_specs):
-                X_f_read[i_spec, :, :, :,
-                         i_ensem] = mr.read_output(run_id,
-                                                   'conc-3d',
-                                                   assimilation_time,
-                                                   spec,
-                                                   output_dir=data_dir,
-                                                   factor=1e9)
-
-    def create_and_start_thread(target, args):
-        thread = threading.Thread(target=target, args=args)
-        thread.start()
-        return thread
-
-    threads = []
-    for i_ensem in range(Ne):
-        run_id = 'iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
-        data_dir = os.path.join(Config['Info']['path']['output_path'],
-                                Config['Model'][model_scheme]['run_project'],
-                                'model_run', run_id, 'output')
-
-        # Thread for AOD
-        threads.append(
-            create_and_start_thread(
-                read_model_output,
-                (run_id, i_ensem, X_f_aod_read, 'aod', data_dir)))
-
-        # Thread for Dust
-        threads.append(
-            create_and_start_thread(
-                read_model_output,
-                (run_id, i_ensem, X_f_dust_read, 'dust', data_dir)))
-
-    for thread in threads:
-        thread.join()
+    ### *--- parallel read, every output file is opened once ---* ###
+    run_ids = ['iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
+               for i_ensem in range(Ne)]
+    data_dirs = [
+        os.path.join(Config['Info']['path']['output_path'],
+                     Config['Model'][model_scheme]['run_project'], 'model_run',
+                     run_id, 'output') for run_id in run_ids
+    ]
+
+    X_f_aod_read = np.moveaxis(
+        mr.read_ensemble(run_ids,
+                         'aod2',
+                         assimilation_time,
+                         'aod_550nm',
+                         output_dirs=data_dirs), 0, -1)
+    X_f_dust_read = np.moveaxis(
+        mr.read_ensemble(run_ids,
+                         'conc-3d',
+                         assimilation_time,
+                         dust_specs,
+                         output_dirs=data_dirs,
+                         factor=1e9), 0, -1)
 
     logging.info('%s ensemble priors received.' % (Ne))
 
@@ -174,12 +144,8 @@ def main(Config: dict, **kwargs):
                           axis=0)[0, :].reshape([Ns, 1])
     # ensemble column dust
     X_f_dust = np.sum(X_f_dust_read, axis=(0, 1)).reshape(Ns, Ne)
-    # mean of column dust
-    x_f_dust_mean = np.mean(X_f_dust, axis=-1).reshape([Ns, 1])
     # ensemble aod
     X_f_aod = X_f_aod_read.reshape([Ns, Ne])
-    # mean of aod prior
-    x_f_aod_mean = np.mean(X_f_aod_read, axis=-1).reshape([Ns, 1])
 
     # dust ratio in vertical, dim : Nlev * Ns
     x_f_dust_all_layers = np.sum(np.mean(X_f_dust_read, axis=-1), axis=0)
@@ -194,12 +160,9 @@ def main(Config: dict, **kwargs):
     if Config['Assimilation']['post_process']['save_variables']:
 
         # save to netCDF format
-        pool.apply_async(var_output.save,
-                         args=('prior_aod', np.mean(X_f_aod_read, axis=-1)))
-        pool.apply_async(var_output.save,
-                         args=('prior_dust_3d',
-                               np.sum(np.mean(X_f_dust_read, axis=-1),
-                                      axis=0)))
+        var_output.save('prior_aod', np.mean(X_f_aod_read, axis=-1))
+        var_output.save('prior_dust_3d',
+                        np.sum(np.mean(X_f_dust_read, axis=-1), axis=0))
 
     ### *-----------------------------------------* ###
     ### *---   Section 3 : read observations   ---* ###
@@ -216,57 +179,43 @@ def main(Config: dict, **kwargs):
     obs.map2obs('nearest', model_lon=model_lon, model_lat=model_lat)
     obs.get_error('fraction', threshold=0.1, factor=0.3)
 
-    ### *---------------------------------------------* ###
-    ### *---   Section 4 : calculate Kalman Gain   ---* ###
+    ### *----------------------------------------------* ###
+    ### *---   Section 4 : calculate the posteriors   ---* ###
+
+    analysis = anl.Analysis(**Config['Assimilation'][assimilation_scheme],
+                            cache_dir=os.path.join(
+                                Config['Info']['path']['output_path'],
+                                'localization'))
+    logging.info('Analysis method : %s' % (analysis.analysis))
+
+    model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
+    model_lon_meshed, model_lat_meshed = np.ravel(
+        model_lon_meshed), np.ravel(model_lat_meshed)
 
     ### *--- Localization ---* ###
+    L = None
     if Config['Assimilation'][assimilation_scheme]['use_localization']:
 
-        start_local = datetime.now()
         logging.info('Localization enabled, distance threshold : %s km' % (
             Config['Assimilation'][assimilation_scheme]['distance_threshold']))
 
-        model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
-        model_lon_meshed, model_lat_meshed = np.ravel(
-            model_lon_meshed), np.ravel(model_lat_meshed)
-
-        local = lol.Localization(model_lon_meshed, model_lat_meshed,
-                                 model_lon_meshed[obs.map_idx],
-                                 model_lat_meshed[obs.map_idx])
-        local.cal_distance()
-
-        L1 = local.cal_correlation(**Config['Assimilation']
-                                   [assimilation_scheme])  # dim : Ns * m
-        logging.debug((f'Dims of Localization 1 : {L1.shape}'))
-
-        local = lol.Localization(model_lon_meshed[obs.map_idx],
-                                 model_lat_meshed[obs.map_idx],
-                                 model_lon_meshed[obs.map_idx],
-                                 model_lat_meshed[obs.map_idx])
-        local.cal_distance()
-        L2 = local.cal_correlation(**Config['Assimilation']
-                                   [assimilation_scheme])  # dim : m * m
-        logging.debug((f'Dims of Localization 2 : {L2.shape}'))
-
-        logging.info('localization took %.2f s.' %
-                     ((datetime.now() - start_local).total_seconds()))
+        L = analysis.localization(
+            (model_lon_meshed, model_lat_meshed),
+            (model_lon_meshed[obs.map_idx], model_lat_meshed[obs.map_idx]))
 
     ### *--- Calculate the posterior ---* ###
-    X_aod_pertubate = (X_f_aod - x_f_aod_mean).reshape([Ns, Ne])
-    X_dust_pertubate = (X_f_dust - x_f_dust_mean).reshape([Ns, Ne])
-    R = np.diag((obs.error**2).reshape(-1))
-    U = X_aod_pertubate[obs.map_idx, :].reshape(-1, Ne)
-
-    if Config['Assimilation'][assimilation_scheme]['use_localization']:
-
-        K = (np.multiply(X_dust_pertubate @ U.T, L1) /
-             (Ne - 1)) @ inv(np.multiply(U @ U.T, L2) / (Ne - 1) + R)
-
-    else:
-
-        K = (X_dust_pertubate @ U.T / (Ne - 1)) @ inv((U @ U.T) / (Ne - 1) + R)
-
-    logging.info('Kalman Gain calculated.')
+    # the column dust is updated by the aod at the observation points
+    X_a_dust, x_a_dust_mean = analysis.update(
+        X_f_dust,
+        X_f_aod[obs.map_idx, :].reshape(-1, Ne),
+        obs.values,
+        obs.error,
+        local=L,
+        state_coord=(model_lon_meshed, model_lat_meshed),
+        obs_coord=(model_lon_meshed[obs.map_idx],
+                   model_lat_meshed[obs.map_idx]))
+
+    logging.info('Posteriors calculated.')
 
     ### *--------------------------------------------* ###
     ### *---   Section 5: update the posteriors   ---* ###
@@ -300,8 +249,6 @@ def main(Config: dict, **kwargs):
 
     ### *------------------------------------------* ###
     ### *---   Section 6 : save the variables   ---* ###
-    x_a_dust_mean = x_f_dust_mean + K @ (obs.values -
-                                         x_f_aod_mean[obs.map_idx])
     x_a_dust = x_a_dust_mean.reshape(-1) * dust_ratio_layers
     logging.info(
         f'Mean of prior : {np.mean(x_f_dust_sfc):.2f} and Mean of posterior : {np.mean(x_a_dust[0]):.2f}'
@@ -309,7 +256,7 @@ def main(Config: dict, **kwargs):
 
     if Config['Assimilation']['post_process']['save_variables']:
         # save to netCDF format
-        pool.apply_async(var_output.save, args=('posterior_dust_3d', x_a_dust))
+        var_output.save('posterior_dust_3d', x_a_dust)
 
     ### *------------------------------------------* ###
     ### *---   tell main branch i am finished   ---* ###
@@ -337,6 +284,10 @@ def main(Config: dict, **kwargs):
                              x_a_dust[0, :].reshape([Nlat, Nlon]),
                              ['Posterior', 'posterior'],
                          ))
+
+    ### *--- wait for the output files ---* ###
+    if Config['Assimilation']['post_process']['save_variables']:
+        var_output.join()
     pool.close()
     pool.join()
 
@@ -11,7 +11,6 @@ import os
 import sys
 import logging
 import numpy as np
-from numpy.linalg import inv
 from datetime import datetime
 
 main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -23,8 +22,9 @@ import LE_obs_lib as leol
 import LE_read_lib as lerl
 import LE_write_lib as lewl
 import LE_output_lib as leopl
-import Localization_lib as lol
 import Assimilation_lib as asl
+import Analysis_lib as anl
+import Operator_lib as opl
 
 
 def main(Config: dict, **kwargs):
@@ -79,6 +79,11 @@ def main(Config: dict, **kwargs):
 
         var_output = leopl.Output(save_variables_dir,
                                   Config['Model'][model_scheme], **Config)
+        var_output.start(
+            max_queue=Config['Assimilation']['post_process'].get(
+                'output_queue', 4),
+            workers=Config['Assimilation']['post_process'].get(
+                'output_workers', 1))
 
     logging.debug('working directory : %s' % (home_dir))
 
@@ -146,96 +151,82 @@ def main(Config: dict, **kwargs):
     obs = leol.Observation(Config['Observation']['path'], 'bc_pm10',
                            Config['Observation']['bc_pm10'])
     obs.get_data(assimilation_time)
-    obs.map2obs('nearest', model_lon=model_lon, model_lat=model_lat)
+    mapping_dir = os.path.join(Config['Info']['path']['output_path'],
+                               'mapping')
+    obs.map2obs('nearest',
+                model_lon=model_lon,
+                model_lat=model_lat,
+                index_dir=mapping_dir)
     obs.get_error('fraction', threshold=200, factor=0.1)
+    obs.operator(model_lon,
+                 model_lat,
+                 index_dir=mapping_dir,
+                 **Config['Observation']['bc_pm10'].get('operator', {}))
 
-    R = np.diag((obs.error**2).reshape(-1))
+    ### *------------------------------------------* ###
+    ### *--- Section 4 : calculate the posteriors ---* ###
 
-    ### *-----------------------------------------* ###
-    ### *--- Section 4 : calculate Kalman Gain ---* ###
+    analysis = anl.Analysis(**Config['Assimilation'][assimilation_scheme],
+                            cache_dir=os.path.join(
+                                Config['Info']['path']['output_path'],
+                                'localization'))
+    logging.info('Analysis method : %s' % (analysis.analysis))
 
-    X_pertubate = X_f - x_f_mean
-    U = X_pertubate[obs.map_idx, :]
-    logging.debug(f'shape of U : {U.shape}')
+    model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
+    model_lon_meshed = np.ravel(model_lon_meshed)
+    model_lat_meshed = np.ravel(model_lat_meshed)
 
     ### *--- Localization ---* ###
+    L = None
     if Config['Assimilation'][assimilation_scheme]['use_localization']:
 
-        start_local = datetime.now()
         logging.info('Localization enabled, distance threshold : %s km' % (
             Config['Assimilation'][assimilation_scheme]['distance_threshold']))
 
-        model_lon_meshed, model_lat_meshed = np.meshgrid(model_lon, model_lat)
-        model_lon_meshed = np.ravel(model_lon_meshed)
-        model_lat_meshed = np.ravel(model_lat_meshed)
-
-        local = lol.Local_class(
-            model_lon_meshed, model_lat_meshed, model_lon_meshed[obs.map_idx],
-            model_lat_meshed[obs.map_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'])
-        L1 = local.calculate()  # dim : Ns * m
-        logging.debug((f'Dims of Localization 1 : {L1.shape}'))
-
-        local = lol.Local_class(
-            model_lon_meshed[obs.map_idx], model_lat_meshed[obs.map_idx],
-            model_lon_meshed[obs.map_idx], model_lat_meshed[obs.map_idx],
-            Config['Assimilation'][assimilation_scheme]['distance_threshold'])
-        L2 = local.calculate()  # dim : m * m
-        logging.debug((f'Dims of Localization 2 : {L2.shape}'))
-
-        logging.info('localization took %.2f s' %
-                     ((datetime.now() - start_local).total_seconds()))
+        L = analysis.localization(
+            (model_lon_meshed, model_lat_meshed),
+            (model_lon_meshed[obs.map_idx], model_lat_meshed[obs.map_idx]))
 
-        K = L1 * (X_pertubate @ U.T) / (Ne - 1) @ inv(L2 * (U @ U.T) /
-                                                      (Ne - 1) + R)
+    X_a, x_a_mean = analysis.update(
+        X_f,
+        opl.apply(obs.H, X_f),
+        obs.values,
+        obs.error,
+        local=L,
+        state_coord=(model_lon_meshed, model_lat_meshed),
+        obs_coord=(model_lon_meshed[obs.map_idx],
+                   model_lat_meshed[obs.map_idx]))
 
-    else:
-
-        K = (X_pertubate @ U.T / (Ne - 1)) @ inv((U @ U.T) / (Ne - 1) + R)
-
-    logging.info('Kalman Gain calculated')
+    logging.info('Posteriors calculated')
 
     ### *----------------------------------------* ###
     ### *--- Section 5: update the posteriors ---* ###
 
     if Config['Model'][model_scheme]['run_type'] == 'ensemble':
 
-        ### *--- calculate the posterior ---* ###
-        X_a = np.zeros([Ns, Ne])
-        X_a_3d = np.zeros([Nspec, Nlev, Nlat, Nlon, Ne])
-
         wr = lewl.WriteRestart(
             Config['Model'][model_scheme]['path']['model_output_path'],
             Config['Model'][model_scheme]['run_project'])
 
-        for i_ensem in range(Ne):
-
-            run_id = 'iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
-
-            y_i = obs.values + np.random.normal(
-                loc=0, scale=obs.error, size=(obs.m, 1))
-
-            y_i = y_i.reshape([obs.m, 1])
-            x_f_i = X_f[:, i_ensem].reshape([Ns, 1])
-
-            X_a[:, i_ensem] = (x_f_i +
-                               K @ (y_i - x_f_i[obs.map_idx, :])).reshape(-1)
-
-            X_a_3d[:, :, :, :, i_ensem] = (X_a[:, i_ensem].reshape(-1) *
-                                           dust_ratio_sfc2layers).reshape(
-                                               [Nspec, Nlev, Nlat, Nlon])
-
-            ### *--- write back to the Model restart files ---* ###
-            if Config['Assimilation'][assimilation_scheme]['write_restart']:
-
-                wr.write(X_a_3d[:, :, :, :, i_ensem], run_id,
-                         assimilation_time, 'c')
+        ### *--- write back to the Model restart files ---* ###
+        if Config['Assimilation'][assimilation_scheme]['write_restart']:
+
+            wr.write_ensemble(
+                X_a.reshape([Nlat, Nlon, Ne]),
+                [
+                    'iter_%02d_ensem_%02d' % (iteration_num, i_ensem)
+                    for i_ensem in range(Ne)
+                ],
+                assimilation_time,
+                'c',
+                ratio=dust_ratio_sfc2layers.reshape([Nspec, Nlev, Nlat, Nlon]),
+                max_workers=Config['Assimilation'][assimilation_scheme].get(
+                    'write_workers', 4))
 
     ### *--------------------------------------* ###
     ### *--- Section 6 : save the variables ---* ###
     if Config['Assimilation']['post_process']['save_variables']:
 
-        x_a_mean = (x_f_mean + K @ (obs.values - x_f_mean[obs.map_idx, :]))
         x_a_mean = x_a_mean.reshape([Nlat, Nlon])
 
         x_a_3d = x_a_mean.reshape(-1) * dust_ratio_sfc2layers
@@ -261,6 +252,10 @@ def main(Config: dict, **kwargs):
                  ((datetime.now() - timer0).total_seconds()))
     stl.edit_json(path=status_path, new_dict={'assimilation': {'code': 100}})
 
+    ### *--- wait for the output files ---* ###
+    if Config['Assimilation']['post_process']['save_variables']:
+        var_output.join()
+
 
 if __name__ == '__main__':
 
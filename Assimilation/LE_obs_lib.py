@@ -6,6 +6,7 @@ Description:
 '''
 import os
 import sys
+import hashlib
 import logging
 import numpy as np
 import pandas as pd
@@ -15,6 +16,8 @@ from datetime import datetime
 main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(main_dir)
 from tool.mapper import find_nearest_vector
+from tool.obs_store import read_obs
+from Operator_lib import ObservationOperator, bilinear_weights
 
 
 ### *--- Some useful functions ---* ###
@@ -22,12 +25,11 @@ from tool.mapper import find_nearest_vector
 def check_bound(data: pd.DataFrame, bound1: List[float],
                 bound2: List[float]) -> pd.DataFrame:
 
-    data = data.drop(data[(data.iloc[:, 0] < bound1[0])
-                          | (data.iloc[:, 0] > bound1[1])].index)
-    data = data.drop(data[(data.iloc[:, 1] < bound2[0])
-                          | (data.iloc[:, 1] > bound2[1])].index)
+    lon, lat = data.iloc[:, 0].values, data.iloc[:, 1].values
+    outside = (lon < bound1[0]) | (lon > bound1[1]) | (lat < bound2[0]) | (
+        lat > bound2[1])
 
-    return data
+    return data[~outside]
 
 
 ### *------------------------------* ###
@@ -56,7 +58,9 @@ def bc_pm10(time: None, obs_dir: str, dir_name: str, **kwargs) -> pd.DataFrame:
         return None
 
     try:
-        df = pd.read_csv(obs_path)
+        # longitude, latitude and the bias corrected PM10
+        df = read_obs(obs_path, [0, 1, 2],
+                      store_dir=kwargs.get('store_dir'))
     except Exception as e:
         ValueError(f"Error reading the CSV file: {e}")
         return None
@@ -97,15 +101,15 @@ def modis_dod(time: datetime, obs_dir: str, dir_name: str, *args,
         FileNotFoundError(f"No such file -> \"{obs_path}\"")
         return None
 
+    relevant_columns = ['Longitude', 'Latitude', 'DOD_550_DB_DT']
     try:
-        df = pd.read_csv(obs_path)
+        df = read_obs(obs_path,
+                      relevant_columns,
+                      store_dir=kwargs.get('store_dir'))
     except Exception as e:
         ValueError(f"Error reading CSV file: {e}")
         return None
 
-    relevant_columns = ['Longitude', 'Latitude', 'DOD_550_DB_DT']
-    df = df[relevant_columns]
-
     df = df[df['DOD_550_DB_DT'] > 1e-3]
 
     if kwargs.get('check_bound', False):
@@ -145,11 +149,11 @@ def viirs_dod(time: None, obs_dir: str, dir_name: str, *args,
         FileNotFoundError(f"No such file -> '{obs_path}'")
         return None
 
-    # Load the csv file into a DataFrame
-    df = pd.read_csv(obs_path)
+    # Load only the relevant columns of the csv file
+    df = read_obs(obs_path, ['Longitude', 'Latitude', 'DOD_550_Land_Ocean'],
+                  store_dir=kwargs.get('store_dir'))
 
-    # Filter DataFrame to include only relevant columns and values above a threshold
-    df = df[['Longitude', 'Latitude', 'DOD_550_Land_Ocean']]
+    # Filter values above a threshold
     df = df[df['DOD_550_Land_Ocean'] > 1e-3]
 
     if kwargs.get('check_bound', False):
@@ -187,7 +191,8 @@ def himawari_8_dod(time: str, obs_dir: str, dir_name: str, *args,
         FileNotFoundError(f"No such file -> '{obs_path}'")
         return None
 
-    df = pd.read_csv(obs_path)
+    df = read_obs(obs_path, ['lon', 'lat', 'DOD', 'AE'],
+                  store_dir=kwargs.get('store_dir'))
 
     # 筛选条件
     is_valid = df['AE'] <= 1
@@ -208,7 +213,11 @@ def himawari_8_dod(time: str, obs_dir: str, dir_name: str, *args,
 
 
 ### *--- the nearest search method ---* ###
-def nearest_search(data: pd.DataFrame, *args, **kwargs) -> np.ndarray:
+def nearest_search(data: pd.DataFrame,
+                   model_lon: np.ndarray,
+                   model_lat: np.ndarray,
+                   index_dir=None,
+                   **kwargs) -> np.ndarray:
     """
     find the nearest match and return an array of mapping indices.
     
@@ -216,19 +225,21 @@ def nearest_search(data: pd.DataFrame, *args, **kwargs) -> np.ndarray:
         data: including longitude and latitude information at the first two columns.
         model_lon: model longitude.
         model_lat: model latitude.
+        index_dir: directory of the persisted MappingIndex, designed for
+                   the fixed station networks. None to search every time.
         
     return:
         a numpy array of mapping indices.
     """
 
-    # get the model longitude and latitude
-    model_lon = kwargs['model_lon']
-    model_lat = kwargs['model_lat']
-
     # vectorize the calculation
     obs_lon = data.iloc[:, 0].values
     obs_lat = data.iloc[:, 1].values
 
+    if not index_dir is None:
+        return get_mapping_index(model_lon, model_lat,
+                                 index_dir).nearest(obs_lon, obs_lat)
+
     map_lon_idx = find_nearest_vector(obs_lon, model_lon)
     map_lat_idx = find_nearest_vector(obs_lat, model_lat)
 
@@ -237,9 +248,266 @@ def nearest_search(data: pd.DataFrame, *args, **kwargs) -> np.ndarray:
     return map_idx
 
 
-### merge all the surrounding points to grid ###
-def merge_surrounding():
-    raise NotImplementedError('merge surrounding data not implemented yet')
+### *--- positions of the stations on one model grid ---* ###
+class MappingIndex:
+
+    def __init__(self,
+                 model_lon: np.ndarray,
+                 model_lat: np.ndarray,
+                 index_dir=None,
+                 precision=1e-4) -> None:
+        """
+        The nearest grid cell and the bilinear weights of every coordinate
+        seen are kept, so the known stations are mapped by a gather, only
+        the new coordinates are searched.
+
+        params:
+            model_lon: model longitude.
+            model_lat: model latitude.
+            index_dir: directory to persist the index, one file per grid.
+            precision: coordinates closer than it (degree) are one station.
+        """
+
+        self.model_lon = np.asarray(model_lon, dtype=float)
+        self.model_lat = np.asarray(model_lat, dtype=float)
+        self.precision = precision
+
+        self.path = None
+        if not index_dir is None:
+            os.makedirs(index_dir, exist_ok=True)
+            self.path = os.path.join(
+                index_dir, 'mapping_%s.npz' %
+                (grid_key(self.model_lon, self.model_lat, precision)))
+
+        self.keys = np.empty(0, dtype=np.int64)
+        self.nearest_idx = np.empty(0, dtype=int)
+        self.corners = np.empty([0, 4], dtype=int)
+        self.weights = np.empty([0, 4])
+
+        self.load()
+
+    ### *--- mapping of the coordinates ---* ###
+    def nearest(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """
+        return:
+            flat index of the nearest grid cell, dim : m
+        """
+        # the lookup may extend the index
+        position = self.lookup(lon, lat)
+
+        return self.nearest_idx[position]
+
+    def bilinear(self, lon: np.ndarray, lat: np.ndarray) -> tuple:
+        """
+        return:
+            flat index of the 4 surrounding grid cells and their bilinear
+            weights, dim : m * 4
+        """
+
+        position = self.lookup(lon, lat)
+
+        return self.corners[position], self.weights[position]
+
+    def lookup(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+
+        lon = np.asarray(lon, dtype=float).reshape(-1)
+        lat = np.asarray(lat, dtype=float).reshape(-1)
+        keys = self.coord_key(lon, lat)
+
+        position = np.searchsorted(self.keys, keys)
+        found = position < len(self.keys)
+        found[found] = self.keys[position[found]] == keys[found]
+
+        if not np.all(found):
+            new_keys, first = np.unique(keys[~found], return_index=True)
+            self.add(new_keys, lon[~found][first], lat[~found][first])
+            position = np.searchsorted(self.keys, keys)
+
+        return position
+
+    def coord_key(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+
+        lon_key = np.round(lon / self.precision).astype(np.int64)
+        lat_key = np.round((lat + 90) / self.precision).astype(np.int64)
+
+        return lon_key * 10**8 + lat_key
+
+    ### *--- search the new coordinates ---* ###
+    def add(self, keys: np.ndarray, lon: np.ndarray, lat: np.ndarray) -> None:
+
+        nearest_idx = find_nearest_vector(lat, self.model_lat) * \
+            len(self.model_lon) + find_nearest_vector(lon, self.model_lon)
+        corners, weights = bilinear_weights(lon, lat, self.model_lon,
+                                            self.model_lat)
+
+        self.merge(keys, nearest_idx, corners, weights)
+
+        logging.debug('%s new coordinates added to the mapping index' %
+                      (len(keys)))
+
+        self.save()
+
+    def merge(self, keys: np.ndarray, nearest_idx: np.ndarray,
+              corners: np.ndarray, weights: np.ndarray) -> None:
+
+        keys = np.concatenate((self.keys, keys))
+        keys, unique = np.unique(keys, return_index=True)
+
+        self.keys = keys
+        self.nearest_idx = np.concatenate(
+            (self.nearest_idx, nearest_idx))[unique]
+        self.corners = np.concatenate((self.corners, corners))[unique]
+        self.weights = np.concatenate((self.weights, weights))[unique]
+
+    ### *--- persist the index ---* ###
+    def load(self) -> None:
+
+        if self.path is None or not os.path.exists(self.path):
+            return
+
+        try:
+            with np.load(self.path) as file:
+                self.merge(file['keys'], file['nearest_idx'], file['corners'],
+                           file['weights'])
+        except (OSError, ValueError, KeyError) as error:
+            logging.warning('Mapping index %s unreadable : %s' %
+                            (self.path, error))
+
+    def save(self) -> None:
+
+        if self.path is None:
+            return
+
+        # another process may have extended the index in the meantime
+        self.load()
+
+        tmp_path = '%s.tmp%s' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as file:
+            np.savez(file,
+                     keys=self.keys,
+                     nearest_idx=self.nearest_idx,
+                     corners=self.corners,
+                     weights=self.weights)
+        os.replace(tmp_path, self.path)
+
+
+def grid_key(model_lon: np.ndarray, model_lat: np.ndarray,
+             precision: float) -> str:
+
+    sha = hashlib.sha1()
+    for array in (model_lon, model_lat):
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        sha.update(str(array.shape).encode())
+        sha.update(array.tobytes())
+    sha.update(repr(precision).encode())
+
+    return sha.hexdigest()[:16]
+
+
+### *--- one index per grid and directory in a process ---* ###
+mapping_indices = {}
+
+
+def get_mapping_index(model_lon: np.ndarray,
+                      model_lat: np.ndarray,
+                      index_dir=None,
+                      precision=1e-4) -> MappingIndex:
+
+    key = (index_dir, grid_key(model_lon, model_lat, precision))
+    if not key in mapping_indices.keys():
+        mapping_indices[key] = MappingIndex(model_lon, model_lat, index_dir,
+                                            precision)
+
+    return mapping_indices[key]
+
+
+### *--- merge all the observations in one grid cell (superobbing) ---* ###
+def merge_surrounding(map_idx: np.ndarray,
+                      values: np.ndarray,
+                      error: np.ndarray,
+                      correlation=0.5,
+                      min_count=1) -> tuple:
+    """
+    Average the observations mapped to the same grid cell.
+
+    params:
+        map_idx: mapping indices of the observations, dim : m
+        values: observations, dim : m (or m * 1)
+        error: observational error (std), dim : m (or m * 1)
+        correlation: error correlation of the observations in one cell,
+                     0 for independent errors shrinking with the number of
+                     contributors, 1 for the mean error kept as it is.
+        min_count: the cells with less contributors are dropped.
+
+    return:
+        map_idx, values, error and the number of contributors of the
+        superobservations, dim : n
+    """
+
+    map_idx = np.asarray(map_idx).reshape(-1)
+    values = np.asarray(values, dtype=float).reshape(-1)
+    error = np.asarray(error, dtype=float).reshape(-1)
+
+    cells, inverse, count = np.unique(map_idx,
+                                      return_inverse=True,
+                                      return_counts=True)
+
+    value_mean = np.bincount(inverse, weights=values) / count
+    variance_mean = np.bincount(inverse, weights=error**2) / count
+    error_merged = np.sqrt(variance_mean *
+                           (correlation + (1 - correlation) / count))
+
+    keep = count >= min_count
+
+    return cells[keep], value_mean[keep], error_merged[keep], count[keep]
+
+
+### *--- flat multi-level observations, sorted by level ---* ###
+level_dtype = np.dtype([('level', np.int32), ('obs', np.int64),
+                        ('cell', np.int64), ('value', np.float64),
+                        ('error', np.float64)])
+
+
+def split_levels(map_idx: np.ndarray, values: np.ndarray, error: np.ndarray,
+                 layers: np.ndarray, max_level=None) -> np.ndarray:
+    """
+    Distribute column observations (e.g. AOD) over the levels.
+
+    params:
+        map_idx: mapping indices of the observations, dim : m
+        values: column observations, dim : m (or m * 1)
+        error: observational error (std), dim : m (or m * 1)
+        layers: fraction of every level, dim : Nlev * Ns
+        max_level: only the levels below are kept, all by default.
+
+    return:
+        structured array of level_dtype, dim : Nlev * m
+    """
+
+    map_idx = np.asarray(map_idx).reshape(-1)
+    Nlev = len(layers) if max_level is None else min(max_level, len(layers))
+    m = len(map_idx)
+
+    # dim : Nlev * m
+    fraction = layers[:Nlev, map_idx]
+
+    levels = np.empty(Nlev * m, dtype=level_dtype)
+    levels['level'] = np.repeat(np.arange(Nlev), m)
+    levels['obs'] = np.tile(np.arange(m), Nlev)
+    levels['cell'] = np.tile(map_idx, Nlev)
+    levels['value'] = (np.asarray(values).reshape(1, -1) * fraction).ravel()
+    levels['error'] = (np.asarray(error).reshape(1, -1) * fraction).ravel()
+
+    return levels
+
+
+def level_offsets(level: np.ndarray, Nlev: int) -> np.ndarray:
+    """
+    return:
+        start of every level in the sorted levels, level i_lev is
+        [offsets[i_lev], offsets[i_lev + 1]), dim : Nlev + 1
+    """
+    return np.searchsorted(level, np.arange(Nlev + 1))
 
 
 ### another version of nearest search for multi-layers ###
@@ -351,6 +619,27 @@ class Observation:
 
         self.map_idx = map_idx
 
+    ### *--- the observation operator as a sparse matrix ---* ###
+    def operator(self, model_lon: np.ndarray, model_lat: np.ndarray,
+                 method='nearest', index_dir=None, **kwargs) -> None:
+        """
+        Build H (m * Ns) of the observations, see ObservationOperator for
+        the parameters, HX is then given by Operator_lib.apply.
+        """
+
+        index = None if index_dir is None else get_mapping_index(
+            model_lon, model_lat, index_dir)
+
+        if self.m == 0:
+            obs_lon, obs_lat = np.empty(0), np.empty(0)
+        else:
+            obs_lon = self.data.iloc[:, 0].values
+            obs_lat = self.data.iloc[:, 1].values
+
+        self.H = ObservationOperator(method, index=index,
+                                     **kwargs).build(model_lon, model_lat,
+                                                     obs_lon, obs_lat)
+
     ### *--- get the observational error ---* ###
     def get_error(self, method: str, *args, **kwargs) -> None:
 
@@ -378,6 +667,9 @@ class Observations:
         self.data = {}
         self.values = {}
         self.map_idx = {}
+        self.H = {}
+        self.levels = {}
+        self.offsets = {}
         self.error = {}
         self.m = {}
 
@@ -432,6 +724,7 @@ class Observations:
                 raise ValueError('Method -> "%s" <- is not regonized.' %
                                  (method))
 
+            kwargs.pop('repeat', None)
             map_idx = methods.get(method)(self.data[self.obs_type], *args,
                                           **kwargs)
 
@@ -444,6 +737,27 @@ class Observations:
 
             self.map_idx[self.obs_type] = np.empty(0, dtype=int)
 
+    ### *--- the observation operator as a sparse matrix ---* ###
+    def operator(self, model_lon: np.ndarray, model_lat: np.ndarray,
+                 method='nearest', index_dir=None, **kwargs) -> None:
+        """
+        Build H (m * Ns) of the current observation type, run after the
+        superobbing if any. See ObservationOperator for the parameters.
+        """
+
+        index = None if index_dir is None else get_mapping_index(
+            model_lon, model_lat, index_dir)
+
+        if self.m[self.obs_type] == 0:
+            obs_lon, obs_lat = np.empty(0), np.empty(0)
+        else:
+            obs_lon = self.data[self.obs_type].iloc[:, 0].values
+            obs_lat = self.data[self.obs_type].iloc[:, 1].values
+
+        self.H[self.obs_type] = ObservationOperator(
+            method, index=index, **kwargs).build(model_lon, model_lat,
+                                                 obs_lon, obs_lat)
+
     ### *--- get the observational error ---* ###
     def get_error(self, method: str, *args, **kwargs) -> None:
 
@@ -466,71 +780,136 @@ class Observations:
 
             self.error[self.obs_type] = np.empty(0)
 
+    ### *--- one superobservation per grid cell ---* ###
+    def superob(self, correlation=0.5, min_count=1, **kwargs) -> None:
+        """
+        Merge the observations mapped to the same grid cell, run after
+        map2obs and get_error. See merge_surrounding for the parameters.
+        """
+
+        if self.m[self.obs_type] == 0:
+            return
+
+        # the repeated indices of every level are the same
+        map_idx = self.map_idx[self.obs_type]
+        repeat = map_idx.shape[0] if map_idx.ndim == 2 else 1
+        map_idx = map_idx[0] if map_idx.ndim == 2 else map_idx
+
+        cells, values, error, count = merge_surrounding(
+            map_idx,
+            self.values[self.obs_type],
+            self.error[self.obs_type],
+            correlation=correlation,
+            min_count=min_count)
+
+        # mean position of the contributors
+        data = self.data[self.obs_type]
+        columns = data.columns[:3]
+        data = data.iloc[:, :2].groupby(map_idx).mean().loc[cells]
+        data[columns[2]] = values
+        data['count'] = count
+        data = data.reset_index(drop=True)
+
+        logging.info('%s %s observations merged into %s grid cells' %
+                     (self.m[self.obs_type], self.obs_type, len(cells)))
+
+        self.m[self.obs_type] = len(cells)
+        self.data[self.obs_type] = data
+        self.values[self.obs_type] = values.reshape([-1, 1])
+        self.error[self.obs_type] = error.reshape(
+            [-1, 1] if self.error[self.obs_type].ndim == 2 else [-1])
+        self.map_idx[self.obs_type] = np.tile(
+            cells, (repeat, 1)) if repeat > 1 else cells
+
     # layering the original data, designed for AOD-like observations
-    def layering(self, layers: np.ndarray, **kwargs) -> None:
+    def layering(self, layers: np.ndarray, max_level=None, **kwargs) -> None:
+        """
+        Distribute the observations over the levels by the layer fraction,
+        dim : Nlev * Ns, the result is kept in levels (see split_levels).
+        """
+
+        map_idx = self.map_idx[self.obs_type]
+        if map_idx.ndim == 2:
+            map_idx = map_idx[0]
+
+        if self.m[self.obs_type] == 0:
+            levels = np.empty(0, dtype=level_dtype)
+        else:
+            levels = split_levels(map_idx,
+                                  self.values[self.obs_type],
+                                  self.error[self.obs_type],
+                                  layers,
+                                  max_level=max_level)
 
-        if not self.m[self.obs_type] == 0:
+        self.levels[self.obs_type] = levels
+        self.offsets[self.obs_type] = level_offsets(
+            levels['level'],
+            len(layers) if max_level is None else min(max_level, len(layers)))
 
-            values = np.zeros(self.map_idx[self.obs_type].shape)
-            error = np.zeros(self.map_idx[self.obs_type].shape)
-            for i_lev in range(len(layers)):
-                layer = layers[i_lev, self.map_idx[self.obs_type][i_lev, :]]
-                values[i_lev, :] = self.values[self.obs_type].flatten() * layer
-                error[i_lev, :] = self.error[self.obs_type].flatten() * layer
+    ### *--- the layered observations of one or several levels ---* ###
+    def level(self, obs_type: str, i_lev: int) -> np.ndarray:
 
-            self.values[self.obs_type] = values
-            self.error[self.obs_type] = error
+        offsets = self.offsets[obs_type]
+
+        return self.levels[obs_type][offsets[i_lev]:offsets[i_lev + 1]]
+
+    def stack_levels(self, obs_types: list, levels, field: str) -> np.ndarray:
+        """
+        Field of the observation types concatenated on every level, for
+        the levels observed at the same locations (not filtered).
+
+        return:
+            dim : L * m
+        """
+
+        return np.stack([
+            np.concatenate(
+                [self.level(obs_type, i_lev)[field] for obs_type in obs_types])
+            for i_lev in levels
+        ])
 
     ### filter the observations out of the model sapce ###
     def local_filter(self, local_bools: np.ndarray) -> None:
 
+        if self.m[self.obs_type] == 0:
+            return
+
         if local_bools.ndim == 1:
-            if not self.m[self.obs_type] == 0:
 
-                map_bools = local_bools[self.map_idx[self.obs_type]]
+            map_bools = local_bools[self.map_idx[self.obs_type]]
 
-                self.map_idx[self.obs_type] = self.map_idx[
-                    self.obs_type][map_bools]
-                self.values[self.obs_type] = self.values[
-                    self.obs_type][map_bools]
-                self.error[self.obs_type] = self.error[
-                    self.obs_type][map_bools]
+            self.map_idx[self.obs_type] = self.map_idx[
+                self.obs_type][map_bools]
+            self.values[self.obs_type] = self.values[self.obs_type][map_bools]
+            self.error[self.obs_type] = self.error[self.obs_type][map_bools]
 
+        # dim : Nlev * Ns, for the layered observations
         elif local_bools.ndim == 2:
-            if not self.m[self.obs_type] == 0:
-
-                map_bools = np.take(local_bools,
-                                    self.map_idx[self.obs_type][0],
-                                    axis=1)
-
-                self.map_idx[self.obs_type] = [
-                    np.array(self.map_idx[self.obs_type][i_lev, :][map_bools[
-                        i_lev, :]]) for i_lev in range(len(map_bools))
-                ]
-                self.values[self.obs_type] = [
-                    np.array(self.values[self.obs_type][i_lev, :][map_bools[
-                        i_lev, :]]) for i_lev in range(len(map_bools))
-                ]
-                self.error[self.obs_type] = [
-                    np.array(self.error[self.obs_type][i_lev, :][map_bools[
-                        i_lev, :]]) for i_lev in range(len(map_bools))
-                ]
-
-    ### *--- reduce the dimension of the variables ---* ###
-    def reduce_dim(self, Ns: int, Nlev: int) -> None:
 
-        if not self.m[self.obs_type] == 0:
-
-            map_idx = []
-            for i_lev in range(Nlev):
-                map_idx.append(self.map_idx[self.obs_type][i_lev] + i_lev * Ns)
+            levels = self.levels[self.obs_type]
+            self.levels[self.obs_type] = levels[local_bools[levels['level'],
+                                                            levels['cell']]]
 
-            self.map_idx[self.obs_type] = np.concatenate(
-                self.map_idx[self.obs_type])
-            self.values[self.obs_type] = np.concatenate(
-                self.values[self.obs_type])
-            self.error[self.obs_type] = np.concatenate(
-                self.error[self.obs_type])
+    ### *--- reduce the dimension of the variables ---* ###
+    def reduce_dim(self, Ns: int, Nlev=None) -> None:
+        """
+        Flatten the layered observations, the mapping indices point to the
+        state of dim : Nlev * Ns then. The start of every level is kept in
+        offsets.
+        """
+
+        if not self.obs_type in self.levels.keys():
+            return
+
+        levels = self.levels[self.obs_type]
+        Nlev = (int(np.max(levels['level'], initial=-1)) + 1) \
+            if Nlev is None else Nlev
+
+        self.map_idx[self.obs_type] = levels['level'].astype(
+            int) * Ns + levels['cell']
+        self.values[self.obs_type] = levels['value'].copy()
+        self.error[self.obs_type] = levels['error'].copy()
+        self.offsets[self.obs_type] = level_offsets(levels['level'], Nlev)
 
     ### *-----------------------------------* ###
     ### *---   assemble some variables   ---* ###
@@ -1,16 +1,21 @@
 '''
 Autor: Mijie Pang
 Date: 2023-10-23 20:55:00
-LastEditTime: 2024-04-11 19:22:31
+LastEditTime: 2024-04-30 11:18:40
 Description: designed to generate the assimilation output files
 '''
 import os
 import sys
+import logging
 import numpy as np
+import multiprocessing as mp
+from multiprocessing import resource_tracker
+from datetime import datetime
 
 sys.path.append('../')
 
 from tool.pack import NcProduct
+from State_lib import EnsembleState
 
 ### kill the negative and nan values ###
 def kill_negative(data: np.ndarray, fill_value=1e-9) -> np.ndarray:
@@ -21,6 +26,47 @@ def kill_negative(data: np.ndarray, fill_value=1e-9) -> np.ndarray:
     return data
 
 
+### *--- the arrays travel to the writers in shared memory ---* ###
+def share(value):
+
+    if not isinstance(value, np.ndarray) or value.size == 0:
+        return value
+
+    state = EnsembleState(value.shape, dtype=value.dtype, fill_value=None)
+    state.array[...] = value
+
+    return state
+
+
+def write_loop(output, queue, errors) -> None:
+
+    while True:
+
+        task = queue.get()
+        if task is None:
+            queue.task_done()
+            break
+
+        method, args, kwargs = task
+        try:
+            output.methods.get(method)(
+                *[unshare(arg) for arg in args],
+                **{key: unshare(value)
+                   for key, value in kwargs.items()})
+        except Exception as error:
+            errors.put('%s : %s' % (method, error))
+        finally:
+            for value in args + list(kwargs.values()):
+                if isinstance(value, EnsembleState):
+                    value.owner = True
+                    value.close()
+            queue.task_done()
+
+
+def unshare(value):
+    return value.array if isinstance(value, EnsembleState) else value
+
+
 class Output:
 
     def __init__(self, output_dir: str, config: dict, **Config) -> None:
@@ -47,15 +93,125 @@ class Output:
         self.Config = Config
         self.output_dir = output_dir
 
+        # the fields are compressed, the ensembles chunked by member
+        post_process = Config.get('Assimilation', {}).get('post_process', {})
+        self.encoding = {
+            'zlib': True,
+            'shuffle': True,
+            'complevel': post_process.get('complevel', 4)
+        }
+
+        # background writers, see start
+        self.queue = None
+        self.errors = None
+        self.writers = []
+
     ###########################################################
     ### method portals for saving output
     ### *--- Method Portal ---* ###
     def save(self, method: str, *args, **kwargs) -> None:
+        """
+        Save the product at once, or hand it to the background writers if
+        they are started, the arrays are copied to shared memory then and
+        the caller is free to change them.
+        """
 
         if method not in self.methods.keys():
             raise ValueError('Invalid product name -> "%s" <-' % (method))
 
-        self.methods.get(method)(*args, **kwargs)
+        if self.queue is None:
+            self.methods.get(method)(*args, **kwargs)
+            return
+
+        args = [share(arg) for arg in args]
+        kwargs = {key: share(value) for key, value in kwargs.items()}
+
+        # blocks while max_queue products are waiting (back-pressure)
+        start_put = datetime.now()
+        self.queue.put((method, args, kwargs))
+        waiting_time = (datetime.now() - start_put).total_seconds()
+        if waiting_time > 1:
+            logging.debug('Output %s waited %.2f s for the writers' %
+                          (method, waiting_time))
+
+        # the writer unlinks the blocks once the product is written
+        for value in args + list(kwargs.values()):
+            if isinstance(value, EnsembleState):
+                value.shm.close()
+
+    ### *--- background writers off the analysis critical path ---* ###
+    def start(self, max_queue=4, workers=1) -> None:
+        """
+        params:
+            max_queue: products waiting for the writers, save blocks when
+                       the queue is full.
+            workers: number of the writer processes.
+        """
+
+        if not self.queue is None:
+            return
+
+        # the writers share the resource tracker, which forgets the blocks
+        # they unlink
+        resource_tracker.ensure_running()
+
+        self.queue = mp.JoinableQueue(maxsize=max_queue)
+        self.errors = mp.SimpleQueue()
+        self.writers = [
+            mp.Process(target=write_loop,
+                       args=(self, self.queue, self.errors),
+                       daemon=True) for i_worker in range(workers)
+        ]
+        for writer in self.writers:
+            writer.start()
+
+        logging.debug('%s output writers started, queue of %s products' %
+                      (workers, max_queue))
+
+    def flush(self) -> list:
+        """
+        Wait for the products saved so far, e.g. at the end of a cycle.
+
+        return:
+            messages of the products failed
+        """
+
+        if self.queue is None:
+            return []
+
+        start_flush = datetime.now()
+        self.queue.join()
+
+        failed = []
+        while not self.errors.empty():
+            failed.append(self.errors.get())
+        for message in failed:
+            logging.error('Output failed, %s' % (message))
+
+        logging.debug('Output flushed, waited %.2f s' %
+                      ((datetime.now() - start_flush).total_seconds()))
+
+        return failed
+
+    def join(self) -> list:
+        """
+        Flush the products and stop the writers.
+        """
+
+        if self.queue is None:
+            return []
+
+        failed = self.flush()
+        for writer in self.writers:
+            self.queue.put(None)
+        for writer in self.writers:
+            writer.join()
+
+        self.queue = None
+        self.errors = None
+        self.writers = []
+
+        return failed
 
     ###########################################################
     ### secific output products to save
@@ -85,7 +241,9 @@ class Output:
         nc_product.define_variable(
             longitude=['f4', 'longitude'],
             latitude=['f4', 'latitude'],
-            prior=['f4', ('bin', 'level', 'latitude', 'longitude')])
+            prior=[
+                'f4', ('bin', 'level', 'latitude', 'longitude'), self.encoding
+            ])
 
         ### *-- add the data ---* ###
         nc_product.add_data(longitude=self.model_lon)
@@ -98,8 +256,9 @@ class Output:
             nc_product.add_data(altitude=altitude)
 
         if not std is None:
-            nc_product.define_variable(
-                prior_std=['f4', ('level', 'latitude', 'longitude')])
+            nc_product.define_variable(prior_std=[
+                'f4', ('level', 'latitude', 'longitude'), self.encoding
+            ])
             nc_product.add_data(prior_std=std)
 
         nc_product.close()
@@ -124,7 +283,7 @@ class Output:
         nc_product.define_variable(
             longitude=['f4', 'longitude'],
             latitude=['f4', 'latitude'],
-            prior=['f4', ('level', 'latitude', 'longitude')])
+            prior=['f4', ('level', 'latitude', 'longitude'), self.encoding])
 
         ### add data to the file ###
         nc_product.add_data(longitude=self.model_lon)
@@ -166,7 +325,10 @@ class Output:
         nc_product.define_variable(
             longitude=['f4', 'longitude'],
             latitude=['f4', 'latitude'],
-            prior=['f4', ('Ne', 'spec', 'level', 'latitude', 'longitude')])
+            prior=[
+                'f4', ('Ne', 'spec', 'level', 'latitude', 'longitude'),
+                dict(self.encoding, chunk='Ne')
+            ])
 
         ### add data to the file ###
         nc_product.add_data(longitude=self.model_lon)
@@ -189,9 +351,10 @@ class Output:
                                Info=self.Config['Info'])
         nc_product.define_dimension(longitude=self.config['nlon'],
                                     latitude=self.config['nlat'])
-        nc_product.define_variable(longitude=['f4', 'longitude'],
-                                   latitude=['f4', 'latitude'],
-                                   prior=['f4', ('latitude', 'longitude')])
+        nc_product.define_variable(
+            longitude=['f4', 'longitude'],
+            latitude=['f4', 'latitude'],
+            prior=['f4', ('latitude', 'longitude'), self.encoding])
 
         ### add data to the file ###
         nc_product.add_data(longitude=self.model_lon)
@@ -214,9 +377,10 @@ class Output:
                                Info=self.Config['Info'])
         nc_product.define_dimension(longitude=self.config['nlon'],
                                     latitude=self.config['nlat'])
-        nc_product.define_variable(longitude=['f4', 'longitude'],
-                                   latitude=['f4', 'latitude'],
-                                   prior=['f4', ('latitude', 'longitude')])
+        nc_product.define_variable(
+            longitude=['f4', 'longitude'],
+            latitude=['f4', 'latitude'],
+            prior=['f4', ('latitude', 'longitude'), self.encoding])
 
         ### add data to the file ###
         nc_product.add_data(longitude=self.model_lon)
@@ -251,7 +415,9 @@ class Output:
         nc_product.define_variable(
             longitude=['f4', 'longitude'],
             latitude=['f4', 'latitude'],
-            posterior=['f4', ('bin', 'level', 'latitude', 'longitude')])
+            posterior=[
+                'f4', ('bin', 'level', 'latitude', 'longitude'), self.encoding
+            ])
 
         ### *-- add the data ---* ###
         nc_product.add_data(longitude=self.model_lon)
@@ -264,8 +430,9 @@ class Output:
             nc_product.add_data(altitude=altitude)
 
         if not std is None:
-            nc_product.define_variable(
-                posterior_std=['f4', ('level', 'latitude', 'longitude')])
+            nc_product.define_variable(posterior_std=[
+                'f4', ('level', 'latitude', 'longitude'), self.encoding
+            ])
             nc_product.add_data(posterior_std=std)
 
         nc_product.close()
@@ -291,7 +458,9 @@ class Output:
             longitude=['f4', 'longitude'],
             latitude=['f4', 'latitude'],
             level=['f4', 'level'],
-            posterior=['f4', ('level', 'latitude', 'longitude')])
+            posterior=[
+                'f4', ('level', 'latitude', 'longitude'), self.encoding
+            ])
 
         ### add data to the file ###
         nc_product.add_data(longitude=self.model_lon)
@@ -333,7 +502,10 @@ class Output:
         nc_product.define_variable(
             longitude=['f4', 'longitude'],
             latitude=['f4', 'latitude'],
-            posterior=['f4', ('Ne', 'bin', 'level', 'latitude', 'longitude')])
+            posterior=[
+                'f4', ('Ne', 'bin', 'level', 'latitude', 'longitude'),
+                dict(self.encoding, chunk='Ne')
+            ])
 
         ### add data to the file ###
         nc_product.add_data(longitude=self.model_lon)
@@ -356,9 +528,10 @@ class Output:
                                Info=self.Config['Info'])
         nc_product.define_dimension(longitude=self.config['nlon'],
                                     latitude=self.config['nlat'])
-        nc_product.define_variable(longitude=['f4', 'longitude'],
-                                   latitude=['f4', 'latitude'],
-                                   posterior=['f4', ('latitude', 'longitude')])
+        nc_product.define_variable(
+            longitude=['f4', 'longitude'],
+            latitude=['f4', 'latitude'],
+            posterior=['f4', ('latitude', 'longitude'), self.encoding])
 
         ### add data to the file ###
         nc_product.add_data(longitude=self.model_lon)
@@ -382,9 +555,10 @@ class Output:
                                Info=self.Config['Info'])
         nc_product.define_dimension(longitude=self.config['nlon'],
                                     latitude=self.config['nlat'])
-        nc_product.define_variable(longitude=['f4', 'longitude'],
-                                   latitude=['f4', 'latitude'],
-                                   posterior=['f4', ('latitude', 'longitude')])
+        nc_product.define_variable(
+            longitude=['f4', 'longitude'],
+            latitude=['f4', 'latitude'],
+            posterior=['f4', ('latitude', 'longitude'), self.encoding])
 
         ### add data to the file ###
         nc_product.add_data(longitude=self.model_lon)
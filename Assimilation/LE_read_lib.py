@@ -5,8 +5,19 @@ LastEditTime: 2024-04-11 19:21:43
 Description: 
 '''
 import os
+import threading
 import numpy as np
 import netCDF4 as nc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# time axis of the opened output files, {(path, mtime): {time string: index}}
+time_index_cache = {}
+time_index_lock = threading.Lock()
+# the netCDF4/HDF5 library is not thread-safe, the reads of one process
+# go through this lock and only the process pool reads concurrently
+netcdf_lock = threading.Lock()
+# the pools are kept between the calls, so the workers keep their cache
+executor_pool = {}
 
 
 class ModelReader:
@@ -85,18 +96,141 @@ class ModelReader:
 
         with nc.Dataset(path) as nc_obj:
 
-            output_time = nc_obj.variables['time']
-            output_time = nc.num2date(output_time[:], output_time.units)
-            output_time = [
-                str(output_time[i_time]) for i_time in range(len(output_time))
+            time_idx = get_time_index(nc_obj, path, time)
+            data = nc_obj.variables[var_name][time_idx, :] * factor
+
+        return data
+
+    def read_ensemble(self,
+                      run_ids: list,
+                      output_name: str,
+                      time: None,
+                      var_names,
+                      run_project=None,
+                      output_dirs=None,
+                      factor=1,
+                      max_workers=8,
+                      parallel='process') -> np.ndarray:
+        """
+        Read the model output of a whole ensemble, every file is opened once.
+
+        params:
+            run_ids: list of run identifiers, one per member.
+            output_name: str, the name of the output.
+            time: the time point of the data to be read.
+            var_names: str or list of the variables to be read.
+            run_project: Optional[str], the name of the project.
+            output_dirs: Optional[list], output directory of every member.
+            factor: scale factor applied to the data.
+            max_workers: size of the thread/process pool.
+            parallel: 'process' or 'thread', the threads read one file at
+                      a time as the netCDF library is not thread-safe and
+                      only overlap the conversion of the data.
+
+        return:
+            a float32 array of dim : Ne * [Nvar] * var_shape, the variable
+            axis is dropped when var_names is a str.
+        """
+
+        executors = {
+            'thread': ThreadPoolExecutor,
+            'process': ProcessPoolExecutor
+        }
+        if parallel not in executors.keys():
+            raise ValueError('Invalid parallel method -> "%s" <-' % (parallel))
+
+        if not (parallel, max_workers) in executor_pool.keys():
+            executor_pool[(parallel, max_workers)] = executors[parallel](
+                max_workers=max_workers)
+        executor = executor_pool[(parallel, max_workers)]
+
+        single_var = isinstance(var_names, str)
+        if single_var:
+            var_names = [var_names]
+
+        if output_dirs is None:
+            output_dirs = [
+                os.path.join(self.model_dir, run_project or self.run_project,
+                             run_id, 'output') for run_id in run_ids
             ]
-            time_idx = output_time.index(time.strftime('%Y-%m-%d %H:%M:%S'))
 
-            data = nc_obj.variables[var_name][time_idx, :] * factor
+        paths = [
+            os.path.join(
+                output_dir, 'LE_%s_%s_%s.nc' %
+                (run_id, output_name, time.strftime('%Y%m%d')))
+            for run_id, output_dir in zip(run_ids, output_dirs)
+        ]
+
+        futures = [
+            executor.submit(read_hyperslab, path, time, var_names, factor)
+            for path in paths
+        ]
+
+        data = None
+        for i_ensem, future in enumerate(futures):
+
+            member = future.result()
+            if data is None:
+                data = np.zeros((len(paths), ) + member.shape,
+                                dtype=np.float32)
+            data[i_ensem] = member
+
+        if single_var:
+            data = data[:, 0]
 
         return data
 
 
+### *--- read several variables at one time point from one file ---* ###
+def read_hyperslab(path: str, time: None, var_names: list,
+                   factor=1) -> np.ndarray:
+
+    with netcdf_lock, nc.Dataset(path) as nc_obj:
+
+        # fill values are kept as they are, same as the masked read
+        nc_obj.set_auto_mask(False)
+        time_idx = get_time_index(nc_obj, path, time)
+
+        data = [
+            nc_obj.variables[var_name][time_idx, ...]
+            for var_name in var_names
+        ]
+
+    data = np.stack(data).astype(np.float32)
+
+    if factor != 1:
+        data *= factor
+
+    return data
+
+
+def get_time_index(nc_obj: nc.Dataset, path: str, time: None) -> int:
+    """
+    Index of the time point in the output file, the decoded time axis is
+    cached per file until the file is modified. The cache lives in the
+    reading process, i.e. in every worker of the kept process pool.
+    """
+
+    key = (path, os.path.getmtime(path))
+
+    with time_index_lock:
+        time_index = time_index_cache.get(key)
+
+    if time_index is None:
+
+        output_time = nc_obj.variables['time']
+        output_time = nc.num2date(output_time[:], output_time.units)
+        time_index = {
+            str(output_time[i_time]): i_time
+            for i_time in range(len(output_time))
+        }
+
+        with time_index_lock:
+            time_index_cache[key] = time_index
+
+    return time_index[time.strftime('%Y-%m-%d %H:%M:%S')]
+
+
 if __name__ == '__main__':
 
     mr = ModelReader()
@@ -5,8 +5,11 @@ LastEditTime: 2024-02-18 21:07:14
 Description: 
 '''
 import os
+import logging
 import numpy as np
 import netCDF4 as nc
+import multiprocessing as mp
+from datetime import datetime
 
 
 class WriteRestart:
@@ -22,13 +25,67 @@ class WriteRestart:
         if kwargs.get('screen', True):
             data = self.kill_negative(data)
 
-        path = os.path.join(
+        with nc.Dataset(self.path(run_id, time), 'r+') as nc_obj:
+            nc_obj.variables[var_name][:] = data[:]
+
+    ### *--- write the restart files of the whole ensemble ---* ###
+    def write_ensemble(self,
+                       ensemble,
+                       run_ids: list,
+                       time: None,
+                       var_name: str,
+                       ratio=None,
+                       max_workers=4,
+                       **kwargs) -> None:
+        """
+        The field of every member is built in a float32 buffer of the
+        worker and written to its file, several files at the same time.
+
+        params:
+            ensemble: EnsembleState or array with the member as the last axis,
+                      the workers share it (fork), nothing is copied.
+            run_ids: run id of every member.
+            time: time of the restart files.
+            var_name: variable written.
+            ratio: multiplied to every member (broadcast) to give the field
+                   of the restart file, e.g. dim : Nspec * Nlev * Nlat * Nlon
+            max_workers: number of files written at the same time, 1 to
+                         write in this process.
+        """
+
+        ensemble = getattr(ensemble, 'array', ensemble)
+        tasks = [(i_ensem, self.path(run_id, time), var_name)
+                 for i_ensem, run_id in enumerate(run_ids)]
+        initargs = (ensemble, ratio, kwargs.get('screen', True))
+
+        start_write = datetime.now()
+
+        if max_workers > 1 and len(tasks) > 1:
+            with mp.Pool(processes=min(max_workers, len(tasks)),
+                         initializer=init_writer,
+                         initargs=initargs) as pool:
+                reports = list(pool.imap_unordered(write_member, tasks))
+        else:
+            init_writer(*initargs)
+            reports = [write_member(task) for task in tasks]
+
+        for path, size, seconds in reports:
+            logging.debug('%s written, %.1f MB at %.1f MB/s' %
+                          (os.path.basename(path), size / 1024**2,
+                           size / 1024**2 / max(seconds, 1e-6)))
+
+        seconds = (datetime.now() - start_write).total_seconds()
+        size = sum(report[1] for report in reports)
+        logging.info('%s restart files written in %.2f s (%.1f MB/s)' %
+                     (len(reports), seconds,
+                      size / 1024**2 / max(seconds, 1e-6)))
+
+    def path(self, run_id: str, time: None) -> str:
+
+        return os.path.join(
             self.model_dir, self.run_project, run_id, 'restart',
             'LE_%s_state_%s.nc' % (run_id, time.strftime('%Y%m%d_%H%M')))
 
-        with nc.Dataset(path, 'r+') as nc_obj:
-            nc_obj.variables[var_name][:] = data[:]
-
     ######################################################
     ### Some useful functions
     ### *--- Functions ---* ###
@@ -76,12 +133,59 @@ class WriteRestart:
 ### eliminate all the values that less then 0 ###
 def kill_negative(data: np.ndarray, fill_value=1e-9) -> np.ndarray:
 
-    data[data <= 0] = fill_value
-    data[np.isnan(data)] = fill_value
+    # NaN is not positive either, one pass in place
+    np.putmask(data, ~(data > 0), fill_value)
 
     return data
 
 
+### *--- restart writing in the worker processes ---* ###
+writer_args = {}
+
+
+def init_writer(ensemble: np.ndarray, ratio, screen: bool) -> None:
+
+    writer_args.update(ensemble=ensemble,
+                       ratio=ratio,
+                       screen=screen,
+                       buffer=None)
+
+
+def write_member(task: tuple) -> tuple:
+    """
+    Write the field of one member, the buffer is reused by the worker.
+
+    return:
+        path, bytes written and seconds taken.
+    """
+
+    i_ensem, path, var_name = task
+
+    member = writer_args['ensemble'][..., i_ensem]
+    ratio = writer_args['ratio']
+    shape = member.shape if ratio is None else np.broadcast_shapes(
+        member.shape, np.shape(ratio))
+
+    buffer = writer_args['buffer']
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, dtype=np.float32)
+        writer_args['buffer'] = buffer
+
+    if ratio is None:
+        np.copyto(buffer, member, casting='unsafe')
+    else:
+        np.multiply(member, ratio, out=buffer, casting='unsafe')
+    if writer_args['screen']:
+        kill_negative(buffer)
+
+    start_write = datetime.now()
+    with nc.Dataset(path, 'r+') as nc_obj:
+        nc_obj.variables[var_name][:] = buffer
+
+    return path, buffer.nbytes, (datetime.now() -
+                                 start_write).total_seconds()
+
+
 ### convert 2d to 3d field ###
 def convert2full(data_2d: np.ndarray, mass_partition: np.ndarray,
                  spec_partition: np.ndarray, Nlon: int, Nlat: int, Nlev: int,
@@ -4,8 +4,13 @@ Date: 2023-09-23 16:44:44
 LastEditTime: 2024-04-05 20:02:58
 Description: 
 '''
+import os
+import shutil
+import hashlib
 import logging
 import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
 # from memory_profiler import profile
 
 
@@ -46,6 +51,64 @@ class Localization:
 
         return Correlation
 
+    ### *--- calculate the sparse Localization matrix ---* ###
+    def cal_sparse_correlation(self,
+                               method='empirical',
+                               distance_threshold=500,
+                               **kwargs) -> sparse.csr_matrix:
+        """
+        Gaspari-Cohn taper stored as a sparse matrix. Only the pairs within
+        2 * distance_threshold are searched with a KD-tree, so the dense
+        dim1 * dim2 distance matrix is never built.
+
+        params:
+            method: distance calculation method, 'empirical' or 'haversine'.
+            distance_threshold: half of the cut-off distance (km).
+
+        return:
+            csr matrix of dim : dim1 * dim2
+        """
+
+        methods = {
+            'empirical': self.empirical_points,
+            'haversine': self.haversine_points
+        }
+        if method not in methods.keys():
+            raise ValueError('Invalid distance calculation method -> "%s" <-' %
+                             (method))
+
+        lon1, lat1 = self.prepare_meshgrid(self.lon1, self.lat1,
+                                           kwargs.get('meshgrid1', False))
+        lon2, lat2 = self.prepare_meshgrid(self.lon2, self.lat2,
+                                           kwargs.get('meshgrid2', False))
+
+        # search radius in the coordinate space of the KD-tree
+        points1, points2, radius = methods.get(method)(lon1, lat1, lon2, lat2,
+                                                       2 * distance_threshold)
+
+        pairs = cKDTree(points1).sparse_distance_matrix(cKDTree(points2),
+                                                        radius,
+                                                        output_type='ndarray')
+        row, col = pairs['i'], pairs['j']
+
+        # the exact distance of the selected pairs only
+        if method == 'empirical':
+            Distance = pairs['v']
+        else:
+            Distance = self.haversine_distance(lon1[row], lat1[row], lon2[col],
+                                               lat2[col],
+                                               pairwise=True)
+
+        Correlation = sparse.csr_matrix(
+            (gaspari_cohn(Distance, distance_threshold), (row, col)),
+            shape=(len(lon1), len(lon2)))
+        Correlation.eliminate_zeros()
+
+        logging.debug('Sparse localization : %s non-zeros of %s * %s' %
+                      (Correlation.nnz, len(lon1), len(lon2)))
+
+        return Correlation
+
     def prepare_meshgrid(self, lon: np.ndarray, lat: np.ndarray,
                          meshgrid_needed: bool) -> np.ndarray:
         if meshgrid_needed:
@@ -85,10 +148,14 @@ class Localization:
         lon2, lat2 = self.prepare_meshgrid(lon2, lat2,
                                            kwargs.get('meshgrid2', False))
 
-        lon1, lat1, lon2, lat2 = map(np.radians, [
-            lon1.reshape([len(lon1), 1]),
-            lat1.reshape([len(lat1), 1]), lon2, lat2
-        ])
+        # element-wise distance of paired points instead of the outer one
+        if kwargs.get('pairwise', False):
+            lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+        else:
+            lon1, lat1, lon2, lat2 = map(np.radians, [
+                lon1.reshape([len(lon1), 1]),
+                lat1.reshape([len(lat1), 1]), lon2, lat2
+            ])
 
         dlat = lat2 - lat1
         dlon = lon2 - lon1
@@ -101,30 +168,39 @@ class Localization:
 
         return Distance
 
+    ### *--- KD-tree coordinates of the distance methods ---* ###
+    def empirical_points(self, lon1: np.ndarray, lat1: np.ndarray,
+                         lon2: np.ndarray, lat2: np.ndarray,
+                         radius: float) -> tuple:
+
+        # the empirical distance is euclidean on the scaled lon/lat plane
+        points1 = np.column_stack((lon1, lat1)) * 100
+        points2 = np.column_stack((lon2, lat2)) * 100
+
+        return points1, points2, radius
+
+    def haversine_points(self, lon1: np.ndarray, lat1: np.ndarray,
+                         lon2: np.ndarray, lat2: np.ndarray,
+                         radius: float) -> tuple:
+
+        def to_cartesian(lon, lat):
+            lon, lat = np.radians(lon), np.radians(lat)
+            return np.column_stack((np.cos(lat) * np.cos(lon),
+                                    np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+        # great circle distance to chord length on the unit sphere
+        radius = 2 * np.sin(min(radius / 6371.0, np.pi) / 2)
+
+        return to_cartesian(lon1, lat1), to_cartesian(lon2, lat2), radius
+
     ### *------------------------------------* ###
     ### *---   Correlation Calculatioon   ---* ###
     # @profile
     def default(self, **kwargs) -> np.ndarray:
 
         distance_threshold = kwargs.get('distance_threshold', 500)
-        Local_martrix = self.Distance / distance_threshold
-
-        condition1 = Local_martrix < 1
-        condition2 = np.logical_and(1 <= Local_martrix, Local_martrix < 2)
-        condition3 = Local_martrix >= 2
-
-        distance1 = Local_martrix[condition1]
-        Local_martrix[condition1] = 1 - 5 / 3 * distance1**2 + 5 / 8 * distance1**3 + \
-                                    1 / 2 * distance1**4 - 1 / 4 * distance1**5
-
-        distance2 = Local_martrix[condition2]
-        Local_martrix[condition2] = -2 / 3 * distance2**(-1) + 4 - 5 * distance2 + \
-                                    5 / 3 * distance2**2 + 5 / 8 * distance2**3 - \
-                                    1 / 2 * distance2**4 + 1 / 12 * distance2**5
 
-        Local_martrix[condition3] = 0
-
-        return Local_martrix
+        return gaspari_cohn(self.Distance, distance_threshold)
 
     def linear(self) -> np.ndarray:
         pass
@@ -133,6 +209,150 @@ class Localization:
         pass
 
 
+### *--- Gaspari-Cohn fifth-order taper ---* ###
+def gaspari_cohn(Distance: np.ndarray, distance_threshold: float) -> np.ndarray:
+    """
+    Gaspari-Cohn correlation function, zero beyond 2 * distance_threshold.
+
+    params:
+        Distance: distance array (any shape), same unit as the threshold.
+        distance_threshold: half of the cut-off distance.
+
+    return:
+        correlation array with the same shape as Distance.
+    """
+
+    Local_martrix = np.asarray(Distance) / distance_threshold
+
+    condition1 = Local_martrix < 1
+    condition2 = np.logical_and(1 <= Local_martrix, Local_martrix < 2)
+    condition3 = Local_martrix >= 2
+
+    distance1 = Local_martrix[condition1]
+    Local_martrix[condition1] = 1 - 5 / 3 * distance1**2 + 5 / 8 * distance1**3 + \
+                                1 / 2 * distance1**4 - 1 / 4 * distance1**5
+
+    distance2 = Local_martrix[condition2]
+    Local_martrix[condition2] = -2 / 3 * distance2**(-1) + 4 - 5 * distance2 + \
+                                5 / 3 * distance2**2 + 5 / 8 * distance2**3 - \
+                                1 / 2 * distance2**4 + 1 / 12 * distance2**5
+
+    Local_martrix[condition3] = 0
+
+    return Local_martrix
+
+
+### *--- memory-mapped on-disk cache of localization matrices ---* ###
+class LocalizationCache:
+
+    def __init__(self, cache_dir: str, max_entries=16) -> None:
+
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, *arrays, **params) -> str:
+        """
+        Hash the grid and observation coordinates together with the
+        localization parameters, e.g. method and distance threshold.
+        """
+
+        sha = hashlib.sha1()
+        for array in arrays:
+            array = np.ascontiguousarray(array, dtype=np.float64)
+            sha.update(str(array.shape).encode())
+            sha.update(array.tobytes())
+        sha.update(repr(sorted(params.items())).encode())
+
+        return sha.hexdigest()
+
+    def load(self, key: str):
+        """
+        Return the cached matrices (memory-mapped, read only) or None.
+        """
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.exists(entry_dir):
+            return None
+
+        matrices = []
+        n_matrix = len(
+            [f for f in os.listdir(entry_dir) if f.endswith('_shape.npy')])
+        for i_matrix in range(n_matrix):
+
+            path = os.path.join(entry_dir, 'L%s' % (i_matrix))
+            shape = tuple(np.load(path + '_shape.npy'))
+
+            if os.path.exists(path + '_indptr.npy'):
+                matrices.append(
+                    sparse.csr_matrix(
+                        (np.load(path + '_data.npy', mmap_mode='r'),
+                         np.load(path + '_indices.npy', mmap_mode='r'),
+                         np.load(path + '_indptr.npy', mmap_mode='r')),
+                        shape=shape,
+                        copy=False))
+            else:
+                matrices.append(np.load(path + '.npy', mmap_mode='r'))
+
+        # mark as recently used
+        os.utime(entry_dir)
+
+        return tuple(matrices)
+
+    def save(self, key: str, matrices: tuple) -> None:
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = os.path.join(self.cache_dir, '.%s_%s' % (key, os.getpid()))
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        for i_matrix, matrix in enumerate(matrices):
+
+            path = os.path.join(tmp_dir, 'L%s' % (i_matrix))
+            np.save(path + '_shape.npy', np.array(matrix.shape))
+
+            if sparse.issparse(matrix):
+                matrix = matrix.tocsr()
+                np.save(path + '_data.npy', matrix.data)
+                np.save(path + '_indices.npy', matrix.indices)
+                np.save(path + '_indptr.npy', matrix.indptr)
+            else:
+                np.save(path + '.npy', matrix)
+
+        # another process may have written the same entry in the meantime
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries beyond max_entries, only
+        the entry directories named by key() are counted as the cache
+        directory may hold other files, e.g. the L_<thr>.npy of legacy.
+        """
+
+        entries = [
+            os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+            if self.is_entry(f)
+        ]
+        entries.sort(key=os.path.getmtime, reverse=True)
+
+        for entry_dir in entries[self.max_entries:]:
+            logging.debug('Localization cache evicted : %s' %
+                          (os.path.basename(entry_dir)))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def is_entry(self, name: str) -> bool:
+
+        return len(name) == 40 and all(
+            c in '0123456789abcdef' for c in name) and os.path.isdir(
+                os.path.join(self.cache_dir, name))
+
+
 def select_elements(array: np.ndarray, value: float, range: int) -> np.ndarray:
 
     bool_array = array > value
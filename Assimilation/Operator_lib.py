@@ -0,0 +1,229 @@
+'''
+Autor: Mijie Pang
+Date: 2024-04-28 09:20:47
+LastEditTime: 2024-04-28 16:41:05
+Description: observation operators as sparse matrices, H maps the flattened
+model grid (Ns) onto the observations (m), so the whole ensemble is taken
+into observation space by one sparse-dense product
+'''
+import os
+import sys
+import logging
+import numpy as np
+from scipy import sparse
+
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(main_dir)
+from tool.mapper import find_nearest_vector
+
+
+class ObservationOperator:
+
+    def __init__(self,
+                 method='nearest',
+                 index=None,
+                 radius=10,
+                 kernel='boxcar',
+                 **kwargs) -> None:
+        """
+        params:
+            method: "nearest", "bilinear" or "footprint".
+            index: MappingIndex of the stations, the nearest cells and the
+                   bilinear weights are looked up instead of searched.
+            radius: radius (km) of the satellite footprint.
+            kernel: weights inside the footprint, "boxcar" or "gaussian"
+                    (standard deviation of half the radius).
+        """
+
+        methods = {
+            'nearest': self.nearest,
+            'bilinear': self.bilinear,
+            'footprint': self.footprint,
+        }
+        if method not in methods.keys():
+            raise ValueError('Invalid operator method -> "%s" <-' % (method))
+        if kernel not in ('boxcar', 'gaussian'):
+            raise ValueError('Invalid footprint kernel -> "%s" <-' % (kernel))
+
+        self.method = method
+        self.methods = methods
+        self.index = index
+        self.radius = radius
+        self.kernel = kernel
+
+    ### *--- Method Portal ---* ###
+    def build(self, model_lon: np.ndarray, model_lat: np.ndarray,
+              obs_lon: np.ndarray, obs_lat: np.ndarray) -> sparse.csr_matrix:
+        """
+        params:
+            model_lon: model longitude, dim : Nlon
+            model_lat: model latitude, dim : Nlat
+            obs_lon: observation longitude, dim : m
+            obs_lat: observation latitude, dim : m
+
+        return:
+            H with the rows summing to 1, dim : m * Ns
+        """
+
+        model_lon = np.asarray(model_lon, dtype=float)
+        model_lat = np.asarray(model_lat, dtype=float)
+        obs_lon = np.asarray(obs_lon, dtype=float).reshape(-1)
+        obs_lat = np.asarray(obs_lat, dtype=float).reshape(-1)
+
+        shape = (len(obs_lon), len(model_lon) * len(model_lat))
+        if shape[0] == 0:
+            return sparse.csr_matrix(shape)
+
+        row, col, weight = self.methods.get(self.method)(model_lon, model_lat,
+                                                         obs_lon, obs_lat)
+
+        # the duplicated entries of the clipped corners are summed up
+        H = sparse.csr_matrix((weight, (row, col)), shape=shape)
+        H.eliminate_zeros()
+
+        logging.debug('%s operator built, %s non-zeros for %s observations' %
+                      (self.method, H.nnz, shape[0]))
+
+        return H
+
+    ### *--- the operators, (row, col, weight) of the entries ---* ###
+    def nearest(self, model_lon: np.ndarray, model_lat: np.ndarray,
+                obs_lon: np.ndarray, obs_lat: np.ndarray) -> tuple:
+
+        if self.index is None:
+            col = find_nearest_vector(obs_lat, model_lat) * len(model_lon) + \
+                find_nearest_vector(obs_lon, model_lon)
+        else:
+            col = self.index.nearest(obs_lon, obs_lat)
+
+        return np.arange(len(col)), col, np.ones(len(col))
+
+    def bilinear(self, model_lon: np.ndarray, model_lat: np.ndarray,
+                 obs_lon: np.ndarray, obs_lat: np.ndarray) -> tuple:
+
+        if self.index is None:
+            corners, weights = bilinear_weights(obs_lon, obs_lat, model_lon,
+                                                model_lat)
+        else:
+            corners, weights = self.index.bilinear(obs_lon, obs_lat)
+
+        row = np.repeat(np.arange(len(obs_lon)), 4)
+
+        return row, corners.reshape(-1), weights.reshape(-1)
+
+    def footprint(self, model_lon: np.ndarray, model_lat: np.ndarray,
+                  obs_lon: np.ndarray, obs_lat: np.ndarray) -> tuple:
+        """
+        Average of the grid cells with the centre inside the footprint, the
+        footprints smaller than a cell take the nearest cell. The grid is
+        assumed regular.
+        """
+
+        Nlon, Nlat = len(model_lon), len(model_lat)
+        res_lon = np.abs(np.mean(np.diff(model_lon)))
+        res_lat = np.abs(np.mean(np.diff(model_lat)))
+
+        # half width of the stencil in cells, wide enough at every latitude
+        radius_lat = self.radius / 111.2
+        radius_lon = radius_lat / max(
+            np.cos(np.deg2rad(np.max(np.abs(obs_lat)))), 0.1)
+        offset_lon = np.arange(-int(np.ceil(radius_lon / res_lon)),
+                               int(np.ceil(radius_lon / res_lon)) + 1)
+        offset_lat = np.arange(-int(np.ceil(radius_lat / res_lat)),
+                               int(np.ceil(radius_lat / res_lat)) + 1)
+        offset_lon, offset_lat = [
+            offset.reshape(1, -1)
+            for offset in np.meshgrid(offset_lon, offset_lat)
+        ]
+
+        # dim : m * stencil
+        i_lon = find_nearest_vector(obs_lon, model_lon)[:, np.newaxis] + \
+            offset_lon
+        i_lat = find_nearest_vector(obs_lat, model_lat)[:, np.newaxis] + \
+            offset_lat
+        inside = (i_lon >= 0) & (i_lon < Nlon) & (i_lat >= 0) & (i_lat < Nlat)
+        i_lon = np.clip(i_lon, 0, Nlon - 1)
+        i_lat = np.clip(i_lat, 0, Nlat - 1)
+
+        d_lat = (model_lat[i_lat] - obs_lat[:, np.newaxis]) * 111.2
+        d_lon = (model_lon[i_lon] - obs_lon[:, np.newaxis]) * 111.2 * \
+            np.cos(np.deg2rad(obs_lat[:, np.newaxis]))
+        distance = np.sqrt(d_lon**2 + d_lat**2)
+
+        if self.kernel == 'gaussian':
+            weight = np.exp(-2 * (distance / self.radius)**2)
+        else:
+            weight = np.ones(distance.shape)
+        weight = np.where(inside & (distance <= self.radius), weight, 0)
+
+        # the footprints missing every cell centre take the nearest cell
+        centre = (offset_lon == 0) & (offset_lat == 0)
+        weight[np.sum(weight, axis=1) == 0] = centre[0]
+
+        weight = weight / np.sum(weight, axis=1, keepdims=True)
+        valid = weight > 0
+
+        row = np.broadcast_to(np.arange(len(obs_lon))[:, np.newaxis],
+                              valid.shape)
+
+        return row[valid], (i_lat * Nlon + i_lon)[valid], weight[valid]
+
+
+### *--- bilinear interpolation on a regular grid ---* ###
+def bilinear_weights(lon: np.ndarray, lat: np.ndarray, model_lon: np.ndarray,
+                     model_lat: np.ndarray) -> tuple:
+    """
+    return:
+        flat index of the 4 surrounding grid cells and their weights,
+        dim : m * 4, the points out of the grid take the boundary values.
+    """
+
+    Nlon, Nlat = len(model_lon), len(model_lat)
+
+    i_lon = np.clip(np.searchsorted(model_lon, lon) - 1, 0, Nlon - 2)
+    i_lat = np.clip(np.searchsorted(model_lat, lat) - 1, 0, Nlat - 2)
+    w_lon = np.clip((lon - model_lon[i_lon]) /
+                    (model_lon[i_lon + 1] - model_lon[i_lon]), 0, 1)
+    w_lat = np.clip((lat - model_lat[i_lat]) /
+                    (model_lat[i_lat + 1] - model_lat[i_lat]), 0, 1)
+
+    corners = np.column_stack(
+        (i_lat * Nlon + i_lon, i_lat * Nlon + i_lon + 1,
+         (i_lat + 1) * Nlon + i_lon, (i_lat + 1) * Nlon + i_lon + 1))
+    weights = np.column_stack(
+        ((1 - w_lon) * (1 - w_lat), w_lon * (1 - w_lat), (1 - w_lon) * w_lat,
+         w_lon * w_lat))
+
+    return corners, weights
+
+
+### *--- take the ensemble into observation space ---* ###
+def apply(H: sparse.spmatrix, ensemble: np.ndarray) -> np.ndarray:
+    """
+    params:
+        H: observation operator, dim : m * Ns
+        ensemble: state with the flattened grid as the second last axis,
+                  e.g. Ns * Ne or Nlev * Ns * Ne.
+
+    return:
+        ensemble in observation space, e.g. m * Ne or Nlev * m * Ne
+    """
+
+    ensemble = np.asarray(ensemble)
+    if ensemble.ndim <= 2:
+        return np.asarray(H @ ensemble)
+
+    # all the leading axes go through the same product
+    shape = ensemble.shape
+    columns = np.moveaxis(ensemble, -2, 0).reshape(shape[-2], -1)
+    HX = np.asarray(H @ columns).reshape((H.shape[0], ) + shape[:-2] +
+                                         shape[-1:])
+
+    return np.moveaxis(HX, 0, -2)
+
+
+def stack(*H: sparse.spmatrix) -> sparse.csr_matrix:
+    """
+    Operator of several observation types assimilated together.
+    """
+    return sparse.vstack(H, format='csr')
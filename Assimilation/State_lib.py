@@ -0,0 +1,110 @@
+'''
+Autor: Mijie Pang
+Date: 2024-04-22 09:31:15
+LastEditTime: 2024-04-22 15:08:47
+Description: ensemble state stored in shared memory, so the readers,
+the analysis workers and the restart writers work on the same buffer
+'''
+import logging
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class EnsembleState:
+
+    def __init__(self,
+                 shape: tuple,
+                 dtype=np.float32,
+                 name=None,
+                 create=True,
+                 fill_value=0) -> None:
+        """
+        Ensemble array with the member as the last axis,
+        e.g. Nspec * Nlev * Nlat * Nlon * Ne.
+
+        params:
+            shape: shape of the ensemble array.
+            dtype: data type, float32 by default.
+            name: name of the shared memory block to attach to.
+            create: create a new block or attach to an existing one.
+            fill_value: initial value of a new block, None to leave it
+                        uninitialised.
+        """
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = create
+
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name,
+                                              create=create,
+                                              size=size)
+        self.name = self.shm.name
+
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+                                buffer=self.shm.buf)
+        if create:
+            if not fill_value is None:
+                self.array.fill(fill_value)
+            logging.debug('Shared ensemble state %s created, %.1f MB' %
+                          (self.name, size / 1024**2))
+
+    ### *--- only the name travels to the worker processes ---* ###
+    def __reduce__(self):
+        return (attach, (self.name, self.shape, self.dtype.str))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    ### *--- named views, no copy is made ---* ###
+    @property
+    def Ne(self) -> int:
+        return self.shape[-1]
+
+    def member(self, i_ensem: int) -> np.ndarray:
+        """
+        Field of one member, dim : shape[:-1]
+        """
+        return self.array[..., i_ensem]
+
+    def level(self, i_lev, axis=-4) -> np.ndarray:
+        """
+        Ensemble on one level with the horizontal grid flattened,
+        dim : [Nspec] * Ns * Ne, or on a slice of levels,
+        dim : [Nspec] * L * Ns * Ne
+        """
+        index = [slice(None)] * self.array.ndim
+        index[axis] = i_lev
+        level = self.array[tuple(index)]
+        level = level.reshape(level.shape[:-3] + (-1, self.Ne))
+
+        if not np.shares_memory(level, self.array):
+            raise ValueError('Level view of axis %s would copy the state' %
+                             (axis))
+
+        return level
+
+    def grid(self) -> np.ndarray:
+        """
+        Ensemble with the horizontal grid flattened, dim : ... * Ns * Ne
+        """
+        return self.array.reshape(self.shape[:-3] + (-1, self.Ne))
+
+    def mean(self, keepdims=True) -> np.ndarray:
+        return np.mean(self.array, axis=-1, keepdims=keepdims)
+
+    ### *--- release the shared memory ---* ###
+    def close(self) -> None:
+
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+### *--- attach to an existing state in another process ---* ###
+def attach(name: str, shape: tuple, dtype='<f4') -> EnsembleState:
+    return EnsembleState(shape, dtype=dtype, name=name, create=False)
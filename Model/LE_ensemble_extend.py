@@ -6,21 +6,19 @@ Description:
 '''
 import os
 import sys
-import time
 import logging
-import subprocess
 import numpy as np
-from datetime import datetime
 
 main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(main_dir)
 sys.path.append(os.path.join(main_dir, 'Model'))
 
 import system_lib as stl
-from tool.node import NodeScript, CheckNode
+from tool.node import CheckNode, NodeAllocator
 import Model_lib as mol
 import LE_model_lib as leml
 import LE_status_lib as lesl
+import Supervisor_lib as sul
 
 
 def main(Config: dict, **kwargs):
@@ -42,6 +40,9 @@ def main(Config: dict, **kwargs):
     model_scheme = Config['Model']['scheme']['name']
 
     core_demand = Config['Model']['node']['core_demand']
+    node_config = Config['Model']['node']
+    array_job = node_config.get('array_job', False)
+    allocator = NodeAllocator(check, **node_config)
     iteration_num = Config['Model'][model_scheme]['iteration_num']
 
     time_set = Config['Assimilation'][assi_scheme]['time_set']
@@ -59,6 +60,14 @@ def main(Config: dict, **kwargs):
     ### *--- start the ensemble model run ---* ###
 
     ### *--- prepare all the ensemble model scripts ---* ###
+    model_dir_sub = Config['Model'][model_scheme]['path'][
+        'model_path'] + '_sub/' + Config['Model'][model_scheme]['run_project']
+    template = mol.SubDirTemplate(
+        model_dir=Config['Model'][model_scheme]['path']['model_path'],
+        model_dir_sub=model_dir_sub,
+        **Config['Model'][model_scheme].get('provision', {}))
+    template.build()
+
     sub_dirs = []
     run_count = 0
     logging.info('Creating sub-directories')
@@ -67,14 +76,7 @@ def main(Config: dict, **kwargs):
         ### *--- create model sub directories ---* ###
         for i_ensemble in range(len(run_ids[i_time])):
 
-            sub_dirs.append(
-                mol.copy_from_source(
-                    model_dir=Config['Model'][model_scheme]['path']
-                    ['model_path'],
-                    model_dir_sub=Config['Model'][model_scheme]['path']
-                    ['model_path'] + '_sub/' +
-                    Config['Model'][model_scheme]['run_project'],
-                    run_id=run_ids[i_time][i_ensemble]))
+            sub_dirs.append(template.materialise(run_ids[i_time][i_ensemble]))
 
             ### *--- configure the model ---* ###
             leml.LOTOS_EUROS_Configure_dict(
@@ -115,132 +117,35 @@ def main(Config: dict, **kwargs):
 
         logging.info('### run model by batch ###')
 
-        run_id_flat = np.ravel(np.array(run_ids))
-
-        # 0 for ready, 10 for submitted, 20 for running, 100 for finished
-        ensemble_status_dict = {
-            run_id_flat[i_run]: {
-                'status': 0,
-                'run_dir': sub_dirs[i_run],
-                # 'progress': None
-            }
-            for i_run in range(len(run_id_flat))
-        }
-
-        node_id = int(Config['Model']['node']['core_demand'])
-        occupied_core_num = 1
-        retry_count = 0
-
-        while len(ensemble_status_dict) > 0:
-
-            ### *--- loop over all remaining ensembles ---* ###
-            delete_index = []
-            # print(ensemble_status_dict.keys())
-            for i_run, run_id in enumerate(ensemble_status_dict):
-
-                ### *--- Stage 1: submit the model to node ---* ###
-                flag1 = ensemble_status_dict[run_id]['status'] == 0
-                flag2 = occupied_core_num <= Config['Model']['node'][
-                    'max_core_num']
-                if flag1 and flag2:
-
-                    if Config['Model']['node']['auto_node_selection']:
-
-                        node_id = check.query(demand=core_demand,
-                                              random_choice=True,
-                                              **Config['Model']['node'])
-
-                    ### *--- prepare the node submission script ---* ###
-                    submission = NodeScript(
-                        path='%s/launcher-server' %
-                        (ensemble_status_dict[run_id]['run_dir']),
-                        node_id=node_id,
-                        core_demand=core_demand,
-                        job_name=run_id,
-                        out_file='log/%s.out.log' % (run_id),
-                        error_file='log/%s.err.log' % (run_id),
-                        management=Config['Info']['Machine']['management'])
-                    submission.add(
-                        'export zijin_dir="/home/pangmj"',
-                        '. ' + Config['Model'][model_scheme]['path']
-                        ['model_bashrc_path'],
-                        'export LD_LIBRARY_PATH="/home/jinjb/TNO/lotos-euros/v2.1_dust2021_ensemble/tools:$LD_LIBRARY_PATH"',
-                        './launcher-radiation -n')
-                    submit_command = submission.get_command()
-
-                    ### *--- submit to the node ---* ###
-                    os.chdir(ensemble_status_dict[run_id]['run_dir'])
-                    command = os.system('. ' + Config['Model'][model_scheme]
-                                        ['path']['model_bashrc_path'])
-                    command = os.system(submit_command)
-
-                    logging.info('%s submitted to node %s' % (run_id, node_id))
-
-                    occupied_core_num += core_demand
-                    # set the submitted status
-                    ensemble_status_dict[run_id]['status'] = 10
-                    # time.sleep(5)
-
-                ### *--- Stage 2: make sure the model has started ---* ###
-                elif ensemble_status_dict[run_id]['status'] == 10:
-
-                    if os.path.exists(ensemble_status_dict[run_id]['run_dir'] +
-                                      '/log/' + run_id + '.out.log'):
-                        # set the running status
-                        ensemble_status_dict[run_id]['status'] = 20
-
-                ### *--- Stage 3: wait for the model to finish and retry when failed ---* ###
-                elif ensemble_status_dict[run_id]['status'] == 20:
-
-                    log_file_path = '%s/log/%s.out.log' % (
-                        ensemble_status_dict[run_id]['run_dir'], run_id)
-                    Finished_flag, Error_flag = lesl.check_model_log(
-                        log_path=log_file_path)
-
-                    ### *--- ERROR process ---* ###
-                    if Error_flag:
-
-                        logging.error(
-                            'error happened in %s, reset to ready mode' %
-                            (run_id))
-
-                        # rename and save the log file or just delete it
-                        log_file_moved = os.path.join(
-                            log_trash_dir, '%s$error.%s.log' %
-                            (datetime.now().strftime('%Y%m%d_%H%M%S'), run_id))
-                        subprocess.run(['mv', log_file_path, log_file_moved])
-
-                        # set the status
-                        ensemble_status_dict[run_id]['status'] = 0
-                        occupied_core_num -= core_demand
-                        retry_count += 1
-
-                    ### *--- SUCCESS process ---* ###
-                    elif Finished_flag:
-
-                        logging.info('%s finished successfully' % (run_id))
-
-                        ### rename and save the log file or just delete it ###
-                        # log_file_moved = log_trash_dir + '/' + run_id + '.out$' + datetime.now(
-                        # ).strftime('%Y%m%d_%H%M%S') + '.log'
-                        # subprocess.run(['mv', log_file_path, log_file_moved])
-                        # os.remove(log_file_path)
-
-                        ### set the status ###
-                        ensemble_status_dict[run_id]['status'] = 100
-                        occupied_core_num -= core_demand
-                        delete_index.append(run_id)
-
-            ### *--- abort the project when the maximum retry is reached ---* ###
-            if retry_count > Config['Model'][model_scheme]['max_retry']:
-                logging.error('maximum retry reached, system aborted')
-                sys.exit(1)
-
-            ### *--- remove the finished ensembles ---* ###
-            [ensemble_status_dict.pop(idx) for idx in delete_index]
-
-            ### *--- take a snap ---* ###
-            time.sleep(5)
+        supervisor = sul.EnsembleSupervisor(
+            run_dirs=dict(zip(np.ravel(np.array(run_ids)), sub_dirs)),
+            commands=[
+                'export zijin_dir="/home/pangmj"', '. ' +
+                Config['Model'][model_scheme]['path']['model_bashrc_path'],
+                'export LD_LIBRARY_PATH="/home/jinjb/TNO/lotos-euros/v2.1_dust2021_ensemble/tools:$LD_LIBRARY_PATH"',
+                './launcher-radiation -n'
+            ],
+            watcher=lesl.ModelWatcher(**Config['Model'].get('watch', {})),
+            management=Config['Info']['Machine']['management'],
+            allocator=allocator
+            if node_config['auto_node_selection'] else None,
+            node_id=int(node_config['node_id']),
+            core_demand=core_demand,
+            max_core_num=node_config['max_core_num'],
+            max_retry=Config['Model'][model_scheme]['max_retry'],
+            array={
+                'path': '%s/launcher-array' % (model_dir_sub),
+                'job_name': 'i_%02d_array' % (iteration_num),
+                'out_file':
+                '%s/i_%02d_array.log' % (log_trash_dir, iteration_num),
+            } if array_job else None,
+            log_trash_dir=log_trash_dir,
+            **Config['Model'].get('supervisor', {}))
+
+        ### *--- abort the project when the maximum retry is reached ---* ###
+        if not supervisor.run():
+            logging.error('ensemble run failed, system aborted')
+            sys.exit(1)
 
     ### *--- update the finished status ---* ###
     os.chdir(home_dir)
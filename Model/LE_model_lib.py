@@ -8,6 +8,80 @@ import os
 import numpy as np
 
 
+### *--- parsed rc or source file rendered with the overrides ---* ###
+class ConfigTemplate:
+
+    def __init__(self, path: str) -> None:
+
+        with open(path, 'r') as file:
+            self.lines = file.readlines()
+
+        # key -> line numbers of the "key : value" lines
+        self.index = {}
+        for i_line, line in enumerate(self.lines):
+            if not line.startswith(('!', '#')) and ':' in line:
+                key = line.split(':')[0].strip()
+                self.index.setdefault(key, []).append(i_line)
+
+        self.prefixes = {}
+
+    def find(self, prefix: str) -> list:
+        """
+        Line numbers of the lines starting with the prefix
+        """
+
+        if not prefix in self.prefixes.keys():
+            self.prefixes[prefix] = [
+                i_line for i_line, line in enumerate(self.lines)
+                if line.startswith(prefix)
+            ]
+
+        return self.prefixes[prefix]
+
+    def render(self, keys={}, lines={}) -> list:
+        """
+        params:
+            keys: {key: value} of the rc lines.
+            lines: {line number: new line} of the other lines.
+        """
+
+        code = self.lines.copy()
+
+        for key, value in keys.items():
+            for i_line in self.index.get(key, []):
+                code[i_line] = '%s:  %s\n' % (code[i_line].split(':')[0],
+                                              value)
+
+        for i_line, line in lines.items():
+            code[i_line] = line
+
+        return code
+
+    def write(self, path: str, keys={}, lines={}) -> None:
+
+        # a single atomic write, also breaks the link to the template
+        tmp_path = '%s.tmp%s' % (path, os.getpid())
+        with open(tmp_path, 'w') as file:
+            file.writelines(self.render(keys, lines))
+        os.replace(tmp_path, path)
+
+
+### *--- the members share the parse of an unchanged copy ---* ###
+config_templates = {}
+
+
+def get_template(path: str) -> ConfigTemplate:
+
+    # the member copies keep the name, size and mtime of the template
+    file_stat = os.stat(path)
+    key = (os.path.basename(path), file_stat.st_size, file_stat.st_mtime_ns)
+
+    if not key in config_templates.keys():
+        config_templates[key] = ConfigTemplate(path)
+
+    return config_templates[key]
+
+
 def LOTOS_EUROS_Configure(
     le_dir: str,
     i_ensemble: int,
@@ -80,49 +154,55 @@ def LOTOS_EUROS_Configure_dict(
     ### *----------------------------------* ###
     ### *---     edit the .rc files     ---* ###
 
-    ### *--- edit the lotos-euros.rc file ---* ####
-    # open the lotos-euros.rc
-    with open('%s/rc/lotos-euros.rc' % (project_dir), 'r') as file:
-        code = file.readlines()
-
-    ### *--- modify the configure according to the config_dict ---* ###
-    for line in range(len(code)):
+    # config_dict goes to lotos-euros.rc, overridden by the rc dicts
+    rc_dicts = {
+        rc_file: rc_dict
+        for rc_file, rc_dict in kwargs.items() if isinstance(rc_dict, dict)
+    }
+    rc_dicts['lotos-euros.rc'] = {
+        **config_dict,
+        **rc_dicts.get('lotos-euros.rc', {})
+    }
 
-        if not code[line].startswith(('!', '#')):
+    ### *--- all the keys of a file in one pass ---* ###
+    for rc_file, rc_dict in rc_dicts.items():
 
-            LE_key = code[line].split(' ')[0]
-            if LE_key in config_dict.keys():
-                code[line] = '%s:  %s\n' % (''.join(
-                    code[line].split(':')[0]), config_dict[LE_key])
+        rc_path = '%s/rc/%s' % (project_dir, rc_file)
+        if os.path.exists(rc_path):
+            get_template(rc_path).write(rc_path, keys=rc_dict)
 
-            if LE_key in kwargs['lotos-euros.rc'].keys():
-                code[line] = '%s:  %s\n' % (''.join(code[line].split(':')[0]),
-                                            kwargs['lotos-euros.rc'][LE_key])
 
-    # write everything back
-    with open('%s/rc/lotos-euros.rc' % (project_dir), 'w') as file:
-        file.writelines(code)
+### *--- configure all the members from one parse ---* ###
+def LOTOS_EUROS_Configure_batch(project_dirs: list, config_dicts: list,
+                                **kwargs) -> None:
+    """
+    params:
+        project_dirs: project directory of every member, their rc files
+                      are the same copies of the template.
+        config_dicts: lotos-euros.rc settings of every member.
+        kwargs: {rc file: settings} shared by all the members.
+    """
 
-    ### *--- edit some other files ---* ###
-    for rc_file in kwargs.keys():
-        if os.path.exists('%s/rc/%s' % (project_dir, rc_file)):
+    rc_dicts = {
+        rc_file: rc_dict
+        for rc_file, rc_dict in kwargs.items() if isinstance(rc_dict, dict)
+    }
+    rc_files = set(rc_dicts.keys()) | {'lotos-euros.rc'}
 
-            with open('%s/rc/%s' % (project_dir, rc_file), 'r') as file:
-                code = file.readlines()
+    for rc_file in rc_files:
 
-            ### *--- modify the configure according to the dict ---* ###
-            for line in range(len(code)):
+        rc_path = '%s/rc/%s' % (project_dirs[0], rc_file)
+        if not os.path.exists(rc_path):
+            continue
+        template = ConfigTemplate(rc_path)
 
-                if not code[line].startswith(('!', '#')):
+        for project_dir, config_dict in zip(project_dirs, config_dicts):
 
-                    LE_key = code[line].split(' ')[0]
-                    if LE_key in kwargs[rc_file].keys():
-                        code[line] = '%s:  %s\n' % (''.join(
-                            code[line].split(':')[0]), kwargs[rc_file][LE_key])
+            keys = rc_dicts.get(rc_file, {})
+            if rc_file == 'lotos-euros.rc':
+                keys = {**config_dict, **keys}
 
-            # write everything back
-            with open('%s/rc/%s' % (project_dir, rc_file), 'w') as file:
-                file.writelines(code)
+            template.write('%s/rc/%s' % (project_dir, rc_file), keys=keys)
 
     # ### *--------------------------------------* ###
     # ### *---      edit the source files     ---* ###
@@ -164,51 +244,38 @@ def LOTOS_EUROS_dust_emis(project_dir: str,
                           year=None) -> None:
 
     ### *--- edit the dust emission file ---* ###
-
-    with open('%s/src/le_emis_dust_wind.F90' % (project_dir), 'r') as file:
-        code = file.readlines()
+    F90_path = '%s/src/le_emis_dust_wind.F90' % (project_dir)
+    template = get_template(F90_path)
 
     ### *--- input the pertubated dust emission field ---* ###
-    for line in np.arange(1000, 1100):  # approximated range
-
-        if code[line][0:23] == "       open(unit=3,file":
-
-            code[
-                line] = "       open(unit=3,file='/home/pangmj/Data/pyFilter/emission_map/emis_iteration/emis_iter_%02d/emis_ensem_%02d/'&\n" % (
-                    iteration_num, i_ensemble)
-
-        if not year is None:
-            if code[line].startswith("                     //'emis_map_"):
-                code[
-                    line] = "                     //'emis_map_%s_'//time_indice_str//'.csv', action='read')" % (
-                        year)
-            if code[line].startswith("                     //'emis_length_"):
-                code[
-                    line] = "                     //'emis_length_%s_'//time_indice_str//'.csv', action='read')" % (
-                        year)
+    lines = {}
+    for i_line in template.find("       open(unit=3,file"):
+        lines[i_line] = "       open(unit=3,file='/home/pangmj/Data/pyFilter/emission_map/emis_iteration/emis_iter_%02d/emis_ensem_%02d/'&\n" % (
+            iteration_num, i_ensemble)
+
+    if not year is None:
+        for i_line in template.find("                     //'emis_map_"):
+            lines[i_line] = "                     //'emis_map_%s_'//time_indice_str//'.csv', action='read')\n" % (
+                year)
+        for i_line in template.find("                     //'emis_length_"):
+            lines[i_line] = "                     //'emis_length_%s_'//time_indice_str//'.csv', action='read')\n" % (
+                year)
 
     # and write everything back
-    with open('%s/src/le_emis_dust_wind.F90' % (project_dir), 'w') as file:
-        file.writelines(code)
+    template.write(F90_path, lines=lines)
 
 
 ### *--- add the ensemble meteo file into the model ---* ###
 def LOTOS_EUROS_meteo_config(base_dir: str, meteo_num: int) -> None:
 
     ### *--- edit the lotos-euros-meteo-ecmwf.rc file ---* ####
-    # open the lotos-euros-meteo-ecmwf.rc
-    with open('%s/rc/lotos-euros-meteo-ecmwf.rc' % (base_dir), 'r') as file:
-        code = file.readlines()
-
-    for i_line in range(len(code)):
-        if code[i_line].startswith('my.mf.dir'):
-            code[
-                i_line] = 'my.mf.dir           :  ${my.leip.dir}/ECMWF/od/ensm%02d/0001\n' % (
-                    meteo_num)
-
-    # and write everything back
-    with open('%s/rc/lotos-euros-meteo-ecmwf.rc' % (base_dir), 'w') as file:
-        file.writelines(code)
+    rc_path = '%s/rc/lotos-euros-meteo-ecmwf.rc' % (base_dir)
+    get_template(rc_path).write(
+        rc_path,
+        keys={
+            'my.mf.dir':
+            '${my.leip.dir}/ECMWF/od/ensm%02d/0001' % (meteo_num)
+        })
 
 
 # ### *--- add the ensemble meteo file into the model ---* ###
@@ -6,7 +6,6 @@ Description:
 '''
 import os
 import sys
-import time
 import logging
 
 main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -14,11 +13,12 @@ sys.path.append(main_dir)
 sys.path.append(os.path.join(main_dir, 'Model'))
 
 import system_lib as stl
-from tool.node import NodeScript, CheckNode
+from tool.node import CheckNode, NodeAllocator
 
 import Model_lib as mol
 import LE_model_lib as leml
 import LE_status_lib as lesl
+import Supervisor_lib as sul
 
 
 def main(Config: dict, **kwargs):
@@ -44,9 +44,9 @@ def main(Config: dict, **kwargs):
     le_dir = Config['Model'][model_scheme]['path']['model_path']
     le_dir_sub = Config['Model'][model_scheme]['path']['model_path'] + '_sub'
 
-    mol.copy_from_source(model_dir=le_dir,
-                         model_dir_sub=le_dir_sub,
-                         run_id=run_id)
+    le_dir_sub = mol.copy_from_source(model_dir=le_dir,
+                                      model_dir_sub=le_dir_sub,
+                                      run_id=run_id)
 
     ### *--- edit the model configuration ---* ###
     leml.LOTOS_EUROS_Configure_dict(
@@ -74,55 +74,29 @@ def main(Config: dict, **kwargs):
         leml.LOTOS_EUROS_meteo_config(base_dir=le_dir_sub + '/base/001',
                                       meteo_num=1)
 
-    ### *--- select node ---* ###
-    core_demand = Config['Model']['node']['core_demand']
-    node_id = int(Config['Model']['node']['node_id'])
-    if Config['Model']['node']['auto_node_selection']:
-        node_id = check_node.query(demand=core_demand,
-                                   random_choice=True,
-                                   **Config['Model']['node'])
-
-    ### *--- prepare submit script ---* ###
-    submission = NodeScript(path='%s/launcher-server' % (le_dir_sub),
-                            node_id=node_id,
-                            core_demand=core_demand,
-                            job_name=run_id,
-                            out_file='log/%s.out.log' % (run_id),
-                            error_file='log/%s.err.log' % (run_id),
-                            management=Config['Info']['Machine']['management'])
-    submission.add(
-        'export zijin_dir="/home/pangmj"',
-        '. ' + Config['Model'][model_scheme]['path']['model_bashrc_path'],
-        'export LD_LIBRARY_PATH="/home/jinjb/TNO/lotos-euros/v2.1_dust2021_ensemble/tools:$LD_LIBRARY_PATH"',
-        './launcher-radiation -n')
-    submit_command = submission.get_command()
-
     ### *--- run the model ---* ###
-    os.chdir(le_dir_sub)
-    command = os.system(
-        '. ' + Config['Model'][model_scheme]['path']['model_bashrc_path'])
-    command = os.system(submit_command)
-
-    logging.info('%s submitted to node %s' % (run_id, node_id))
-
-    log_file_path = '%s/log/%s.out.log' % (le_dir_sub, run_id)
-    Finished_flag, Error_flag = False, False
-    while not Finished_flag or not Error_flag:
-
-        Finished_flag, Error_flag = lesl.check_model_log(
-            log_path=log_file_path)
-
-        ### *--- ERROR process ---* ###
-        # if error happened, reset the ensemble to ready mode
-        if Error_flag:
-            logging.warning('%s error happened' % (run_id))
-
-        ### *--- SUCCESS process ---* ###
-        # if it is finished secessfully, release the occupied core
-        elif Finished_flag:
-            logging.info('%s finished successfully' % (run_id))
-
-        time.sleep(5)
+    node_config = Config['Model']['node']
+    supervisor = sul.EnsembleSupervisor(
+        run_dirs={run_id: le_dir_sub},
+        commands=[
+            'export zijin_dir="/home/pangmj"',
+            '. ' + Config['Model'][model_scheme]['path']['model_bashrc_path'],
+            'export LD_LIBRARY_PATH="/home/jinjb/TNO/lotos-euros/v2.1_dust2021_ensemble/tools:$LD_LIBRARY_PATH"',
+            './launcher-radiation -n'
+        ],
+        watcher=lesl.ModelWatcher(**Config['Model'].get('watch', {})),
+        management=Config['Info']['Machine']['management'],
+        allocator=NodeAllocator(check_node, **node_config)
+        if node_config['auto_node_selection'] else None,
+        node_id=int(node_config['node_id']),
+        core_demand=node_config['core_demand'],
+        max_retry=Config['Model'][model_scheme]['max_retry'],
+        log_trash_dir=Config['Info']['path']['output_path'] + '/log',
+        **Config['Model'].get('supervisor', {}))
+
+    if not supervisor.run():
+        logging.error('%s failed, system aborted' % (run_id))
+        sys.exit(-1)
 
     ### *--- update the finished status ---* ###
     os.chdir(home_dir)
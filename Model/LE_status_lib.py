@@ -5,26 +5,35 @@ LastEditTime: 2024-03-04 22:14:35
 Description: 
 '''
 import os
-import subprocess
+import time
+import ctypes
+import struct
+import logging
+import ctypes.util
 import pandas as pd
 from datetime import datetime
 
+finish_mark = ('[INFO    ] End of script at', '[INFO    ] ** end **',
+               '*** end of simulation reached')
+error_mark = ('[ERROR   ] exception', 'subprocess.CalledProcessError:',
+              'ERROR:root:exception')
+
 
 def check_model_log(log_path: str, depth=10) -> list:
 
     Finished_flag = False
     Error_flag = False
-    finish_mark = ('[INFO    ] End of script at', '[INFO    ] ** end **',
-                   '*** end of simulation reached')
-    error_mark = ('[ERROR   ] exception', 'subprocess.CalledProcessError:',
-                  'ERROR:root:exception')
 
-    result = subprocess.run(['tail', '-n', str(depth), log_path],
-                            capture_output=True,
-                            text=True)
-    output = result.stdout.split('\n')
+    # read the last lines from the end instead of calling tail
+    try:
+        with open(log_path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(file.tell() - 256 * depth, 0))
+            output = file.read().decode(errors='replace').split('\n')
+    except FileNotFoundError:
+        output = []
 
-    for line in output:
+    for line in output[-depth - 1:]:
         if line.startswith(finish_mark):
             Finished_flag = True
         elif line.startswith(error_mark):
@@ -33,6 +42,245 @@ def check_model_log(log_path: str, depth=10) -> list:
     return Finished_flag, Error_flag
 
 
+### *--- follow a growing log file by its offset ---* ###
+class LogTail:
+
+    def __init__(self, path: str) -> None:
+
+        self.path = path
+        self.offset = 0
+        self.inode = None
+        self.partial = b''
+
+    def exists(self) -> bool:
+        return not self.inode is None
+
+    def read_lines(self) -> list:
+        """
+        The complete lines appended since the last read.
+        """
+
+        try:
+            file_stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.inode = None
+            return []
+
+        # the log is moved away or rewritten, e.g. by a retry
+        if file_stat.st_ino != self.inode or file_stat.st_size < self.offset:
+            self.inode = file_stat.st_ino
+            self.offset = 0
+            self.partial = b''
+
+        if file_stat.st_size == self.offset:
+            return []
+
+        with open(self.path, 'rb') as file:
+            file.seek(self.offset)
+            data = self.partial + file.read(file_stat.st_size - self.offset)
+        self.offset = file_stat.st_size
+
+        lines = data.split(b'\n')
+        self.partial = lines.pop()
+
+        return [line.decode(errors='replace') for line in lines]
+
+    def reset(self) -> None:
+
+        self.offset = 0
+        self.inode = None
+        self.partial = b''
+
+
+### *--- minimal inotify binding, None where it is not available ---* ###
+class Inotify:
+
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+
+    def __init__(self) -> None:
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.watches = {}
+
+    def add(self, directory: str) -> None:
+
+        if directory in self.watches.values():
+            return
+
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | \
+            self.IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),
+                          'inotify_add_watch failed on %s' % (directory))
+        self.watches[wd] = directory
+
+    def read(self) -> set:
+        """
+        Paths changed since the last read.
+        """
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+
+            i_byte = 0
+            while i_byte < len(data):
+                wd, mask, cookie, length = struct.unpack_from(
+                    'iIII', data, i_byte)
+                name = data[i_byte + 16:i_byte + 16 + length].rstrip(b'\0')
+                i_byte += 16 + length
+                if wd in self.watches.keys():
+                    changed.add(
+                        os.path.join(self.watches[wd], name.decode()))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+### *--- watch the logs and restart files of all the members ---* ###
+class ModelWatcher:
+
+    def __init__(self, method='auto', full_interval=30) -> None:
+        """
+        params:
+            method: "inotify", "poll" or "auto" for inotify if available.
+            full_interval: seconds between two full checks with inotify,
+                           the writes on a network file system from other
+                           hosts are not notified.
+        """
+
+        methods = ('auto', 'inotify', 'poll')
+        if method not in methods:
+            raise ValueError('Invalid watch method -> "%s" <-' % (method))
+
+        self.inotify = None
+        if method in ('auto', 'inotify'):
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError, TypeError) as error:
+                if method == 'inotify':
+                    raise
+                logging.debug('inotify not available : %s' % (error))
+
+        self.full_interval = full_interval
+        self.full_time = 0.
+        self.members = {}
+        self.states = {}
+
+    def add(self, run_id: str, run_dir: str, restart_files=()) -> None:
+        """
+        params:
+            run_id: member to watch.
+            run_dir: the model log is run_dir/log/run_id.out.log
+            restart_files: restart files in the order of production.
+        """
+
+        log_path = '%s/log/%s.out.log' % (run_dir, run_id)
+        self.members[run_id] = {
+            'tail': LogTail(log_path),
+            'restart_files': list(restart_files),
+            'progress': 0,
+        }
+        self.states[run_id] = 'waiting'
+
+        if not self.inotify is None:
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            self.inotify.add(os.path.dirname(log_path))
+            for path in {os.path.dirname(f) for f in restart_files}:
+                if os.path.isdir(path):
+                    self.inotify.add(path)
+
+    def reset(self, run_id: str) -> None:
+
+        self.members[run_id]['tail'].reset()
+        self.states[run_id] = 'waiting'
+
+    def remove(self, run_id: str) -> None:
+
+        self.members.pop(run_id, None)
+        self.states.pop(run_id, None)
+
+    ### *--- state transitions since the last poll ---* ###
+    def poll(self) -> list:
+        """
+        return:
+            [(run_id, event, value)], event is "started", "progress" with
+            the number of restart files produced, "finished" or "error".
+        """
+
+        run_ids = self.members.keys()
+        if not self.inotify is None and \
+                time.time() - self.full_time < self.full_interval:
+            changed = self.inotify.read()
+            run_ids = [
+                run_id for run_id, member in self.members.items()
+                if member['tail'].path in changed or any(
+                    path in changed for path in member['restart_files']
+                    [member['progress']:member['progress'] + 1])
+            ]
+        else:
+            if not self.inotify is None:
+                self.inotify.read()
+            self.full_time = time.time()
+
+        events = []
+        for run_id in list(run_ids):
+            events += self.check(run_id)
+
+        return events
+
+    def check(self, run_id: str) -> list:
+
+        member = self.members[run_id]
+        if self.states[run_id] in ('finished', 'error'):
+            return []
+
+        events = []
+        lines = member['tail'].read_lines()
+
+        if self.states[run_id] == 'waiting' and member['tail'].exists():
+            self.states[run_id] = 'running'
+            events.append((run_id, 'started', None))
+
+        # only the next restart file is looked for
+        progress = member['progress']
+        while progress < len(member['restart_files']) and os.path.exists(
+                member['restart_files'][progress]):
+            progress += 1
+        if progress > member['progress']:
+            member['progress'] = progress
+            events.append((run_id, 'progress', progress))
+
+        for line in lines:
+            if line.startswith(error_mark):
+                self.states[run_id] = 'error'
+                events.append((run_id, 'error', line))
+                break
+            elif line.startswith(finish_mark):
+                self.states[run_id] = 'finished'
+                events.append((run_id, 'finished', None))
+                break
+
+        return events
+
+    def close(self) -> None:
+
+        if not self.inotify is None:
+            self.inotify.close()
+
+
 class StatusReporter:
 
     def __init__(self, start_time: str, end_time: str, interval: str,
@@ -52,10 +300,10 @@ class StatusReporter:
     def check_restart(self, ) -> int:
 
         ### start from the next not producted files ###
-        for time in self.run_time_range[self.progress_index + 1:]:
+        for run_time in self.run_time_range[self.progress_index + 1:]:
 
             restart_file = '%s/restart/LE_%s_state_%s.nc' % (
-                self.run_dir, self.run_id, time.strftime('%Y%m%d_%H%M'))
+                self.run_dir, self.run_id, run_time.strftime('%Y%m%d_%H%M'))
 
             if os.path.exists(restart_file):
 
@@ -111,8 +359,6 @@ class StatusReporter:
 
 if __name__ == '__main__':
 
-    import time
-
     SR = StatusReporter(
         '2023-03-01 00:00', '2023-05-31 23:00', '1H',
         '/home/pangmj/TNO/scratch/projects/Reanalysis/beta072_2023_background',
@@ -1,10 +1,15 @@
 '''
 Autor: Mijie Pang
 Date: 2023-04-22 16:32:34
-LastEditTime: 2024-03-05 08:50:14
+LastEditTime: 2024-04-25 10:12:40
 Description: This is the library for the universal model operation
 '''
 import os
+import stat
+import shutil
+import fnmatch
+import logging
+import subprocess
 
 
 ### *--- create sub model project ---* ###
@@ -19,3 +24,185 @@ def copy_from_source(model_dir: str, model_dir_sub: str, run_id: str) -> str:
     command = os.system('rsync -a ' + model_dir + '/* ' + sub_dir)
 
     return sub_dir
+
+
+### *--- sub model projects materialised from one template ---* ###
+class SubDirTemplate:
+
+    def __init__(self,
+                 model_dir: str,
+                 model_dir_sub: str,
+                 method='hardlink',
+                 mutable=('*.rc', '*.F90', 'launcher*'),
+                 clean=('log', ),
+                 **kwargs) -> None:
+        """
+        The model source is synchronised into a template once per cycle,
+        every sub-directory links to the template and persists across the
+        cycles. Only the files edited per member are real copies.
+
+        params:
+            model_dir: the model source directory.
+            model_dir_sub: directory of the sub-directories.
+            method: "hardlink", "reflink", "symlink" or "copy".
+            mutable: patterns of the files edited or written in place, they
+                     are copied from the template on every materialisation.
+            clean: directories emptied on every materialisation.
+        """
+
+        methods = {
+            'hardlink': self.hardlink,
+            'reflink': self.reflink,
+            'symlink': self.symlink,
+            'copy': self.copy,
+        }
+        if method not in methods.keys():
+            raise ValueError('Invalid provision method -> "%s" <-' % (method))
+
+        self.model_dir = model_dir
+        self.model_dir_sub = model_dir_sub
+        self.template_dir = os.path.join(model_dir_sub, '.template')
+        self.method = method
+        self.methods = methods
+        self.mutable = mutable
+        self.clean = clean
+
+        self.entries = []
+
+    ### *--- synchronise the template with the model source ---* ###
+    def build(self) -> None:
+
+        os.makedirs(self.template_dir, exist_ok=True)
+        subprocess.run(
+            ['rsync', '-a', '--no-perms', '--executability', '--delete'] +
+            ['--exclude=/%s/' % (path) for path in self.clean] +
+            [self.model_dir + '/', self.template_dir + '/'],
+            check=True)
+
+        # index of the template, the linked files are read-only so that
+        # writing through a link fails instead of changing every member
+        self.entries = []
+        for root, dirs, files in os.walk(self.template_dir):
+
+            rel_root = os.path.relpath(root, self.template_dir)
+            for name in list(dirs):
+                if os.path.islink(os.path.join(root, name)):
+                    dirs.remove(name)
+                    files.append(name)
+                else:
+                    self.entries.append(
+                        ('dir', os.path.normpath(os.path.join(rel_root,
+                                                              name))))
+
+            for name in files:
+
+                path = os.path.join(root, name)
+                rel_path = os.path.normpath(os.path.join(rel_root, name))
+
+                if os.path.islink(path):
+                    self.entries.append(('link', rel_path))
+                elif any(
+                        fnmatch.fnmatch(name, pattern)
+                        for pattern in self.mutable):
+                    self.entries.append(('mutable', rel_path))
+                else:
+                    self.entries.append(('file', rel_path))
+                    mode = os.stat(path).st_mode
+                    if mode & 0o222:
+                        os.chmod(path, stat.S_IMODE(mode) & ~0o222)
+
+        logging.debug('Template of %s entries built in %s' %
+                      (len(self.entries), self.template_dir))
+
+    ### *--- create or update one sub-directory ---* ###
+    def materialise(self, run_id: str) -> str:
+
+        if not self.entries:
+            self.build()
+
+        sub_dir = os.path.join(self.model_dir_sub, run_id)
+        os.makedirs(sub_dir, exist_ok=True)
+
+        for kind, rel_path in self.entries:
+
+            src = os.path.join(self.template_dir, rel_path)
+            dst = os.path.join(sub_dir, rel_path)
+
+            if kind == 'dir':
+                os.makedirs(dst, exist_ok=True)
+            elif kind == 'link':
+                target = os.readlink(src)
+                if not (os.path.islink(dst) and os.readlink(dst) == target):
+                    replace(dst, lambda tmp: os.symlink(target, tmp))
+            elif kind == 'mutable':
+                replace(dst, lambda tmp: shutil.copy2(src, tmp))
+            else:
+                self.methods.get(self.method)(src, dst)
+
+        for path in self.clean:
+            shutil.rmtree(os.path.join(sub_dir, path), ignore_errors=True)
+            os.makedirs(os.path.join(sub_dir, path))
+
+        return sub_dir
+
+    ### *--- materialisation methods of the unchanged files ---* ###
+    def hardlink(self, src: str, dst: str) -> None:
+
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+
+        try:
+            replace(dst, lambda tmp: os.link(src, tmp))
+        except OSError:
+            # e.g. the template on another file system
+            logging.warning('Hard link failed in %s, copy instead' % (dst))
+            self.method = 'copy'
+            self.copy(src, dst)
+
+    def reflink(self, src: str, dst: str) -> None:
+
+        if up_to_date(src, dst):
+            return
+
+        replace(
+            dst, lambda tmp: subprocess.run(
+                ['cp', '--reflink=auto', '--preserve=all', src, tmp],
+                check=True))
+
+    def symlink(self, src: str, dst: str) -> None:
+
+        if os.path.islink(dst) and os.readlink(dst) == src:
+            return
+
+        replace(dst, lambda tmp: os.symlink(src, tmp))
+
+    def copy(self, src: str, dst: str) -> None:
+
+        if up_to_date(src, dst):
+            return
+
+        replace(dst, lambda tmp: shutil.copy2(src, tmp))
+
+
+### *--- create the file aside and rename it over the destination ---* ###
+def replace(dst: str, create) -> None:
+
+    tmp = '%s.tmp%s' % (dst, os.getpid())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+
+    create(tmp)
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    os.replace(tmp, dst)
+
+
+def up_to_date(src: str, dst: str) -> bool:
+
+    if os.path.islink(dst) or not os.path.exists(dst):
+        return False
+
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+
+    return src_stat.st_size == dst_stat.st_size and \
+        src_stat.st_mtime_ns == dst_stat.st_mtime_ns
@@ -0,0 +1,374 @@
+'''
+Autor: Mijie Pang
+Date: 2024-04-26 09:12:40
+LastEditTime: 2024-04-26 17:35:21
+Description: asynchronous supervisor of the ensemble jobs, the members are
+submitted, watched and resubmitted by one event loop
+'''
+import os
+import time
+import signal
+import shutil
+import asyncio
+import logging
+import functools
+from datetime import datetime
+
+from tool.node import NodeScript_test, submit_array, parse_job_id, cancel_jobs
+
+
+### *--- one member of the ensemble ---* ###
+class Member:
+
+    def __init__(self, run_id: str, run_dir: str, job_name: str) -> None:
+
+        self.run_id = run_id
+        self.run_dir = run_dir
+        self.job_name = job_name
+
+        # 0 for ready, 10 for submitted, 20 for running, 100 for finished
+        self.status = 0
+        self.retry = 0
+        self.next_time = 0.  # the earliest (monotonic) time to submit
+        self.job_id = ''
+
+    def __repr__(self) -> str:
+        return self.run_id
+
+
+class EnsembleSupervisor:
+
+    def __init__(self,
+                 run_dirs: dict,
+                 commands: list,
+                 watcher,
+                 management='SGE',
+                 allocator=None,
+                 node_id=None,
+                 core_demand=1,
+                 max_core_num=None,
+                 max_retry=0,
+                 job_names=None,
+                 array=None,
+                 log_trash_dir=None,
+                 backoff=30,
+                 backoff_max=600,
+                 busy_wait=60,
+                 interval=5,
+                 min_interval=1,
+                 **kwargs) -> None:
+        """
+        params:
+            run_dirs: {run_id: run_dir} of the members.
+            commands: commands run in the run directory of the member.
+            watcher: ModelWatcher of the model logs, the members are added.
+            management: job management system.
+            allocator: NodeAllocator placing the members, None to submit
+                       all of them to node_id.
+            core_demand: cores of every member.
+            max_core_num: core budget of all the submitted members.
+            max_retry: resubmissions of a member before the run aborts.
+            job_names: {run_id: job name}, the run id by default.
+            array: keyword arguments of submit_array, e.g. path, job_name
+                   and out_file, to submit the ready members as one array.
+            log_trash_dir: the logs of the failed runs are moved here.
+            backoff: seconds before the first resubmission of a member,
+                     doubled on every retry up to backoff_max.
+            busy_wait: seconds before placing again when the nodes are full.
+            interval: maximum seconds between two status checks.
+            min_interval: minimum seconds between two status checks, the
+                          checks are woken by inotify in between.
+        """
+
+        job_names = {} if job_names is None else job_names
+        self.members = {
+            run_id: Member(run_id, run_dir, job_names.get(run_id, run_id))
+            for run_id, run_dir in run_dirs.items()
+        }
+        self.commands = commands
+        self.watcher = watcher
+        self.management = management
+        self.allocator = allocator
+        self.node_id = node_id
+        self.core_demand = int(core_demand)
+        self.max_core_num = len(self.members) * self.core_demand \
+            if max_core_num is None else int(max_core_num)
+        self.max_retry = max_retry
+        self.array = array
+        self.log_trash_dir = log_trash_dir
+
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.busy_wait = busy_wait
+        self.interval = interval
+        self.min_interval = min_interval
+        self.wait_time = 120 if allocator is None else allocator.wait_time
+
+        self.occupied_core_num = 0
+        self.busy_since = None
+        self.aborted = False
+        self.tasks = set()
+
+        for member in self.members.values():
+            self.watcher.add(member.run_id, member.run_dir)
+
+    ### *--- run the whole ensemble ---* ###
+    def run(self) -> bool:
+        """
+        return:
+            True if all the members finished, False if the run was aborted
+            or cancelled, the jobs left are cancelled then.
+        """
+        return asyncio.run(self.supervise())
+
+    async def supervise(self) -> bool:
+
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        # the jobs are cancelled when the run is terminated, e.g. by the
+        # cycle scheduler
+        main_task = asyncio.current_task()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
+            signal_handled = True
+        except (ValueError, RuntimeError, NotImplementedError):
+            signal_handled = False
+
+        # the inotify fd stays readable until the watcher reads it in the
+        # next step, so the reader is removed on every wake-up and added
+        # again once the step has run
+        def on_change() -> None:
+            loop.remove_reader(self.watcher.inotify.fd)
+            wake.set()
+
+        try:
+            while not self.aborted and any(
+                    member.status != 100 for member in self.members.values()):
+
+                self.step()
+
+                wake.clear()
+                if not self.watcher.inotify is None:
+                    loop.add_reader(self.watcher.inotify.fd, on_change)
+                try:
+                    await asyncio.wait_for(wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                await asyncio.sleep(self.min_interval)
+
+        except asyncio.CancelledError:
+            logging.warning('Ensemble run cancelled')
+            self.aborted = True
+
+        finally:
+            if not self.watcher.inotify is None:
+                loop.remove_reader(self.watcher.inotify.fd)
+            if signal_handled:
+                loop.remove_signal_handler(signal.SIGTERM)
+
+        if self.aborted:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.cancel()
+
+        self.watcher.close()
+
+        return not self.aborted
+
+    ### *--- one pass over the state transitions ---* ###
+    def step(self) -> None:
+
+        for run_id, event, value in self.watcher.poll():
+            self.handle(self.members[run_id], event, value)
+
+        if self.aborted:
+            return
+
+        ready = []
+        now = time.monotonic()
+        for member in self.members.values():
+            if member.status == 0 and member.next_time <= now and \
+                    self.occupied_core_num + self.core_demand <= \
+                    self.max_core_num:
+                # the cores are reserved until the submission fails
+                member.status = 10
+                self.occupied_core_num += self.core_demand
+                ready.append(member)
+
+        if ready:
+            task = asyncio.create_task(self.launch(ready))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def handle(self, member: Member, event: str, value) -> None:
+
+        if event == 'started':
+            if member.status == 10:
+                member.status = 20
+
+        elif event == 'progress':
+            logging.debug('%s produced %s restart files' %
+                          (member.run_id, value))
+
+        elif event == 'finished':
+            logging.info('%s finished successfully' % (member.run_id))
+            member.status = 100
+            self.occupied_core_num -= self.core_demand
+            self.watcher.remove(member.run_id)
+
+        elif event == 'error':
+
+            # rename and save the log file
+            log_file_path = '%s/log/%s.out.log' % (member.run_dir,
+                                                   member.run_id)
+            if not self.log_trash_dir is None and os.path.exists(
+                    log_file_path):
+                shutil.move(
+                    log_file_path,
+                    os.path.join(
+                        self.log_trash_dir, '%s$error.%s.log' %
+                        (datetime.now().strftime('%Y%m%d_%H%M%S'),
+                         member.run_id)))
+            self.watcher.reset(member.run_id)
+
+            self.retry(member, 'error happened')
+
+    ### *--- put the member back to ready mode with a backoff ---* ###
+    def retry(self, member: Member, reason: str) -> None:
+
+        self.occupied_core_num -= self.core_demand
+        member.status = 0
+        member.job_id = ''
+        member.retry += 1
+
+        if member.retry > self.max_retry:
+            logging.error('%s %s, maximum retry reached' %
+                          (member.run_id, reason))
+            self.aborted = True
+            return
+
+        delay = min(self.backoff * 2**(member.retry - 1), self.backoff_max)
+        member.next_time = time.monotonic() + delay
+        logging.warning('%s %s, resubmitted in %s s (retry %s)' %
+                        (member.run_id, reason, delay, member.retry))
+
+    ### *--- place and submit the ready members ---* ###
+    async def launch(self, members: list) -> None:
+
+        loop = asyncio.get_running_loop()
+
+        if self.allocator is None:
+            plan = {member.run_id: self.node_id for member in members}
+        else:
+            # the snapshot may query the job manager
+            try:
+                plan = await loop.run_in_executor(
+                    None, self.allocator.try_plan,
+                    [member.run_id for member in members])
+            except (OSError, ValueError, KeyError) as error:
+                logging.warning('Node query failed : %s' % (error))
+                plan = {}
+
+        # the members not fitting on the nodes wait without a retry counted
+        placed = [member for member in members if member.run_id in plan]
+        for member in members:
+            if not member.run_id in plan:
+                member.status = 0
+                member.next_time = time.monotonic() + self.busy_wait
+                self.occupied_core_num -= self.core_demand
+
+        if len(placed) == 0:
+            self.node_busy()
+            return
+        self.busy_since = None
+
+        if self.array is None:
+            await asyncio.gather(*[
+                self.submit(member, plan[member.run_id]) for member in placed
+            ])
+        else:
+            await self.submit_array(placed,
+                                    sorted(set(plan[m.run_id] for m in placed)))
+
+    def node_busy(self) -> None:
+
+        logging.warning('node busy')
+        if self.busy_since is None:
+            self.busy_since = time.monotonic()
+        elif time.monotonic() - self.busy_since > self.wait_time * 60:
+            logging.error('No available core in due time (%s mins)' %
+                          (self.wait_time))
+            self.aborted = True
+
+    async def submit(self, member: Member, node_id) -> None:
+
+        submission = NodeScript_test(
+            path='%s/launcher-server' % (member.run_dir),
+            node_id=node_id,
+            core_demand=self.core_demand,
+            job_name=member.job_name,
+            out_file='log/%s.out.log' % (member.run_id),
+            error_file='log/%s.err.log' % (member.run_id),
+            management=self.management)
+        submission.add(*self.commands)
+
+        process = await asyncio.create_subprocess_shell(
+            submission.get_command(),
+            cwd=member.run_dir,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await process.communicate()
+
+        if process.returncode != 0:
+            self.retry(member,
+                       'submission failed : %s' % (stderr.decode().strip()))
+            return
+
+        member.job_id = parse_job_id(stdout.decode(), self.management)
+        logging.info('%s submitted to node %s' % (member.run_id, node_id))
+
+    async def submit_array(self, members: list, node_id: list) -> None:
+
+        loop = asyncio.get_running_loop()
+        if self.allocator is None:
+            node_id = self.node_id
+
+        try:
+            output = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    submit_array,
+                    run_dirs=[member.run_dir for member in members],
+                    run_ids=[member.run_id for member in members],
+                    commands=self.commands,
+                    management=self.management,
+                    node_id=node_id,
+                    core_demand=self.core_demand,
+                    max_running=self.max_core_num // self.core_demand,
+                    **self.array))
+        except RuntimeError as error:
+            for member in members:
+                self.retry(member, str(error))
+            return
+
+        job_id = parse_job_id(output, self.management)
+        for member in members:
+            member.job_id = job_id
+
+        logging.info('%s members submitted as array job %s' %
+                     (len(members), job_id))
+
+    ### *--- cancel the jobs submitted and not finished ---* ###
+    async def cancel(self) -> None:
+
+        job_ids = sorted(
+            set(member.job_id for member in self.members.values()
+                if member.status in (10, 20) and member.job_id))
+        if len(job_ids) == 0:
+            return
+
+        logging.warning('Cancelling jobs %s' % (', '.join(job_ids)))
+        await asyncio.get_running_loop().run_in_executor(
+            None, cancel_jobs, job_ids, self.management)
@@ -6,9 +6,7 @@ Description:
 '''
 import os
 import sys
-import time
 import logging
-import subprocess
 import numpy as np
 from datetime import datetime
 
@@ -20,7 +18,8 @@ import system_lib as stl
 import Model.Model_lib as mol
 import Model.LE_model_lib as leml
 import Model.LE_status_lib as lesl
-from tool.node import NodeScript, CheckNode
+import Model.Supervisor_lib as sul
+from tool.node import CheckNode, NodeAllocator
 
 
 def main(Config: dict, **kwargs):
@@ -46,8 +45,11 @@ def main(Config: dict, **kwargs):
     end_time = Config['Initial']['initial_run']['end_time']
     iteration_num = Config['Model'][model_scheme]['iteration_num']
     core_demand = Config['Model']['node']['core_demand']
+    node_config = Config['Initial']['initial_run']['node']
+    array_job = node_config.get('array_job', False)
 
     check = CheckNode(Config['Info']['Machine']['management'])
+    allocator = NodeAllocator(check, core_demand=core_demand, **node_config)
 
     log_trash_dir = Config['Info']['path']['output_path'] + '/log'
     if not os.path.exists(log_trash_dir):
@@ -78,33 +80,17 @@ def main(Config: dict, **kwargs):
         Config['Model'][model_scheme]['path']['model_path'],
         Config['Model'][model_scheme]['run_project'])
 
-    if not os.path.exists(model_dir_sub):
-        logging.info('Creating the model sub-directories')
-        os.makedirs(model_dir_sub)
-    else:
-        logging.info('Cleaning the existing model sub-directories')
-        os.system('rm -rf %s/*' % (model_dir_sub))
+    logging.info('Updating the template of the model sub-directories')
+    template = mol.SubDirTemplate(
+        model_dir=Config['Model'][model_scheme]['path']['model_path'],
+        model_dir_sub=model_dir_sub,
+        **Config['Model'][model_scheme].get('provision', {}))
+    template.build()
 
     sub_dirs = []
     for i_ensemble in range(len(ensemble_num)):
 
-        sub_dirs.append(
-            mol.copy_from_source(
-                model_dir=Config['Model'][model_scheme]['path']['model_path'],
-                model_dir_sub=model_dir_sub,
-                run_id=run_ids[i_ensemble]))
-
-        ### *--- edit the model configuration ---* ###
-        leml.LOTOS_EUROS_Configure_dict(
-            # project_dir=sub_dirs[i_ensemble] + '/proj/dust/002',
-            project_dir=sub_dirs[i_ensemble] + '/proj/radiation/001',
-            config_dict={
-                'run.id': run_ids[i_ensemble],
-                'run.project': Config['Model'][model_scheme]['run_project'],
-                'timerange.start': start_time,
-                'timerange.end': end_time,
-            },
-            **Config['Initial']['initial_run']['rc'])
+        sub_dirs.append(template.materialise(run_ids[i_ensemble]))
 
         ### *--- edit the dust emission file ---* ###
         leml.LOTOS_EUROS_dust_emis(
@@ -120,6 +106,17 @@ def main(Config: dict, **kwargs):
                                           '/base/001',
                                           meteo_num=i_ensemble // 2 + 1)
 
+    ### *--- edit the model configuration of all the members ---* ###
+    leml.LOTOS_EUROS_Configure_batch(
+        project_dirs=[sub_dir + '/proj/radiation/001' for sub_dir in sub_dirs],
+        config_dicts=[{
+            'run.id': run_id,
+            'run.project': Config['Model'][model_scheme]['run_project'],
+            'timerange.start': start_time,
+            'timerange.end': end_time,
+        } for run_id in run_ids],
+        **Config['Initial']['initial_run']['rc'])
+
     logging.info('sub-directories created')
 
     ### *----------------------------------* ###
@@ -127,135 +124,37 @@ def main(Config: dict, **kwargs):
 
     logging.info('### run model by batch ###')
 
-    run_id_flat = np.ravel(np.array(run_ids))
-    # status : 0 for ready, 10 for submitted, 20 for running, 100 for finished
-    ensemble_status_dict = {
-        run_id_flat[i_run]: {
-            'status': 0,
-            'run_dir': sub_dirs[i_run],
-            # 'progress': None
-        }
-        for i_run in range(len(run_id_flat))
-    }
-
-    node_id = int(Config['Initial']['initial_run']['node']['node_id'])
-    occupied_core_num = 1
-    retry_count = 0
-    while len(ensemble_status_dict) > 0:
-
-        ### loop over all remaining ensembles ###
-        delete_index = []
-
-        for i_run, run_id in enumerate(ensemble_status_dict):
-
-            ### *--- stage 1: submit the model to node ---* ###
-            flag1 = ensemble_status_dict[run_id]['status'] == 0
-            flag2 = occupied_core_num <= Config['Initial']['initial_run'][
-                'node']['max_core_num']
-            if flag1 and flag2:
-
-                if Config['Initial']['initial_run']['node'][
-                        'auto_node_selection']:
-
-                    node_id = check.query(
-                        demand=core_demand,
-                        **Config['Initial']['initial_run']['node'])
-
-                ### prepare submit script ###
-                submission = NodeScript(
-                    path='%s/launcher-server' %
-                    (ensemble_status_dict[run_id]['run_dir']),
-                    node_id=node_id,
-                    core_demand=core_demand,
-                    job_name='i_%02d_e_%02d' %
-                    (iteration_num, int(run_id.split('_')[3])),
-                    out_file='log/%s.out.log' % (run_id),
-                    error_file='log/%s.err.log' % (run_id),
-                    management=Config['Info']['Machine']['management'])
-                submission.add(
-                    'export zijin_dir="/home/pangmj"', '. ' +
-                    Config['Model'][model_scheme]['path']['model_bashrc_path'],
-                    'export LD_LIBRARY_PATH="/home/jinjb/TNO/lotos-euros/v2.1_dust2021_ensemble/tools:$LD_LIBRARY_PATH"',
-                    './launcher-radiation -n')
-                submit_command = submission.get_command()
-
-                os.chdir(ensemble_status_dict[run_id]['run_dir'])
-                command = os.system(
-                    '. ' +
-                    Config['Model'][model_scheme]['path']['model_bashrc_path'])
-                command = os.system(submit_command)
-
-                logging.info('%s submitted to node %s' % (run_id, node_id))
-
-                # set the submitted status
-                occupied_core_num += core_demand
-                ensemble_status_dict[run_id]['status'] = 10
-                # time.sleep(5)
-
-            ### *--- stage 2: make sure the model has started ---* ###
-            elif ensemble_status_dict[run_id]['status'] == 10:
-
-                if os.path.exists(
-                        '%s/log/%s.out.log' %
-                    (ensemble_status_dict[run_id]['run_dir'], run_id)):
-
-                    # set the running status
-                    ensemble_status_dict[run_id]['status'] = 20
-
-            ### *--- stage 3: wait for the model to finish and retry when failed ---* ###
-            elif ensemble_status_dict[run_id]['status'] == 20:
-
-                log_file_path = '%s/log/%s.out.log' % (
-                    ensemble_status_dict[run_id]['run_dir'], run_id)
-
-                Finished_flag, Error_flag = lesl.check_model_log(
-                    log_path=log_file_path)
-
-                ### *--- ERROR process ---* ###
-                # if error happened, reset the ensemble to ready mode
-                if Error_flag:
-
-                    logging.warning('%s error happened, reset to ready mode' %
-                                    (run_id))
-
-                    # rename and save the log file or just delete it
-                    log_file_moved = os.path.join(
-                        log_trash_dir, '%s$error.%s.log' %
-                        (datetime.now().strftime('%Y%m%d_%H%M%S'), run_id))
-                    subprocess.run(['mv', log_file_path, log_file_moved])
-
-                    # set the status
-                    ensemble_status_dict[run_id]['status'] = 0
-                    occupied_core_num -= core_demand
-                    retry_count += 1
-
-                ### *--- SUCCESS process ---* ###
-                # if it is finished secessfully, release the occupied core
-                elif Finished_flag:
-
-                    logging.info('%s finished successfully' % (run_id))
-
-                    ### rename and save the log file or just delete it ###
-                    # log_file_moved = log_trash_dir + '/' + run_ids + '.out$' + datetime.now(
-                    # ).strftime('%Y%m%d_%H%M%S') + '.log'
-                    # subprocess.run(['mv', log_file_path, log_file_moved])
-                    # os.remove(log_file_path)
-
-                    # set the status
-                    ensemble_status_dict[run_id]['status'] = 100
-                    occupied_core_num -= core_demand
-                    delete_index.append(run_id)
-
-        ### *--- abort the project if the maximum retry is reached ---* ###
-        if retry_count > Config['Model'][model_scheme]['max_retry']:
-            logging.error('maximum retry reached, system aborted')
-            sys.exit(-1)
-
-        ### *--- remove the finished ensembles ---* ###
-        [ensemble_status_dict.pop(idx) for idx in delete_index]
-
-        ### *--- take a snap ---* ###
-        time.sleep(5)
+    supervisor = sul.EnsembleSupervisor(
+        run_dirs=dict(zip(run_ids, sub_dirs)),
+        commands=[
+            'export zijin_dir="/home/pangmj"',
+            '. ' + Config['Model'][model_scheme]['path']['model_bashrc_path'],
+            'export LD_LIBRARY_PATH="/home/jinjb/TNO/lotos-euros/v2.1_dust2021_ensemble/tools:$LD_LIBRARY_PATH"',
+            './launcher-radiation -n'
+        ],
+        watcher=lesl.ModelWatcher(**Config['Model'].get('watch', {})),
+        management=Config['Info']['Machine']['management'],
+        allocator=allocator if node_config['auto_node_selection'] else None,
+        node_id=int(node_config['node_id']),
+        core_demand=core_demand,
+        max_core_num=node_config['max_core_num'],
+        max_retry=Config['Model'][model_scheme]['max_retry'],
+        job_names={
+            run_id: 'i_%02d_e_%02d' % (iteration_num, ensemble_num[i_ensemble])
+            for i_ensemble, run_id in enumerate(run_ids)
+        },
+        array={
+            'path': '%s/launcher-array' % (model_dir_sub),
+            'job_name': 'i_%02d_array' % (iteration_num),
+            'out_file': '%s/i_%02d_array.log' % (log_trash_dir, iteration_num),
+        } if array_job else None,
+        log_trash_dir=log_trash_dir,
+        **Config['Model'].get('supervisor', {}))
+
+    ### *--- abort the project if the maximum retry is reached ---* ###
+    if not supervisor.run():
+        logging.error('initial run failed, system aborted')
+        sys.exit(-1)
 
     ### *----------------------------------------* ###
     ### *--- store the model simulation files ---* ###
@@ -19,6 +19,7 @@ import system_lib as stl
 from tool.metrics import MetricTwoD
 from tool.china_map_v2 import MyMap as mmp
 from tool.mapper import find_nearest_vector
+from tool.obs_store import read_obs
 
 
 class PlotForecast:
@@ -181,7 +182,7 @@ class PlotForecast:
 
             obs_flag = True
 
-            obs_data = pd.read_csv(file_path, header=None)
+            obs_data = read_obs(file_path, [0, 1, 2], header=None)
             obs_lon = obs_data.iloc[:, 0]
             obs_lat = obs_data.iloc[:, 1]
             obs_val = obs_data.iloc[:, 2]
@@ -18,6 +18,7 @@ import system_lib as stl
 from tool.metrics import MetricTwoD
 from tool.china_map import my_map as mmp
 from tool.mapper import find_nearest_vector
+from tool.obs_store import read_obs
 
 
 class PlotModelRun:
@@ -128,7 +129,7 @@ class PlotModelRun:
 
                 obs_flag = True
 
-                obs_data = pd.read_csv(obs_path, header=None)
+                obs_data = read_obs(obs_path, [0, 1, 2], header=None)
                 obs_lon = obs_data.iloc[:, 0].values
                 obs_lat = obs_data.iloc[:, 1].values
                 obs_val = obs_data.iloc[:, 2].values
@@ -0,0 +1,567 @@
+'''
+Autor: Mijie Pang
+Date: 2024-04-29 09:41:26
+LastEditTime: 2024-04-29 17:02:13
+Description: streaming merge of the ensemble model output, the member files
+are opened once per day and all the products and their ensemble statistics
+are reduced in one pass
+'''
+import os
+import sys
+import logging
+import numpy as np
+import pandas as pd
+import netCDF4 as nc
+from datetime import datetime
+
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(main_dir)
+from tool.pack import NcProduct
+
+dust_bin = ['dust_ff', 'dust_f', 'dust_c', 'dust_cc', 'dust_ccc']
+
+
+### *--- running mean and variance of the members (Welford) ---* ###
+class RunningMoments:
+
+    def __init__(self, shape: tuple) -> None:
+
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.M2 = np.zeros(shape)
+
+        # scratch buffers, the update allocates nothing
+        self.delta = np.empty(shape)
+        self.buffer = np.empty(shape)
+
+    def reset(self) -> None:
+
+        self.count = 0
+        self.mean.fill(0)
+        self.M2.fill(0)
+
+    def add(self, value: np.ndarray) -> None:
+
+        self.count += 1
+
+        np.subtract(value, self.mean, out=self.delta)
+        np.divide(self.delta, self.count, out=self.buffer)
+        self.mean += self.buffer
+        np.subtract(value, self.mean, out=self.buffer)
+        self.buffer *= self.delta
+        self.M2 += self.buffer
+
+    def variance(self, ddof=1) -> np.ndarray:
+        return self.M2 / max(self.count - ddof, 1)
+
+
+### *--- streaming quantiles of the members on fixed bins ---* ###
+class QuantileSketch:
+
+    def __init__(self, shape: tuple, lower: float, upper: float, bins=100,
+                 log=True) -> None:
+        """
+        Histogram of the members in every grid cell, the quantiles are
+        interpolated inside the bins and bounded by the member extremes.
+
+        params:
+            lower, upper: range of the bins, the values out of the range
+                          fall in two open bins.
+            bins: number of the bins inside the range.
+            log: logarithmic bins, for the positive quantities spanning
+                 orders of magnitude.
+        """
+
+        self.shape = shape
+        self.log = log
+        self.edges = np.geomspace(lower, upper, bins + 1) if log else \
+            np.linspace(lower, upper, bins + 1)
+        self.scaled_edges = self.scale(self.edges)
+        self.width = self.scaled_edges[1] - self.scaled_edges[0]
+
+        size = int(np.prod(shape))
+        self.cells = np.arange(size)
+        self.counts = np.zeros((bins + 2, size), dtype=np.uint16)
+        self.minimum = np.full(size, np.inf)
+        self.maximum = np.full(size, -np.inf)
+        self.count = 0
+
+    def scale(self, value: np.ndarray) -> np.ndarray:
+
+        if self.log:
+            return np.log10(np.maximum(value, self.edges[0] * 1e-3))
+        return np.asarray(value, dtype=float)
+
+    def reset(self) -> None:
+
+        self.counts.fill(0)
+        self.minimum.fill(np.inf)
+        self.maximum.fill(-np.inf)
+        self.count = 0
+
+    def add(self, value: np.ndarray) -> None:
+
+        value = value.reshape(-1)
+        np.minimum(self.minimum, value, out=self.minimum)
+        np.maximum(self.maximum, value, out=self.maximum)
+
+        # 0 below the range, bins + 1 above it
+        idx = np.floor((self.scale(value) - self.scaled_edges[0]) /
+                       self.width) + 1
+        idx = np.clip(idx, 0, len(self.counts) - 1).astype(np.intp)
+        self.counts[idx, self.cells] += 1
+        self.count += 1
+
+    def quantile(self, q: list) -> np.ndarray:
+        """
+        params:
+            q: quantiles in [0, 1], interpolated between the members like
+               numpy.quantile.
+
+        return:
+            dim : Nq * shape
+        """
+
+        rank = np.asarray(q, dtype=float).reshape(-1, 1) * (self.count - 1)
+        lower = np.floor(rank)
+        upper = np.minimum(lower + 1, self.count - 1)
+
+        value_lower = self.order_statistic(lower)
+        value_upper = self.order_statistic(upper)
+        result = value_lower + (rank - lower) * (value_upper - value_lower)
+
+        return result.reshape((len(rank), ) + self.shape)
+
+    def order_statistic(self, k: np.ndarray) -> np.ndarray:
+        """
+        k-th smallest member (Nk * 1) of every cell, the members of a bin
+        are spread evenly over it, the extremes are exact.
+        """
+
+        result = np.empty((len(k), len(self.cells)))
+        below = np.zeros(len(self.cells))
+
+        Nbin = len(self.counts)
+        for i_bin in range(Nbin):
+
+            count = self.counts[i_bin]
+            if not count.any():
+                continue
+
+            inside = (below <= k) & (k < below + count)
+            if inside.any():
+
+                fraction = (k - below + 0.5) / np.maximum(count, 1)
+                if i_bin == 0:
+                    low, high = self.minimum, self.edges[0]
+                elif i_bin == Nbin - 1:
+                    low, high = self.edges[-1], self.maximum
+                else:
+                    low, high = self.edges[i_bin - 1], self.edges[i_bin]
+
+                if self.log and 0 < i_bin < Nbin - 1:
+                    value = low * (high / low)**fraction
+                else:
+                    value = low + fraction * (high - low)
+                result[inside] = np.broadcast_to(value, result.shape)[inside]
+
+            below += count
+
+        result = np.where(k == 0, self.minimum, result)
+        result = np.where(k == self.count - 1, self.maximum, result)
+
+        return np.clip(result, self.minimum, self.maximum)
+
+
+### *--- members exceeding the thresholds ---* ###
+class ExceedanceCounter:
+
+    def __init__(self, shape: tuple, thresholds: list) -> None:
+
+        self.thresholds = np.asarray(thresholds, dtype=float)
+        self.counts = np.zeros((len(self.thresholds), ) + shape,
+                               dtype=np.uint16)
+        self.count = 0
+
+    def reset(self) -> None:
+
+        self.counts.fill(0)
+        self.count = 0
+
+    def add(self, value: np.ndarray) -> None:
+
+        for i_threshold in range(len(self.thresholds)):
+            self.counts[i_threshold] += value > self.thresholds[i_threshold]
+        self.count += 1
+
+    def probability(self) -> np.ndarray:
+        return self.counts / max(self.count, 1)
+
+
+### *--- statistics of the members, no member is kept in memory ---* ###
+class EnsembleStatistics:
+
+    def __init__(self,
+                 shape: tuple,
+                 percentile=(10, 50, 90),
+                 threshold=(),
+                 value_range=(1e-2, 1e5),
+                 bins=100,
+                 log=True,
+                 **kwargs) -> None:
+        """
+        params:
+            shape: shape of the statistics.
+            percentile: percentiles (%) of the members.
+            threshold: the probability to exceed them is counted.
+            value_range, bins, log: bins of the quantile sketch.
+        """
+
+        self.percentile = np.asarray(percentile, dtype=float)
+        self.threshold = np.asarray(threshold, dtype=float)
+
+        self.moments = RunningMoments(shape)
+        self.sketch = QuantileSketch(shape, value_range[0], value_range[1],
+                                     bins, log)
+        self.exceedance = ExceedanceCounter(shape, self.threshold)
+
+    def reset(self) -> None:
+
+        self.moments.reset()
+        self.sketch.reset()
+        self.exceedance.reset()
+
+    def add(self, value: np.ndarray) -> None:
+
+        self.moments.add(value)
+        self.sketch.add(value)
+        self.exceedance.add(value)
+
+
+### *--- one merged product written through one open file ---* ###
+class MergedProduct:
+
+    def __init__(self,
+                 name: str,
+                 data_dir: str,
+                 Config: dict,
+                 complevel=4,
+                 statistics=None) -> None:
+        """
+        params:
+            name: product of the model output, "conc-3d", "aod2" or
+                  "conc-sfc".
+            data_dir: directory of the member outputs and the products.
+            Config: configurations of the whole system.
+            complevel: zlib compression level of the product.
+            statistics: keyword arguments of EnsembleStatistics, the
+                        statistics of the total dust are written to
+                        "<product>_stats.nc" if given.
+        """
+
+        model_scheme = Config['Model']['scheme']['name']
+        Nspec = Config['Model'][model_scheme]['nspec']
+        Nlev = Config['Model'][model_scheme]['nlevel']
+        Nlat = Config['Model'][model_scheme]['nlat']
+        Nlon = Config['Model'][model_scheme]['nlon']
+
+        # file name, variable, dimensions, scale and value range of the
+        # products
+        specs = {
+            'conc-3d': ('dust_conc-3d.nc', 'dust_conc',
+                        ('spec', 'level', 'latitude', 'longitude'),
+                        (Nspec, Nlev, Nlat, Nlon), 10**9, (1e-2, 1e5)),
+            'aod2': ('dust_aod.nc', 'aod_550nm', ('latitude', 'longitude'),
+                     (Nlat, Nlon), 1, (1e-4, 10)),
+            'conc-sfc': ('dust_conc-sfc.nc', 'dust_conc',
+                         ('spec', 'latitude', 'longitude'),
+                         (Nspec, Nlat, Nlon), 10**9, (1e-2, 1e5)),
+        }
+        if name not in specs.keys():
+            raise ValueError('Invalid merge product -> "%s" <-' % (name))
+
+        self.name = name
+        self.data_dir = data_dir
+        self.Config = Config
+        self.complevel = complevel
+        (self.file_name, self.variable, self.dimensions, self.shape,
+         self.scale, value_range) = specs[name]
+        self.sizes = dict(zip(self.dimensions, self.shape))
+
+        self.moments = RunningMoments(self.shape)
+        self.value = np.empty(self.shape, dtype=np.float32)
+
+        # the statistics are of the total over the dust bins
+        self.statistics = None
+        if not statistics is None:
+            self.stats_sizes = {
+                dim: size
+                for dim, size in self.sizes.items() if dim != 'spec'
+            }
+            self.total = np.empty(tuple(self.stats_sizes.values()))
+            self.statistics = EnsembleStatistics(
+                tuple(self.stats_sizes.values()),
+                **dict({'value_range': value_range}, **statistics))
+
+        self.nc_product = None
+        self.nc_stats = None
+        self.count = 0
+
+    def source_path(self, run_id: str, day: datetime) -> str:
+
+        return os.path.join(
+            self.data_dir, run_id, 'output',
+            'LE_%s_%s_%s.nc' % (run_id, self.name, day.strftime('%Y%m%d')))
+
+    ### *--- create the product, the coordinates from a member ---* ###
+    def create(self, run_id: str, day: datetime) -> None:
+
+        self.nc_product = self.create_file(self.file_name, self.sizes, {
+            self.variable: self.dimensions,
+            '%s_spread' % (self.variable): self.dimensions
+        }, run_id, day)
+
+        if self.statistics is None:
+            return
+
+        # an empty dimension would be unlimited, the percentiles and the
+        # exceedance are only written if asked for
+        stats_sizes = dict(self.stats_sizes)
+        dims = tuple(self.stats_sizes.keys())
+        variables = {
+            '%s_mean' % (self.variable): dims,
+            '%s_spread' % (self.variable): dims
+        }
+        coordinates = {}
+        for name, values in (('percentile', self.statistics.percentile),
+                             ('threshold', self.statistics.threshold)):
+            if len(values) > 0:
+                stats_sizes[name] = len(values)
+                coordinates[name] = values
+        if 'percentile' in coordinates.keys():
+            variables['%s_percentile' %
+                      (self.variable)] = ('percentile', ) + dims
+        if 'threshold' in coordinates.keys():
+            variables['%s_exceedance' %
+                      (self.variable)] = ('threshold', ) + dims
+
+        self.nc_stats = self.create_file(
+            self.file_name.replace('.nc', '_stats.nc'), stats_sizes,
+            variables, run_id, day)
+        for name, values in coordinates.items():
+            self.nc_stats.define_variable(**{name: ['f4', name]})
+            self.nc_stats.add_data(**{name: values})
+        if 'spec' in self.sizes:
+            self.nc_stats.set_attr_global(
+                Description='Ensemble statistics of the total over %s' %
+                (', '.join(dust_bin)))
+
+    def create_file(self, file_name: str, sizes: dict, variables: dict,
+                    run_id: str, day: datetime) -> NcProduct:
+
+        nc_product = NcProduct(os.path.join(self.data_dir, file_name),
+                               Model=self.Config['Model'],
+                               Assimilation=self.Config['Assimilation'],
+                               Info=self.Config['Info'])
+        nc_product.define_dimension(time=None, **sizes)
+
+        # one time step per chunk
+        options = {
+            'zlib': True,
+            'complevel': self.complevel,
+            'shuffle': True,
+            'chunk': 'time'
+        }
+        variables = {
+            var_name: ['f4', ('time', ) + dims, options]
+            for var_name, dims in variables.items()
+        }
+        nc_product.define_variable(longitude=['f4', 'longitude'],
+                                   latitude=['f4', 'latitude'],
+                                   time=['S19', 'time'],
+                                   **variables)
+        if 'level' in sizes:
+            nc_product.define_variable(
+                altitude=['f4', ('level', 'latitude', 'longitude')])
+
+        with nc.Dataset(self.source_path(run_id, day)) as nc_obj:
+            nc_product.add_data(longitude=nc_obj.variables['longitude'][:])
+            nc_product.add_data(latitude=nc_obj.variables['latitude'][:])
+            if 'level' in sizes:
+                nc_product.add_data(
+                    altitude=nc_obj.variables['altitude'][0, :])
+
+        return nc_product
+
+    ### *--- one member at one time ---* ###
+    def read(self, nc_obj: nc.Dataset, time_idx: int) -> np.ndarray:
+
+        if self.name == 'aod2':
+            self.value[:] = nc_obj.variables['aod_550nm'][time_idx, :]
+        elif self.name == 'conc-3d':
+            for i_spec in range(len(dust_bin)):
+                self.value[i_spec] = nc_obj.variables[dust_bin[i_spec]][
+                    time_idx, :]
+        else:
+            for i_spec in range(len(dust_bin)):
+                self.value[i_spec] = nc_obj.variables[dust_bin[i_spec]][
+                    time_idx, 0, :, :]
+
+        return self.value
+
+    def reset(self) -> None:
+
+        self.moments.reset()
+        if not self.statistics is None:
+            self.statistics.reset()
+
+    def add(self, value: np.ndarray) -> None:
+
+        self.moments.add(value)
+
+        if not self.statistics is None:
+            if 'spec' in self.sizes:
+                np.sum(value, axis=0, out=self.total)
+            else:
+                self.total[:] = value
+            self.total *= self.scale
+            self.statistics.add(self.total)
+
+    def write(self, time: datetime) -> None:
+
+        time_str = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        self.nc_product.add_data(time=time_str)
+        self.nc_product.add_data(count=self.count,
+                                 **{
+                                     self.variable:
+                                     self.moments.mean * self.scale,
+                                     '%s_spread' % (self.variable):
+                                     np.sqrt(self.moments.variance()) *
+                                     self.scale
+                                 })
+
+        if not self.statistics is None:
+            statistics = self.statistics
+            self.nc_stats.add_data(time=time_str)
+            values = {
+                '%s_mean' % (self.variable): statistics.moments.mean,
+                '%s_spread' % (self.variable):
+                np.sqrt(statistics.moments.variance()),
+            }
+            if len(statistics.percentile) > 0:
+                values['%s_percentile' % (self.variable)] = \
+                    statistics.sketch.quantile(statistics.percentile / 100)
+            if len(statistics.threshold) > 0:
+                values['%s_exceedance' % (self.variable)] = \
+                    statistics.exceedance.probability()
+            self.nc_stats.add_data(count=self.count, **values)
+
+        self.count += 1
+
+    def close(self) -> None:
+
+        for nc_product in (self.nc_product, self.nc_stats):
+            if not nc_product is None:
+                nc_product.close()
+        self.nc_product = None
+        self.nc_stats = None
+
+
+### *--- merge all the products in one pass over the member files ---* ###
+class EnsembleMerger:
+
+    def __init__(self,
+                 data_dir: str,
+                 run_ids: list,
+                 products: list,
+                 Config: dict,
+                 statistics=None,
+                 **kwargs) -> None:
+        """
+        params:
+            data_dir: directory of the member outputs and the products.
+            run_ids: run ids of the members.
+            products: products of the model output to merge.
+            Config: configurations of the whole system.
+            statistics: {product: keyword arguments of EnsembleStatistics}
+                        of the products with the statistics.
+            kwargs: passed to MergedProduct, e.g. complevel.
+        """
+
+        statistics = {} if statistics is None else statistics
+
+        self.data_dir = data_dir
+        self.run_ids = list(run_ids)
+        self.products = [
+            MergedProduct(name,
+                          data_dir,
+                          Config,
+                          statistics=statistics.get(name),
+                          **kwargs) for name in products
+        ]
+
+    def run(self, time_range: pd.DatetimeIndex) -> None:
+
+        start_merge = datetime.now()
+
+        try:
+            for day, times in pd.Series(time_range).groupby(
+                    time_range.normalize()):
+                self.merge_day(day.to_pydatetime(), list(times))
+        finally:
+            for product in self.products:
+                product.close()
+
+        logging.info('%s products of %s members merged over %s times, '
+                     'took %.2f s' %
+                     (len(self.products), len(self.run_ids), len(time_range),
+                      (datetime.now() - start_merge).total_seconds()))
+
+    def merge_day(self, day: datetime, times: list) -> None:
+
+        for product in self.products:
+            if product.nc_product is None:
+                product.create(self.run_ids[0], day)
+
+        # every member file is opened and its time axis decoded once a day
+        handles, indices = {}, {}
+        try:
+            for product in self.products:
+                for run_id in self.run_ids:
+
+                    nc_obj = nc.Dataset(product.source_path(run_id, day))
+                    handles[product.name, run_id] = nc_obj
+
+                    output_time = nc_obj.variables['time']
+                    output_time = nc.num2date(output_time[:],
+                                              output_time.units,
+                                              only_use_cftime_datetimes=False,
+                                              only_use_python_datetimes=True)
+                    indices[product.name, run_id] = {
+                        time: idx
+                        for idx, time in enumerate(output_time)
+                    }
+
+            for time in times:
+                time = time.to_pydatetime()
+                for product in self.products:
+
+                    product.reset()
+                    for run_id in self.run_ids:
+
+                        nc_obj = handles[product.name, run_id]
+                        time_idx = indices[product.name, run_id].get(time)
+                        if time_idx is None:
+                            raise ValueError('%s not found in %s' %
+                                             (time, nc_obj.filepath()))
+
+                        product.add(product.read(nc_obj, time_idx))
+
+                    product.write(time)
+
+        finally:
+            for nc_obj in handles.values():
+                nc_obj.close()
+
+        logging.debug('Products of %s merged' % (day.strftime('%Y-%m-%d')))
@@ -18,8 +18,16 @@ from tool.node import NodeScript, CheckNode
 
 def entrance(Config: dict, Status: dict, queue=None, **kwargs):
 
-    check_node = CheckNode(Config['Info']['Machine']['management'])
-    home_dir = os.getcwd()
+    save(Config, Status, **kwargs)
+
+    ### after finish the necesssary procedure, the system continus ###
+    queue.put('Please Go On')
+
+    finish(Config, Status, **kwargs)
+
+
+### *--- the part the next cycle has to wait for ---* ###
+def save(Config: dict, Status: dict, **kwargs):
 
     model_scheme = Config['Model']['scheme']['name']
 
@@ -58,12 +66,17 @@ def entrance(Config: dict, Status: dict, queue=None, **kwargs):
             logging.error('Something is wrong!')
             sys.exit(exit_code)
 
-    ### after finish the necesssary procedure, the system continus ###
-    queue.put('Please Go On')
     # stl.edit_json(path=status_path, new_dict={'model': {'post_process_code': 100}})
 
-    ##################################################################
-    ### parts that won't jam the system
+
+##################################################################
+### parts that won't jam the system
+def finish(Config: dict, Status: dict, **kwargs):
+
+    check_node = CheckNode(Config['Info']['Machine']['management'])
+    home_dir = os.getcwd()
+
+    model_scheme = Config['Model']['scheme']['name']
 
     ### generate the combined product ###
     if Config['Model'][model_scheme]['post_process']['save_method'] in [
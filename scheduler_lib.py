@@ -0,0 +1,344 @@
+'''
+Autor: Mijie Pang
+Date: 2024-04-24 10:02:18
+LastEditTime: 2024-04-24 18:36:51
+Description: pipelined scheduler of the assimilation cycles, the stages of
+different cycles run concurrently as far as their data dependencies allow
+'''
+import copy
+import logging
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+import system_lib as stl
+
+
+### *--- one stage of one cycle ---* ###
+class Task:
+
+    def __init__(self,
+                 name: str,
+                 i_cycle: int,
+                 target,
+                 args=(),
+                 deps=(),
+                 pool='critical',
+                 on_start=None,
+                 status_section=None) -> None:
+        """
+        params:
+            name: stage name, e.g. "prepare", "assimilation".
+            i_cycle: index of the cycle.
+            target: function run in a separate process.
+            args: arguments of the target.
+            deps: keys (name, i_cycle) of the tasks to finish first.
+            pool: concurrency pool the task counts to.
+            on_start: called in the scheduler right before the launch.
+            status_section: the task is only finished when the code of this
+                            section in Status.json reaches 100.
+        """
+
+        self.name = name
+        self.i_cycle = i_cycle
+        self.key = (name, i_cycle)
+        self.target = target
+        self.args = args
+        self.deps = [dep for dep in deps if dep[1] >= 0]
+        self.pool = pool
+        self.on_start = on_start
+        self.status_section = status_section
+
+        self.process = None
+
+    def __repr__(self) -> str:
+        return '%s[%s]' % (self.name, self.i_cycle)
+
+
+class CycleScheduler:
+
+    def __init__(self, Config: dict, status_bus: stl.StatusBus,
+                 asml_time_list: list, model_time_list: list,
+                 **kwargs) -> None:
+        """
+        params:
+            Config: configurations of the whole system.
+            status_bus: the shared status.
+            asml_time_list: assimilation time of every cycle.
+            model_time_list: [start, end] of the model run of every cycle.
+            prefetch: number of cycles the preparation may run ahead.
+            limits: maximum number of running tasks of the pools
+                    "prepare" and "post".
+            interval: maximum time (s) between two status checks.
+        """
+
+        self.Config = Config
+        self.status_bus = status_bus
+        self.asml_time_list = asml_time_list
+        self.model_time_list = model_time_list
+
+        self.prefetch = kwargs.get('prefetch', 1)
+        self.interval = kwargs.get('interval', 1)
+
+        # the assimilation and the model share Status.json, never overlap them
+        self.limits = {'prepare': 1, 'post': 2}
+        self.limits.update(kwargs.get('limits', {}))
+        self.limits['critical'] = 1
+
+        self.tasks = {}
+        self.finished = set()
+        self.running = []
+
+    ### *--- build the dependency graph ---* ###
+    def build(self) -> None:
+
+        import prepare
+        import Assimilation
+        import post_asml
+        import Model
+        import post_model
+
+        Status = self.status_bus.read()
+        asml_enable = self.Config['Assimilation']['scheme']['enable']
+
+        for i_cycle, asml_time in enumerate(self.asml_time_list):
+
+            model_time = None if self.model_time_list is None else \
+                self.model_time_list[i_cycle]
+
+            # snapshot of the status for the stages reading it from argument
+            Status_cycle = copy.deepcopy(Status)
+            stl.update_dict(
+                Status_cycle, {
+                    'assimilation': {
+                        'code': 0,
+                        'assimilation_time': asml_time,
+                        'post_process_code': 0
+                    },
+                    'model': {
+                        'code': 0,
+                        'post_process_code': 0
+                    }
+                })
+            if not model_time is None:
+                Status_cycle['model']['start_time'] = model_time[0]
+                Status_cycle['model']['end_time'] = model_time[1]
+
+            # the last task of the previous cycle the next cycle relies on
+            last = self.critical_tail(i_cycle - 1)
+
+            self.add(
+                Task('prepare',
+                     i_cycle,
+                     prepare.entrance,
+                     args=(self.Config, Status_cycle),
+                     deps=[('prepare', i_cycle - 1),
+                           self.critical_tail(i_cycle - 1 - self.prefetch)],
+                     pool='prepare'))
+            last = [('prepare', i_cycle), last]
+
+            if asml_enable:
+
+                self.add(
+                    Task('assimilation',
+                         i_cycle,
+                         Assimilation.entrance,
+                         args=(self.Config, ),
+                         deps=last,
+                         on_start=self.status_updater(
+                             {'assimilation': Status_cycle['assimilation']}),
+                         status_section='assimilation'))
+                self.add(
+                    Task('post_asml',
+                         i_cycle,
+                         post_asml.entrance,
+                         args=(self.Config, Status_cycle),
+                         deps=[('assimilation', i_cycle)],
+                         pool='post'))
+                last = [('assimilation', i_cycle)]
+
+            if not model_time is None:
+
+                self.add(
+                    Task('model',
+                         i_cycle,
+                         Model.entrance,
+                         args=(self.Config, ),
+                         deps=last,
+                         on_start=self.status_updater(
+                             {'model': Status_cycle['model']}),
+                         status_section='model'))
+                self.add(
+                    Task('post_model_save',
+                         i_cycle,
+                         post_model.save,
+                         args=(self.Config, Status_cycle),
+                         deps=[('model', i_cycle)]))
+                self.add(
+                    Task('post_model',
+                         i_cycle,
+                         post_model.finish,
+                         args=(self.Config, Status_cycle),
+                         deps=[('post_model_save', i_cycle)],
+                         pool='post'))
+
+        logging.info('%s tasks scheduled for %s cycles' %
+                     (len(self.tasks), len(self.asml_time_list)))
+
+    def add(self, task: Task) -> None:
+        self.tasks[task.key] = task
+
+    def critical_tail(self, i_cycle: int) -> tuple:
+        """
+        Key of the task that closes the critical chain of a cycle.
+        """
+
+        if self.model_time_list is not None:
+            return ('post_model_save', i_cycle)
+        elif self.Config['Assimilation']['scheme']['enable']:
+            return ('assimilation', i_cycle)
+        else:
+            return ('prepare', i_cycle)
+
+    def status_updater(self, new_dict: dict):
+
+        def update() -> None:
+            self.status_bus.update(new_dict)
+
+        return update
+
+    ### *--- run the graph ---* ###
+    def run(self) -> int:
+        """
+        Launch the tasks as soon as their dependencies are finished.
+
+        return:
+            0 if all tasks finished, otherwise the failed exit code.
+        """
+
+        if not self.tasks:
+            self.build()
+
+        # the critical chain goes first within a cycle
+        pending = sorted(
+            self.tasks.values(),
+            key=lambda task: (task.i_cycle, task.pool != 'critical'))
+
+        while pending or self.running:
+
+            for task in list(pending):
+                if self.ready(task):
+                    pending.remove(task)
+                    self.launch(task)
+
+            if not self.running:
+                raise RuntimeError('Unresolvable dependencies : %s' %
+                                   (pending))
+
+            # block until a process exits, the tasks finished by status code
+            # are checked every interval. The process of such a task may have
+            # exited already (e.g. a job submitted to a node), its sentinel
+            # would wake the wait at once and is left out
+            sentinels = [
+                task.process.sentinel for task in self.running
+                if task.process.exitcode is None
+            ]
+            submitted = [
+                task for task in self.running
+                if task.process.exitcode == 0 and task.status_section
+            ]
+            watch_status = any(task.status_section for task in self.running)
+            if sentinels:
+                wait(sentinels,
+                     timeout=self.interval if watch_status else None)
+            elif submitted:
+                self.status_bus.wait_for_finish(submitted[0].status_section,
+                                                interval=self.interval)
+
+            exit_code = self.collect()
+            if exit_code != 0:
+                self.terminate()
+                return exit_code
+
+        return 0
+
+    def ready(self, task: Task) -> bool:
+
+        if not all(dep in self.finished or not dep in self.tasks
+                   for dep in task.deps):
+            return False
+
+        n_running = len([t for t in self.running if t.pool == task.pool])
+
+        return n_running < self.limits.get(task.pool, 1)
+
+    def launch(self, task: Task) -> None:
+
+        if task.on_start is not None:
+            task.on_start()
+
+        if task.name == 'assimilation':
+            logging.info('Assimilation time : %s' %
+                         (self.asml_time_list[task.i_cycle]))
+
+        task.process = mp.Process(target=task.target,
+                                  name='%s_%s' % (task.name, task.i_cycle),
+                                  args=task.args)
+        task.process.start()
+        self.running.append(task)
+
+        logging.info('%s started' % (task))
+
+    def collect(self) -> int:
+
+        for task in list(self.running):
+
+            if task.process.is_alive():
+                continue
+
+            exit_code = task.process.exitcode
+            if exit_code == 0 and task.status_section is not None:
+                exit_code = self.status_code(task)
+                if exit_code is None:
+                    continue
+
+            self.running.remove(task)
+
+            if exit_code == 0:
+                self.finished.add(task.key)
+                logging.info('%s finished' % (task))
+
+            # post processing does not stop the system
+            elif task.pool == 'post':
+                self.finished.add(task.key)
+                logging.warning('%s failed with code %s' % (task, exit_code))
+
+            else:
+                logging.critical('%s failed with code %s' % (task, exit_code))
+                return exit_code
+
+        return 0
+
+    def status_code(self, task: Task):
+        """
+        0 when the section is finished, the code when it failed and None when
+        it is still running, e.g. the job submitted to a node.
+        """
+
+        code = self.status_bus.read(task.status_section).get('code', 0)
+
+        if code == 100:
+            return 0
+        elif code < 0:
+            return code
+        else:
+            return None
+
+    def terminate(self) -> None:
+
+        for task in self.running:
+            if task.process.is_alive():
+                task.process.terminate()
+                task.process.join()
+                logging.warning('%s terminated' % (task))
+
+        self.running = []
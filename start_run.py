@@ -16,15 +16,16 @@ import Model
 import post_model
 
 import system_lib as stl
+import scheduler_lib as scl
 
 home_dir = os.getcwd()
 pid = os.getpid()
 
 config_dir = './config'
 status_path = './Status.json'
+status_bus = stl.StatusBus(status_path)
 
-stl.edit_json(
-    path=status_path,
+status_bus.update(
     new_dict={'system': {
         'running': True,
         'pid': pid,
@@ -43,11 +44,9 @@ system_project = '%s_%s' % (
     Config['Model'][model_scheme]['run_project'],
     Config['Assimilation'][assimilation_scheme]['project_name'])
 
-Status = stl.edit_json(
-    path=status_path,
-    new_dict={'system': {
-        'system_project': system_project,
-    }})
+Status = status_bus.update(new_dict={'system': {
+    'system_project': system_project,
+}})
 
 ### *--------------------------------------* ###
 ###                                          ###
@@ -83,23 +82,41 @@ asml_time_list, model_time_list = rt.get(Config['Initial']['run_time'])
 ### *---------------------------------* ###
 ### *---    start the main loop    ---* ###
 
+### *--- pipelined cycles ---* ###
+scheduler_config = Config['Initial'].get('scheduler', {})
+if scheduler_config.get('pipeline', False):
+
+    system_log.info('Cycles are pipelined, %s cycles to run' %
+                    (len(asml_time_list)))
+
+    scheduler = scl.CycleScheduler(Config, status_bus, asml_time_list,
+                                   model_time_list, **scheduler_config)
+    exit_code = scheduler.run()
+    if exit_code != 0:
+        system_log.critical('ERROR happened in the cycles, system aborted.')
+        sys.exit(exit_code)
+
+    # the sequential loop below is skipped
+    asml_time_list = []
+
+### *--- sequential cycles ---* ###
 for i_time in range(len(asml_time_list)):
 
     system_log.write(stl.number_guide(i_time + 1))
 
     ### initialize the status ###
-    Status = stl.edit_json(path=status_path,
-                           new_dict={
-                               'assimilation': {
-                                   'code': 0,
-                                   'assimilation_time': asml_time_list[i_time],
-                                   'post_process_code': 0
-                               },
-                               'model': {
-                                   'code': 0,
-                                   'post_process_code': 0
-                               }
-                           })
+    Status = status_bus.update(
+        new_dict={
+            'assimilation': {
+                'code': 0,
+                'assimilation_time': asml_time_list[i_time],
+                'post_process_code': 0
+            },
+            'model': {
+                'code': 0,
+                'post_process_code': 0
+            }
+        })
 
     ### *-------------------------------------------* ###
     ### *---   preparation before assimilation   ---* ###
@@ -143,7 +160,8 @@ for i_time in range(len(asml_time_list)):
         # assimilation_process.join()
 
         ### *--- wait until assimilation finish ---* ###
-        status = stl.check_status_code('Status.json', 'assimilation', 'code')
+        status_bus.wait_for_start('assimilation')
+        status = status_bus.wait_for_finish('assimilation')
         if status < 0:
             system_log.critical(
                 'ERROR happened during assimilation, system aborted.')
@@ -173,14 +191,13 @@ for i_time in range(len(asml_time_list)):
     if model_time_list is None:
         system_log.warning('Model forecast skipped')
     else:
-        Status = stl.edit_json(path=status_path,
-                               new_dict={
-                                   'model': {
-                                       'start_time':
-                                       model_time_list[i_time][0],
-                                       'end_time': model_time_list[i_time][1],
-                                   }
-                               })
+        Status = status_bus.update(
+            new_dict={
+                'model': {
+                    'start_time': model_time_list[i_time][0],
+                    'end_time': model_time_list[i_time][1],
+                }
+            })
 
         ### *----------------------------------* ###
         ### *---     start to run model     ---* ###
@@ -195,7 +212,8 @@ for i_time in range(len(asml_time_list)):
         model_process.start()
         model_process.join()
 
-        status = stl.check_status_code('Status.json', 'model', 'code')
+        status_bus.wait_for_start('model')
+        status = status_bus.wait_for_finish('model')
         if status < 0:
             system_log.critical('ERROR happened during model forecast.\n')
             sys.exit(status)
@@ -226,4 +244,4 @@ for i_time in range(len(asml_time_list)):
 ### *--- End of the System ---* ###
 system_log.info('All work done successfully.')
 system_log.write(stl.finished())
-stl.edit_json(path=status_path, new_dict={'system': {'running': False}})
+status_bus.update(new_dict={'system': {'running': False}})
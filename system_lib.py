@@ -8,7 +8,9 @@ import re
 import os
 import time
 import json
+import fcntl
 import logging
+import tempfile
 import pandas as pd
 from glob import iglob
 from datetime import datetime, timedelta
@@ -53,15 +55,146 @@ def update_dict(dict1: dict, dict2: dict) -> dict:
 
 def edit_json(path: str, new_dict: dict) -> dict:
 
-    with open(path, 'r') as jsonFile:
-        data = json.load(jsonFile)
+    return StatusBus(path).update(new_dict)
 
-    data = update_dict(data, new_dict)
 
-    with open(path, 'w') as jsonFile:
-        json.dump(data, jsonFile)
+### *--- lock-protected status store shared by all the parts ---* ###
+class StatusBus:
 
-    return data
+    def __init__(self, path: str, lock_path=None) -> None:
+        """
+        Status file with atomic updates and blocking waits. The file stays a
+        plain json (sections "system", "assimilation", "model"), so it can
+        be read by anyone and shared by the gate and the computing nodes.
+
+        params:
+            path: path of the status file.
+            lock_path: path of the lock file, default is path + ".lock".
+        """
+
+        self.path = path
+        self.lock_path = lock_path or path + '.lock'
+        self.signature = None
+
+    ### *--- POSIX record lock, also honoured on NFS ---* ###
+    def lock(self, exclusive=True):
+
+        lock_file = open(self.lock_path, 'a+')
+        fcntl.lockf(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+        return lock_file
+
+    def unlock(self, lock_file) -> None:
+
+        fcntl.lockf(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def read(self, section=None) -> dict:
+
+        lock_file = self.lock(exclusive=False)
+        try:
+            data = self._load()
+        finally:
+            self.unlock(lock_file)
+
+        return data if section is None else data.get(section, {})
+
+    def update(self, new_dict: dict) -> dict:
+        """
+        Merge new_dict into the status, the read-modify-write is done under
+        an exclusive lock and the file is replaced atomically.
+        """
+
+        lock_file = self.lock(exclusive=True)
+        try:
+            data = update_dict(self._load(), new_dict)
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(
+                os.path.abspath(self.path)),
+                                            prefix='.status_')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        finally:
+            self.unlock(lock_file)
+
+        return data
+
+    def _load(self) -> dict:
+
+        if not os.path.exists(self.path):
+            return {}
+
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    ### *--- wait for a status change ---* ###
+    def changed(self) -> bool:
+        """
+        Cheap check with os.stat, the file is only parsed when it changed.
+        """
+
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            signature = None
+
+        if signature == self.signature:
+            return False
+
+        self.signature = signature
+        return True
+
+    def wait(self,
+             section: str,
+             key: str,
+             condition,
+             interval=1,
+             timeout=None):
+        """
+        Block until condition(status[section][key]) is True.
+
+        params:
+            section: status section, e.g. "assimilation".
+            key: key in the section, e.g. "code".
+            condition: callable on the value.
+            interval: maximum time (s) between two checks.
+            timeout: give up after timeout (s) and raise TimeoutError.
+
+        return:
+            the value that fulfils the condition.
+        """
+
+        start = time.time()
+        self.signature = None
+        sleep = min(0.05, interval)
+
+        while True:
+
+            if self.changed():
+                value = self.read(section).get(key)
+                if condition(value):
+                    return value
+                # react quickly right after a change
+                sleep = min(0.05, interval)
+
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError('Waiting for %s.%s timed out' %
+                                   (section, key))
+
+            time.sleep(sleep)
+            sleep = min(sleep * 2, interval)
+
+    def wait_for_start(self, section: str, key='code', **kwargs) -> int:
+        return self.wait(section, key,
+                         lambda code: code is not None and code != 0, **kwargs)
+
+    def wait_for_finish(self, section: str, key='code', **kwargs) -> int:
+        return self.wait(
+            section, key,
+            lambda code: code is not None and (code == 100 or code < 0),
+            **kwargs)
 
 
 ### *--- design for advanced log record ---* ###
@@ -231,25 +364,12 @@ def check_status_code(path: str,
                       interval=1,
                       check_start=True) -> int:
 
-    def read_status() -> int:
-        with open(path, 'r') as f:
-            return json.load(f)[section][key]
-
-    def wait_for_start() -> None:
-        while read_status() == 0:
-            time.sleep(interval)
-
-    def wait_for_finish() -> int:
-        status = read_status()
-        while status != 100 and status >= 0:
-            time.sleep(interval)
-            status = read_status()
-        return status
+    bus = StatusBus(path)
 
     if check_start:
-        wait_for_start()
+        bus.wait_for_start(section, key, interval=interval)
 
-    return wait_for_finish()
+    return bus.wait_for_finish(section, key, interval=interval)
 
 
 ### mark the number of the assimilation loop ###
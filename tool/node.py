@@ -5,9 +5,14 @@ LastEditTime: 2024-03-23 09:28:46
 Description: designed for jobs running on node
 '''
 import os
+import re
+import math
 import time
+import heapq
 import random
 import logging
+import threading
+import subprocess
 
 from decorators import deprecated
 
@@ -156,7 +161,14 @@ class NodeScript_test:
                  parallel_mode='smp',
                  executor='/bin/bash',
                  management='SGE',
+                 array_size=0,
+                 max_running=None,
                  **kwargs) -> None:
+        """
+        params:
+            array_size: number of tasks of an array job, 0 for a single job.
+            max_running: maximum number of array tasks running at once.
+        """
 
         self.path = path
         self.node_id = node_id
@@ -167,6 +179,8 @@ class NodeScript_test:
         self.management = management
         self.out_file = out_file if out_file else f'{job_name}_out.log'
         self.error_file = error_file if error_file else f'{job_name}_error.log'
+        self.array_size = int(array_size)
+        self.max_running = max_running
 
         self.script_list = self._generate_script(**kwargs)
 
@@ -207,8 +221,11 @@ class NodeScript_test:
         script_list.append('#$ -S %s' % (executor))  # shell environment
         script_list.append('#$ -j y')  #standard error to the output file (y|n)
 
-        # assign the submission node id
-        if isinstance(node_id, int) or node_id.isdigit():
+        # assign the submission node id, a list of nodes for the array job
+        if isinstance(node_id, (list, tuple)):
+            script_list.append('#$ -q %s' % (','.join(
+                ['all.q@compute-0-%s.local' % (node) for node in node_id])))
+        elif isinstance(node_id, int) or node_id.isdigit():
             script_list.append('#$ -q all.q@compute-0-%s.local' % (node_id))
         elif isinstance(node_id, str):
             script_list.append('#$ -q %s' % (node_id))
@@ -223,6 +240,12 @@ class NodeScript_test:
         # assign the parallel computing mode and number
         script_list.append('#$ -pe %s %s' % (parallel_mode, core_demand))
 
+        # one task for every run directory
+        if self.array_size > 0:
+            script_list.append('#$ -t 1-%s' % (self.array_size))
+            if self.max_running:
+                script_list.append('#$ -tc %s' % (self.max_running))
+
         return script_list
 
     ### *--- Strategy for Simple Linux Utility for Resource Management (SLURM) ---* ###
@@ -240,13 +263,27 @@ class NodeScript_test:
 
         ### generate the submission script worked on SLURM ###
         script_list.append('#!' + executor)
-        script_list.append('#SBATCH -n ')
-        script_list.append('#SBATCH -N ')
-        script_list.append('#SBATCH -t ')
-        script_list.append('#SBATCH -p ')
-        script_list.append('#SBATCH --mem=')
-        script_list.append('#SBATCH -o ')
-        script_list.append('#SBATCH -e ')
+        script_list.append('#SBATCH -J %s' % (job_name))  # job name
+        script_list.append('#SBATCH -N 1')  # all the cores on one node
+        script_list.append('#SBATCH -n 1')
+        script_list.append('#SBATCH -c %s' % (core_demand))  # cores of a task
+
+        # a named partition, the node is left to SLURM
+        if isinstance(node_id, str) and not node_id.isdigit():
+            script_list.append('#SBATCH -p %s' % (node_id))
+
+        # assign the standard output and error file
+        script_list.append('#SBATCH -o %s' % (out_file))
+        script_list.append('#SBATCH -e %s' % (error_file))
+
+        # one task for every run directory
+        if self.array_size > 0:
+            if self.max_running:
+                script_list.append('#SBATCH --array=1-%s%%%s' %
+                                   (self.array_size, self.max_running))
+            else:
+                script_list.append('#SBATCH --array=1-%s' %
+                                   (self.array_size))
 
         return script_list
 
@@ -268,8 +305,8 @@ class NodeScript_test:
         script_list.append('#PBS -S %s' % (executor))  #shell environment
         script_list.append('#PBS -V')  # current environment Variables
         script_list.append('#PBS -N %s' % (job_name))  #  job name
-        script_list.append('#PBS -l nodes=%s:ppn=%s' %
-                           (core_demand, node_id))  # node number and cores
+        script_list.append('#PBS -l nodes=1:ppn=%s' %
+                           (core_demand))  # cores on one node
 
         # assign the standard output file
         if out_file == '':
@@ -281,6 +318,10 @@ class NodeScript_test:
             error_file = job_name + '_error.log'
         script_list.append('#PBS -e %s' % (error_file))
 
+        # one task for every run directory
+        if self.array_size > 0:
+            script_list.append('#PBS -J 1-%s' % (self.array_size))
+
         return script_list
 
     ### *--- add extra config scripts if necessary ---* ###
@@ -296,6 +337,32 @@ class NodeScript_test:
 
         self.script_list += args
 
+    ### *--- resolve the run directory of every array task ---* ###
+    def add_array_dirs(self, run_dirs: list, run_ids: list) -> None:
+        """
+        Move every array task to its own run directory. The output of the
+        task goes to log/<run_id>.out.log there, the same as the single job.
+        """
+
+        if len(run_dirs) != self.array_size or len(run_ids) != self.array_size:
+            raise ValueError('%s run directories for an array of %s tasks' %
+                             (len(run_dirs), self.array_size))
+
+        task_id_options = {
+            'SGE': 'SGE_TASK_ID',
+            'SLURM': 'SLURM_ARRAY_TASK_ID',
+            'PBS': 'PBS_ARRAY_INDEX'
+        }
+
+        self.add(
+            'run_dirs=(%s)' % (' '.join('"%s"' % (d) for d in run_dirs)),
+            'run_ids=(%s)' % (' '.join('"%s"' % (i) for i in run_ids)),
+            'i_task=$((${%s} - 1))' % (task_id_options[self.management]),
+            'cd "${run_dirs[$i_task]}" || exit 1',
+            'mkdir -p log',
+            'exec > "log/${run_ids[$i_task]}.out.log" '
+            '2> "log/${run_ids[$i_task]}.err.log"')
+
     ### *--- write to the submission file ---* ###
     def write(self, ) -> None:
 
@@ -316,123 +383,361 @@ class NodeScript_test:
         return submit_command
 
 
-### *--- check the available cores in node ---* ###
-class CheckNode:
-
-    def __init__(self, management='SGE') -> None:
+### *--- snapshot of the cluster state shared by all the queries ---* ###
+class ClusterSnapshot:
 
+    def __init__(self,
+                 management='SGE',
+                 ttl=30,
+                 min_interval=10,
+                 hold=120) -> None:
+        """
+        params:
+            management: job management system.
+            ttl: seconds a queried state is reused before it is refreshed.
+            min_interval: minimum seconds between two queries of a source,
+                          also for the forced refresh.
+            hold: seconds the cores booked by our own submissions are
+                  counted when the scheduler query fails, the bookings
+                  are dropped once a query reports the node usage.
+        """
+
+        # the sources of every management, the slow changing ones are
+        # refreshed less frequently
         managements = {
-            'SGE': self.SGE_query,
-            'PBS': self.PBS_query,
-            'SLURM': self.SLURM_query
+            'SGE': [(self.SGE_query, ttl), (self.SGE_host_query, ttl * 10)],
+            'PBS': [(self.PBS_query, ttl)],
+            'SLURM': [(self.SLURM_query, ttl)]
         }
         if management not in managements.keys():
             raise ValueError('Management : "%s" is not supported yet' %
-                             (self.management))
-        else:
-            self.management = management
-            self.managements = managements
+                             (management))
 
-    ### *------------------------* ###
-    ### *---   Query Portal   ---* ###
-    def query(self, **kwargs) -> None:
+        self.management = management
+        self.sources = managements[management]
+        self.updated = [0.] * len(self.sources)
+        self.min_interval = min_interval
+        self.hold = hold
+
+        self.nodes = {}
+        self.booked = []
+        self.lock = threading.Lock()
+
+    ### *--- incremental refresh of the expired sources ---* ###
+    def refresh(self, force=False) -> dict:
 
-        return self.managements.get(self.management)(**kwargs)
+        with self.lock:
 
-    ### *-- querry the Sun Grid Engine node ---* ###
-    def SGE_query(self,
+            for i_source, (source, ttl) in enumerate(self.sources):
+
+                age = time.time() - self.updated[i_source]
+                if age < self.min_interval or (age < ttl and not force):
+                    continue
+
+                query_time = time.time()
+                reported = []
+                for node, info in source().items():
+                    self.nodes.setdefault(node, {}).update(info)
+                    if 'core_used' in info:
+                        reported.append(node)
+                self.updated[i_source] = time.time()
+
+                # the jobs booked before a successful usage query are
+                # already counted in its core_used
+                self.booked = [
+                    book for book in self.booked
+                    if book[0] >= query_time or not book[1] in reported
+                ]
+
+            # the bookings of nodes the query failed on expire by age
+            self.booked = [
+                book for book in self.booked
+                if time.time() - book[0] < self.hold
+            ]
+
+            return {node: info.copy() for node, info in self.nodes.items()}
+
+    ### *--- local bookkeeping of our own submissions ---* ###
+    def book(self, node: str, cores: int) -> None:
+
+        with self.lock:
+            self.booked.append((time.time(), node, int(cores)))
+
+    def booked_cores(self, node: str) -> int:
+        return sum([book[2] for book in self.booked if book[1] == node])
+
+    ### *--- nodes qualified for the demand ---* ###
+    def available(self,
                   demand=1,
-                  random_choice=False,
-                  return_type='number',
                   reserve=0,
-                  wait_time=120,
-                  black_list=['1', '2', '3', '12'],
+                  black_list=[],
                   load_max=50,
                   mem_min=10,
-                  **kwargs) -> None:
-
-        ### *--- settings ---* ###
-        demand = kwargs.get('demand', demand)
-        random_choice = kwargs.get('random_choice', random_choice)
-        return_type = kwargs.get('return_type', return_type)
-        reserve = kwargs.get('reserve', reserve)
-        wait_time = kwargs.get('wait_time', wait_time)  # minutes
-        black_list = kwargs.get('black_list', black_list)
-        load_max = kwargs.get(
-            'load_max', load_max)  # set the threshold of load on cpu usage
-        mem_min = kwargs.get('mem_min',
-                             mem_min)  # the minimum memory needed, unit : GB
+                  force=False) -> dict:
+        """
+        return:
+            {node: info} of the qualified nodes, info['core_free'] is the
+            number of cores left after the reserve and our bookings.
+        """
 
-        ### *--- Main Loop ---* ###
-        for wait in range(wait_time):
+        node_info = self.refresh(force=force)
+        keys = ('number', 'core_total', 'core_used', 'load_avg', 'mem_total',
+                'mem_used')
+
+        for node in list(node_info.keys()):
 
-            ### *--- check the node information ---* ###
-            process = os.popen('qstat -f')  # return file
-            # columns : queuename qtype resv/used/tot. load_avg arch states
-            node_querry1 = process.read().split('\n')
-            process.close()
+            info = node_info[node]
+            if not all(key in info for key in keys) or \
+                    info['number'] in black_list:
+                node_info.pop(node)
+                continue
 
-            process = os.popen('qhost')  # return file
-            # columns : HOSTNAME ARCH NCPU NSOC NCOR NTHR LOAD MEMTOT MEMUSE SWAPTO SWAPUS
-            node_querry2 = process.read().split('\n')
-            process.close()
+            core_free = info['core_total'] - info['core_used'] - \
+                self.booked_cores(node)
 
-            ### *--- arrange the information ---* ###
-            node_info = {}
-            for line in node_querry1:
-                if line.startswith('all.q@compute-'):
+            ### decide if the node has enough core I need ###
+            condition1 = reserve <= core_free - demand
+
+            ### decide if the node are too busy ###
+            condition2 = info['load_avg'] < load_max
+
+            ### decide if the node has enough memory I need ###
+            condition3 = info['mem_total'] - info['mem_used'] > mem_min
+
+            if condition1 and condition2 and condition3:
+                info['core_free'] = core_free - reserve
+            else:
+                node_info.pop(node)
 
-                    info_split = line.split()
+        return node_info
+
+    ### *--- query the Sun Grid Engine node ---* ###
+    def SGE_query(self) -> dict:
+
+        node_info = {}
+        # columns : queuename qtype resv/used/tot. load_avg arch states
+        for line in read_command('qstat -f').split('\n'):
+            if line.startswith('all.q@compute-'):
+
+                info_split = line.split()
+                try:
                     node_info[info_split[0]] = {
                         'number': info_split[0].split('-')[2].split('.')[0],
                         'core_total': int(info_split[2].split('/')[2]),
                         'core_used': int(info_split[2].split('/')[1]),
                         'load_avg': float(info_split[3])
                     }
-            for line in node_querry2:
-                if line.startswith('compute-'):
-                    info_split = line.split()
-                    node_info['all.q@%s.local' % (info_split[0])].update({
-                        'mem_total':
-                        float(info_split[7][:-1]),
-                        'mem_used':
-                        float(info_split[8][:-1])
-                    })
+                except (IndexError, ValueError):
+                    # the unreachable node reports -NA-
+                    continue
+
+        return node_info
 
-            ### *--- screen the unqualified node ---* ###
-            for node in node_info.copy().keys():
+    def SGE_host_query(self) -> dict:
 
-                ### exclude the node in black list ###
-                if not node_info[node]['number'] in black_list:
+        node_info = {}
+        # columns : HOSTNAME ARCH NCPU NSOC NCOR NTHR LOAD MEMTOT MEMUSE SWAPTO SWAPUS
+        for line in read_command('qhost').split('\n'):
+            if line.startswith('compute-'):
 
-                    ### decide if the node has enough core I need ###
-                    condition1 = reserve <= node_info[node][
-                        'core_total'] - node_info[node]['core_used'] - demand
+                info_split = line.split()
+                try:
+                    node_info['all.q@%s.local' % (info_split[0])] = {
+                        'mem_total': to_gb(info_split[7]),
+                        'mem_used': to_gb(info_split[8])
+                    }
+                except (IndexError, ValueError):
+                    continue
+
+        return node_info
+
+    ### *--- query the Simple Linux Utility for Resource Management node ---* ###
+    def SLURM_query(self) -> dict:
+
+        node_info = {}
+        # columns : NODELIST CPUS(A/I/O/T) CPU_LOAD MEMORY(MB) FREE_MEM(MB)
+        for line in read_command('sinfo -N -h -o "%N %C %O %m %e"').split(
+                '\n'):
+
+            info_split = line.split()
+            try:
+                cpus = info_split[1].split('/')
+                mem_total = to_gb(info_split[3], unit='M')
+                node_info[info_split[0]] = {
+                    'number': node_number(info_split[0]),
+                    'core_total': int(cpus[3]),
+                    'core_used': int(cpus[3]) - int(cpus[1]),
+                    'load_avg': float(info_split[2]),
+                    'mem_total': mem_total,
+                    'mem_used': mem_total - to_gb(info_split[4], unit='M')
+                }
+            except (IndexError, ValueError):
+                # the node down reports N/A
+                continue
+
+        return node_info
+
+    ### *--- query the Portable Batch System node ---* ###
+    def PBS_query(self) -> dict:
+
+        node_info = {}
+        # blocks of "key = value" lines under the node name, both Torque
+        # (np, jobs, status) and PBS Pro (resources_*) are understood
+        for block in read_command('pbsnodes -a').split('\n\n'):
+
+            lines = [line for line in block.split('\n') if line.strip()]
+            if len(lines) == 0:
+                continue
+
+            attrs = {}
+            for line in lines[1:]:
+                if '=' in line:
+                    key, value = line.split('=', 1)
+                    attrs[key.strip()] = value.strip()
+
+            if 'down' in attrs.get('state', '') or 'offline' in attrs.get(
+                    'state', ''):
+                continue
+
+            status = dict(
+                item.split('=', 1) for item in attrs.get('status', '').split(',')
+                if '=' in item)
+
+            try:
+                if 'resources_available.ncpus' in attrs:
+                    core_total = int(attrs['resources_available.ncpus'])
+                    core_used = int(attrs.get('resources_assigned.ncpus', 0))
+                    mem_total = to_gb(attrs['resources_available.mem'])
+                    mem_used = to_gb(attrs.get('resources_assigned.mem', '0'))
+                else:
+                    core_total = int(attrs['np'])
+                    core_used = len([
+                        job for job in attrs.get('jobs', '').split(',')
+                        if job.strip()
+                    ])
+                    mem_total = to_gb(status['physmem'])
+                    mem_used = mem_total - to_gb(status['availmem'])
+            except (KeyError, ValueError):
+                continue
 
-                    ### decide if the node are too busy ###
-                    condition2 = node_info[node]['load_avg'] < load_max
+            node_name = lines[0].strip()
+            node_info[node_name] = {
+                'number': node_number(node_name),
+                'core_total': core_total,
+                'core_used': core_used,
+                'load_avg': float(status.get('loadave', 0)),
+                'mem_total': mem_total,
+                'mem_used': mem_used
+            }
 
-                    ### decide if the node has enough memory I need ###
-                    condition3 = node_info[node]['mem_total'] - node_info[
-                        node]['mem_used'] > mem_min
+        return node_info
 
-                    if not condition1 or not condition2 or not condition3:
-                        node_info.pop(node)
 
-                else:
-                    node_info.pop(node)
+### *--- one snapshot per management in a process ---* ###
+snapshots = {}
+
+
+def get_snapshot(management='SGE', **kwargs) -> ClusterSnapshot:
+
+    if management not in snapshots.keys():
+        snapshots[management] = ClusterSnapshot(management, **kwargs)
+
+    return snapshots[management]
+
+
+def read_command(command: str) -> str:
+
+    result = subprocess.run(command,
+                            shell=True,
+                            capture_output=True,
+                            text=True)
+    if result.returncode != 0:
+        logging.warning('%s failed : %s' % (command, result.stderr.strip()))
+
+    return result.stdout
+
+
+def to_gb(value: str, unit='G') -> float:
+    """
+    Convert the memory like "251.9G", "1024mb" or "263856kb" to GB,
+    the value without suffix is in the given unit.
+    """
+
+    factors = {'K': 1024**-2, 'M': 1024**-1, 'G': 1, 'T': 1024}
+
+    value = value.strip().upper().rstrip('B')
+    if value[-1] in factors.keys():
+        unit, value = value[-1], value[:-1]
+
+    return float(value) * factors[unit]
+
+
+def node_number(node_name: str) -> str:
+    """
+    Trailing digits of the node name, e.g. "cn012" -> "12"
+    """
+
+    digits = re.search(r'(\d+)$', node_name.split('.')[0])
+
+    return str(int(digits.group(1))) if digits else node_name
+
+
+### *--- check the available cores in node ---* ###
+class CheckNode:
+
+    def __init__(self, management='SGE', **kwargs) -> None:
+        """
+        params:
+            management: job management system.
+            kwargs: passed to the shared ClusterSnapshot, e.g. ttl.
+        """
+
+        self.management = management
+        self.snapshot = get_snapshot(management, **kwargs)
+
+    ### *------------------------* ###
+    ### *---   Query Portal   ---* ###
+    def query(self,
+              demand=1,
+              random_choice=False,
+              return_type='number',
+              reserve=0,
+              wait_time=120,
+              black_list=['1', '2', '3', '12'],
+              load_max=50,
+              mem_min=10,
+              **kwargs):
+        """
+        Select the nodes from the shared snapshot. The cores of the node
+        returned as "number" or "str" are booked for the demand, as the
+        job is submitted right after.
+
+        params:
+            wait_time: minutes to wait for an available node.
+            load_max: the threshold of load on cpu usage.
+            mem_min: the minimum memory needed, unit : GB
+        """
+
+        return_types = ('number', 'str', 'number_list', 'str_list')
+        if return_type not in return_types:
+            raise ValueError('Invalid return type -> "%s" <-' % (return_type))
+
+        ### *--- Main Loop ---* ###
+        for wait in range(wait_time):
+
+            node_info = self.snapshot.available(demand=demand,
+                                                reserve=reserve,
+                                                black_list=black_list,
+                                                load_max=load_max,
+                                                mem_min=mem_min,
+                                                force=wait > 0)
 
             if len(node_info) == 0:
                 logging.warning('node busy')
                 time.sleep(60)
             else:
-                # logging.debug(node_info)
                 break
 
-        ### *--- produce the output ---* ###
-        # available_num.append([node_id, total - used - reserve])
-        # available_str.append([node_info[0], total - used - reserve])
-
         ### if there isn't enough available core detected in due time,
         ### return the false flag
         if len(node_info) == 0:
@@ -441,88 +746,310 @@ class CheckNode:
                                (wait_time))
 
         ### *--- decide which type of the result to return ---* ###
-        # return a node number
-        if return_type == 'number':
+        # return a node number or a node name string
+        if return_type in ('number', 'str'):
 
             if random_choice:
                 node_id = random.choice(list(node_info.keys()))
             else:
                 node_id = sorted(list(node_info.keys()))[0]
 
-            return int(node_info[node_id]['number'])
+            self.snapshot.book(node_id, demand)
 
-        # return a node name string
-        elif return_type == 'str':
-
-            if random_choice:
-                node_id = random.choice(list(node_info.keys()))
+            if return_type == 'number':
+                return int(node_info[node_id]['number'])
             else:
-                node_id = sorted(list(node_info.keys()))[0]
-
-            return node_id
+                return node_id
 
         # return a list contains all the available node number
         elif return_type == 'number_list':
 
-            number_list = []
-            for node_id in node_info.keys():
-                number_list.append([
-                    node_info[node_id]['number'],
-                    node_info[node_id]['core_total'] -
-                    node_info[node_id]['core_used'] - reserve
-                ])
-            return number_list
+            return [[info['number'], info['core_free']]
+                    for info in node_info.values()]
 
         # return a list contains all the available node string
         elif return_type == 'str_list':
 
-            str_list = []
-            for node_id in node_info.keys():
-                str_list.append([
-                    node_id, node_info[node_id]['core_total'] -
-                    node_info[node_id]['core_used'] - reserve
-                ])
-            return str_list
+            return [[node_id, info['core_free']]
+                    for node_id, info in node_info.items()]
+
+
+### *--- submit the whole ensemble as one array job ---* ###
+def submit_array(run_dirs: list,
+                 run_ids: list,
+                 commands: list,
+                 path: str,
+                 management='SGE',
+                 **kwargs) -> str:
+    """
+    Launch all the members in one scheduler transaction.
+
+    params:
+        run_dirs: run directory of every member.
+        run_ids: run id of every member.
+        commands: commands run in the run directory of the member.
+        path: path of the array submission script.
+        management: job management system.
+        kwargs: passed to NodeScript_test, e.g. node_id, core_demand and
+                max_running.
+
+    return:
+        output of the submission command, e.g. the job id.
+    """
+
+    submission = NodeScript_test(path=path,
+                                 management=management,
+                                 array_size=len(run_dirs),
+                                 **kwargs)
+    submission.add_array_dirs(run_dirs, run_ids)
+    submission.add(*commands)
+
+    result = subprocess.run(submission.get_command(),
+                            shell=True,
+                            cwd=os.path.dirname(os.path.abspath(path)),
+                            capture_output=True,
+                            text=True)
+    if result.returncode != 0:
+        raise RuntimeError('Array job submission failed : %s' %
+                           (result.stderr.strip()))
+
+    return result.stdout.strip()
+
+
+### *--- job id in the output of the submission command ---* ###
+def parse_job_id(output: str, management='SGE') -> str:
+    """
+    e.g. "Your job 1234 (...) has been submitted" for SGE,
+    "Submitted batch job 1234" for SLURM and "1234.server" for PBS.
+    """
+
+    if management == 'PBS':
+        return output.split()[0] if output.split() else ''
+
+    match = re.search(r'\d+', output)
+
+    return match.group() if match else ''
+
+
+### *--- cancel the submitted jobs ---* ###
+def cancel_jobs(job_ids: list, management='SGE') -> None:
+
+    command_options = {'SGE': 'qdel', 'SLURM': 'scancel', 'PBS': 'qdel'}
+    if management not in command_options.keys():
+        raise ValueError('Invalid management -> "%s" <-' % (management))
+
+    job_ids = [job_id for job_id in job_ids if job_id]
+    if len(job_ids) == 0:
+        return
+
+    result = subprocess.run([command_options[management]] + job_ids,
+                            capture_output=True,
+                            text=True)
+    if result.returncode != 0:
+        logging.warning('Cancel of jobs %s failed : %s' %
+                        (job_ids, result.stderr.strip()))
+
+
+### *--- place the members on the nodes as a bin packing problem ---* ###
+def pack_members(capacity: dict, member_number: int, policy='pack') -> list:
+    """
+    Assign the members of equal demand to the nodes.
+
+    params:
+        capacity: {node: (slots, load)}, slots is the number of members
+                  fitting on the node, load breaks the ties.
+        member_number: number of members to place.
+        policy: "pack" fills as few nodes as possible, "spread" balances
+                the members over all the nodes.
+
+    return:
+        node of every member, None if the capacity is short.
+    """
+
+    if policy not in ('pack', 'spread'):
+        raise ValueError('Invalid placement policy -> "%s" <-' % (policy))
+
+    slots = {node: capacity[node][0] for node in capacity.keys()}
+    if sum(slots.values()) < member_number:
+        return None
 
-    def PBS_query(self, ):
-        pass
+    placement = []
 
-    def SLURM_query(self, ):
-        pass
+    # first fit decreasing, the largest and least loaded nodes are filled up
+    if policy == 'pack':
+
+        for node in sorted(slots.keys(),
+                           key=lambda node: (-slots[node], capacity[node][1])):
+            n_member = min(slots[node], member_number - len(placement))
+            placement += [node] * n_member
+
+    # worst fit, every member goes to the node with the most free slots
+    elif policy == 'spread':
+
+        heap = [(-slots[node], capacity[node][1], node)
+                for node in slots.keys() if slots[node] > 0]
+        heapq.heapify(heap)
+        for i_member in range(member_number):
+            free, load, node = heapq.heappop(heap)
+            placement.append(node)
+            if free + 1 < 0:
+                heapq.heappush(heap, (free + 1, load, node))
+
+    return placement
+
+
+### *--- placement engine of the ensemble ---* ###
+class NodeAllocator:
+
+    def __init__(self,
+                 check: CheckNode,
+                 core_demand=1,
+                 mem_demand=0,
+                 policy='pack',
+                 return_type='number',
+                 **kwargs) -> None:
+        """
+        params:
+            check: CheckNode whose snapshot describes the cluster.
+            core_demand: cores of every member.
+            mem_demand: memory of every member, unit : GB
+            policy: "pack" or "spread", see pack_members.
+            return_type: the node in the plan as "number" or "str".
+            kwargs: node filters of the query, i.e. reserve, black_list,
+                    load_max, mem_min and wait_time.
+        """
+
+        self.snapshot = check.snapshot
+        self.core_demand = int(core_demand)
+        self.mem_demand = float(mem_demand)
+        self.policy = policy
+        self.return_type = return_type
+
+        self.reserve = kwargs.get('reserve', 0)
+        self.black_list = kwargs.get('black_list', ['1', '2', '3', '12'])
+        self.load_max = kwargs.get('load_max', 50)
+        self.mem_min = kwargs.get('mem_min', 10)
+        self.wait_time = kwargs.get('wait_time', 120)  # minutes
+
+    ### *--- members fitting on every node by cores, memory and load ---* ###
+    def capacity(self, force=False) -> dict:
+
+        node_info = self.snapshot.available(demand=self.core_demand,
+                                            reserve=self.reserve,
+                                            black_list=self.black_list,
+                                            load_max=self.load_max,
+                                            mem_min=self.mem_min,
+                                            force=force)
+
+        capacity = {}
+        for node, info in node_info.items():
+
+            # the cores loaded outside the job manager are not free either
+            core_free = min(
+                info['core_free'], info['core_total'] - self.reserve -
+                math.ceil(info['load_avg']))
+            slots = core_free // self.core_demand
+
+            if self.mem_demand > 0:
+                mem_free = info['mem_total'] - info['mem_used'] - self.mem_min
+                slots = min(slots, int(mem_free // self.mem_demand))
+
+            if slots > 0:
+                capacity[node] = (slots, info['load_avg'] / info['core_total'])
+
+        return capacity
+
+    ### *--- full placement plan in one pass ---* ###
+    def plan(self, run_ids: list) -> dict:
+        """
+        Place the members and book their cores.
+
+        return:
+            {run_id: node}
+        """
+
+        for wait in range(self.wait_time):
+
+            placement = pack_members(self.capacity(force=wait > 0),
+                                     len(run_ids), self.policy)
+            if placement is None:
+                logging.warning('node busy')
+                time.sleep(60)
+            else:
+                break
+
+        if placement is None:
+            raise TimeoutError('No available core in due time (%s mins)' %
+                               (self.wait_time))
+
+        return self.book(run_ids, placement)
+
+    ### *--- place as many members as the free capacity allows ---* ###
+    def try_plan(self, run_ids: list, force=False) -> dict:
+        """
+        Same as plan but never waits, the members not fitting on the nodes
+        are left out of the returned plan.
+        """
+
+        capacity = self.capacity(force=force)
+        member_number = min(len(run_ids),
+                            sum(slots for slots, load in capacity.values()))
+
+        return self.book(run_ids[:member_number],
+                         pack_members(capacity, member_number, self.policy))
+
+    def book(self, run_ids: list, placement: list) -> dict:
+
+        plan = {}
+        for run_id, node in zip(run_ids, placement):
+            self.snapshot.book(node, self.core_demand)
+            plan[run_id] = int(self.snapshot.nodes[node]['number']) \
+                if self.return_type == 'number' else node
+
+        if len(run_ids) > 0:
+            logging.debug('%s members placed on %s nodes' %
+                          (len(run_ids), len(set(placement))))
+
+        return plan
+
+    ### *--- place the failed or preempted members only ---* ###
+    def replan(self, plan: dict, run_ids: list) -> dict:
+
+        plan = {
+            run_id: node
+            for run_id, node in plan.items() if not run_id in run_ids
+        }
+        plan.update(self.plan(run_ids))
+
+        return plan
 
 
 ### arange all the ensemble to a node list ###
-def arange_node_list(available_num: list, ensemble_number: int,
-                     core_demand: int) -> list:
+@deprecated
+def arange_node_list(available_num: list,
+                     ensemble_number: int,
+                     core_demand: int,
+                     policy='pack',
+                     management='SGE',
+                     **kwargs) -> list:
 
     core_demand = int(core_demand)
     ensemble_number = int(ensemble_number)
 
-    ### check if the available node is sufficient ###
-    available_flag = False
-    while not available_flag:
-
-        total_available = sum(
-            [available_num[i_node][1] for i_node in range(len(available_num))])
-        if ensemble_number * core_demand <= total_available:
-            available_flag = True
-        else:
-            logging.warning('node busy')
-            time.sleep(60)
-            available_num = CheckNode.query(demand=core_demand,
-                                            reserve=0,
-                                            return_type='number_list')
-
-    ### arrange a node list ###
-    node_list = []
-    for i in range(ensemble_number):
-        for j in range(len(available_num)):
-
-            if available_num[j][1] - core_demand >= 0:
-                # print(available_num)
-                node_list.append(int(available_num[j][0]))
-                available_num[j][1] = available_num[j][1] - core_demand
-                break
+    capacity = {
+        int(node): (int(cores) // core_demand, 0)
+        for node, cores in available_num
+    }
+    node_list = pack_members(capacity, ensemble_number, policy)
+
+    ### wait for the capacity through the placement engine ###
+    if node_list is None:
+        kwargs.pop('core_demand', None)
+        allocator = NodeAllocator(CheckNode(management),
+                                  core_demand=core_demand,
+                                  policy=policy,
+                                  **kwargs)
+        node_list = list(allocator.plan(list(range(ensemble_number))).values())
 
     return node_list
 
@@ -0,0 +1,163 @@
+'''
+Autor: Mijie Pang
+Date: 2024-04-27 10:05:41
+LastEditTime: 2024-04-27 16:22:18
+Description: columnar store of the observation files, every CSV is parsed
+once into a compact binary copy and the recent reads are kept in memory
+'''
+import os
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+
+class ObsStore:
+
+    def __init__(self, store_dir=None, max_entries=64) -> None:
+        """
+        params:
+            store_dir: directory of the binary copies, None for ".store"
+                       beside every CSV file.
+            max_entries: number of tables kept in memory.
+        """
+
+        self.store_dir = store_dir
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict()
+
+    ### *--- read the columns of an observation file ---* ###
+    def read(self, path: str, columns: list, header='infer', dtype=np.float32):
+        """
+        params:
+            path: path of the CSV file.
+            columns: names or positions of the columns to read.
+            header: passed to pandas.read_csv, None for the files without.
+            dtype: data type of all the columns read.
+
+        return:
+            dataframe with the columns in the given order, None if the file
+            does not exist.
+        """
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        source = (stat.st_size, stat.st_mtime_ns)
+        key = (os.path.abspath(path), tuple(columns), header)
+
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != source:
+
+            store_path = self.store_path(path, key)
+            data = self.load(store_path, source)
+            if data is None:
+                data = self.convert(path, store_path, source, columns, header,
+                                    dtype)
+
+            entry = (source, data)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        self.entries.move_to_end(key)
+
+        # the callers filter and edit their own copy
+        return entry[1].copy()
+
+    def store_path(self, path: str, key: tuple) -> str:
+
+        store_dir = self.store_dir if not self.store_dir is None else \
+            os.path.join(os.path.dirname(os.path.abspath(path)), '.store')
+        tag = hashlib.sha1(repr(key[1:]).encode()).hexdigest()[:8]
+
+        return os.path.join(store_dir,
+                            '%s.%s.npz' % (os.path.basename(path), tag))
+
+    ### *--- binary copy, invalid once the CSV changed ---* ###
+    def load(self, store_path: str, source: tuple):
+
+        if not os.path.exists(store_path):
+            return None
+
+        try:
+            with np.load(store_path, allow_pickle=False) as file:
+                if tuple(file['source']) != source:
+                    return None
+                names = [
+                    int(name) if is_int else str(name) for name, is_int in
+                    zip(file['names'], file['int_names'])
+                ]
+                data = pd.DataFrame({
+                    name: file['c%s' % (i_col)]
+                    for i_col, name in enumerate(names)
+                })
+        except (OSError, ValueError, KeyError) as error:
+            logging.debug('Observation store %s unreadable : %s' %
+                          (store_path, error))
+            return None
+
+        return data
+
+    def convert(self, path: str, store_path: str, source: tuple,
+                columns: list, header, dtype) -> pd.DataFrame:
+
+        data = pd.read_csv(path, usecols=columns, header=header, dtype=dtype)
+
+        # usecols keeps the order of the file
+        if all(isinstance(column, str) for column in columns):
+            data = data[list(columns)]
+        else:
+            data = data.iloc[:, np.argsort(np.argsort(columns))]
+
+        arrays = {
+            'c%s' % (i_col): data.iloc[:, i_col].values
+            for i_col in range(data.shape[1])
+        }
+        arrays['names'] = np.array([str(name) for name in data.columns])
+        arrays['int_names'] = np.array(
+            [isinstance(name, (int, np.integer)) for name in data.columns])
+        arrays['source'] = np.array(source, dtype=np.int64)
+
+        # the observation directory may be read only, the copy is optional
+        tmp_path = '%s.tmp%s' % (store_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                np.savez(file, **arrays)
+            os.replace(tmp_path, store_path)
+        except OSError as error:
+            logging.debug('Observation store %s not written : %s' %
+                          (store_path, error))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return data
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+### *--- one store per process and directory ---* ###
+stores = {}
+
+
+def get_store(store_dir=None, **kwargs) -> ObsStore:
+
+    if not store_dir in stores.keys():
+        stores[store_dir] = ObsStore(store_dir, **kwargs)
+
+    return stores[store_dir]
+
+
+def read_obs(path: str, columns: list, header='infer', store_dir=None,
+             **kwargs):
+    """
+    Read the columns of an observation file through the shared store.
+    """
+
+    return get_store(store_dir).read(path, columns, header=header, **kwargs)
@@ -1,7 +1,7 @@
 '''
 Autor: Mijie Pang
 Date: 2023-09-14 21:07:10
-LastEditTime: 2024-04-07 10:27:22
+LastEditTime: 2024-04-30 11:18:40
 Description: designed to store outputs in nc file
 '''
 import numpy as np
@@ -17,12 +17,24 @@ class NcProduct:
                  file_path='test.nc',
                  mode='w',
                  format='NETCDF4',
+                 buffer_size=0,
                  **kwargs):
+        """
+        params:
+            buffer_size: bytes of the data held by add_data before written,
+                         the records of a variable added in a row are
+                         written as one slab. 0 to write at once.
+        """
 
         self.file_path = self.ensure_nc_extension(file_path)
         self.nc_file = nc.Dataset(self.file_path, mode, format=format)
         self.init_file(mode, **kwargs)
 
+        self.buffer_size = buffer_size
+        self.buffer = {}
+        self.buffered_bytes = 0
+        self.record_dims = {}
+
     @staticmethod
     def ensure_nc_extension(file_path: str) -> str:
 
@@ -68,16 +80,67 @@ class NcProduct:
 
     ### *--- define the variables and their dimension in the nc file ---* ###
     def define_variable(self, **kwargs) -> None:
+        """
+        [type, dimensions] of every variable, an optional third item holds
+        the options of createVariable, e.g. zlib, shuffle, complevel and
+        least_significant_digit. The chunks are given by "chunksizes" or
+        by "chunk", the dimension read one index at a time, e.g. "time" or
+        "Ne", see chunk_shape.
+        """
+
+        for var_name, spec in kwargs.items():
+
+            var_type, dimensions = spec[0], spec[1]
+            options = dict(spec[2]) if len(spec) > 2 else {}
 
-        for var_name, (var_type, dimensions) in kwargs.items():
-            self.nc_file.createVariable(var_name, var_type, dimensions)
+            slicing = options.pop('chunk', None)
+            if not slicing is None:
+                options['chunksizes'] = self.chunk_shape(
+                    dimensions, slicing, np.dtype(var_type).itemsize)
+
+            self.nc_file.createVariable(var_name, var_type, dimensions,
+                                        **options)
 
     def define_variable_dict(self, var_dict):
 
-        for i_key in var_dict.keys():
-            self.nc_file.createVariable(i_key,
-                                        var_dict[i_key][0],
-                                        dimensions=var_dict[i_key][1])
+        self.define_variable(**var_dict)
+
+    ### *--- chunks of the slices read one by one ---* ###
+    def chunk_shape(self,
+                    dimensions,
+                    slicing: str,
+                    itemsize=4,
+                    max_bytes=4 * 2**20) -> tuple:
+        """
+        params:
+            dimensions: dimensions of the variable.
+            slicing: the dimension read one index at a time, the chunks
+                     hold whole slices of the dimensions after it. The
+                     dimensions after it are cut to 1 from the outside in
+                     until the chunk fits into max_bytes, the last two
+                     (the horizontal field) are kept whole.
+
+        return:
+            chunksizes of createVariable
+        """
+
+        dimensions = (dimensions, ) if isinstance(dimensions,
+                                                  str) else tuple(dimensions)
+        if slicing not in dimensions:
+            raise ValueError('Invalid chunk dimension -> "%s" <-' % (slicing))
+
+        sizes = [
+            max(self.nc_file.dimensions[dim].size, 1) for dim in dimensions
+        ]
+        i_slice = dimensions.index(slicing)
+        chunk = [1] * (i_slice + 1) + sizes[i_slice + 1:]
+
+        for i_dim in range(i_slice + 1, len(dimensions) - 2):
+            if np.prod(chunk) * itemsize <= max_bytes:
+                break
+            chunk[i_dim] = 1
+
+        return tuple(chunk)
 
     ### *--- set global attribute ---* ###
     def set_attr_global(self, **kwargs) -> None:
@@ -98,32 +161,76 @@ class NcProduct:
 
         for key in kwargs.keys():
 
-            ### determine if the variables contain a unlimited dimendion ###
             ### Attention： the first dimension must be time if there is unlimited dim ###
-            unlimit_flag = False
-            time_dim = str(self.nc_file[key].dimensions[0])
-            if self.nc_file.dimensions[time_dim].isunlimited():
-                unlimit_flag = True
+            time_dim = self.record_dim(key)
+
+            ### *--- not time dimension ---* ###
+            if time_dim is None:
+                self.nc_file[key][:] = kwargs[key]
+                continue
 
             ### *--- time dimension ---* ###
-            if unlimit_flag:
+            # assign the dim to add the data
+            if not count == 1e9:
+                index = int(count)
+            # append the data after the last time dim, the buffered
+            # records included
+            else:
+                index = max([self.nc_file.dimensions[time_dim].size] + [
+                    start + len(records)
+                    for name, (records, start) in self.buffer.items()
+                    if self.record_dims[name] == time_dim
+                ])
+
+            if self.buffer_size > 0:
+                self.buffer_record(key, index, kwargs[key])
+            else:
+                self.nc_file[key][index] = kwargs[key]
 
-                time_dim_size = self.nc_file.dimensions[time_dim].size
-                # assign the dim to add the data
-                if not count == 1e9:
-                    self.nc_file[key][count] = kwargs[key]
-                # append the data after the last time dim
-                else:
-                    self.nc_file[key][time_dim_size] = kwargs[key]
+    def record_dim(self, key: str):
 
-            ### *--- not time dimension ---* ###
-            else:
+        # the unlimited dimension is looked up once per variable
+        if not key in self.record_dims.keys():
+            dimensions = self.nc_file[key].dimensions
+            self.record_dims[key] = dimensions[0] if len(
+                dimensions) > 0 and self.nc_file.dimensions[
+                    dimensions[0]].isunlimited() else None
 
-                self.nc_file[key][:] = kwargs[key]
+        return self.record_dims[key]
+
+    ### *--- buffered records, written as slabs ---* ###
+    def buffer_record(self, key: str, count: int, data) -> None:
+
+        data = np.asarray(data)
+        if key in self.buffer.keys():
+            records, start = self.buffer[key]
+            if count != start + len(records):
+                self.flush(key)
+
+        if not key in self.buffer.keys():
+            self.buffer[key] = ([], count)
+
+        self.buffer[key][0].append(data)
+        self.buffered_bytes += data.nbytes
+
+        if self.buffered_bytes >= self.buffer_size:
+            self.flush()
+
+    def flush(self, *keys) -> None:
+        """
+        Write the buffered records, of the given variables or all.
+        """
+
+        for key in (keys if keys else list(self.buffer.keys())):
+
+            records, start = self.buffer.pop(key)
+            self.nc_file[key][start:start + len(records)] = np.stack(records)
+            self.buffered_bytes -= sum(record.nbytes for record in records)
 
     ### *--- close the nc file ---* ###
     def close(self) -> None:
 
+        self.flush()
         self.nc_file.setncattr(
             'history', 'Last modified at %s' %
             datetime.now().astimezone(utc).strftime('%Y-%m-%d %H:%M:%S UTC'))